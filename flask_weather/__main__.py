@@ -1,4 +1,32 @@
-from flask_weather.app import app
+import argparse
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m flask_weather')
+    parser.add_argument('--mode', choices=('flask', 'async'),
+                        default=os.environ.get('SERVER_MODE', 'flask'),
+                        help='flask: Werkzeug server, async: asyncio (aiohttp) server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 9090)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVER_WORKERS', 0)),
+                        help='serve with this many pre-forked gunicorn worker processes, '
+                             '-1 for one per core, 0 for the single process servers')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='threads per worker process in flask mode, '
+                             'defaults to SERVER_THREADS or 8')
+    args = parser.parse_args()
+
+    if args.workers:
+        from flask_weather import server
+        server.run(args.mode, args.host, args.port, max(args.workers, 0), args.threads)
+    elif args.mode == 'async':
+        from flask_weather import routes
+        routes.run(args.host, args.port)
+    else:
+        from flask_weather.app import app
+        app.run(debug=False, host=args.host, port=args.port, threaded=False)
+
 
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0', port=9090, threaded=False)
+    main()
@@ -1,82 +1,211 @@
-import os
-import sys
-import json
-import statistics
-from datetime import datetime
+"""
+Flask serving mode of /current_weather.
+
+The application is built by create_app(). `from flask_weather.app import app`
+still works, and creates it on first use rather than on import. Resources are
+plain Flask class based views whose handlers return the response body, encoded
+by json_response, so serving a request does not need flask-restplus and its
+Swagger and schema dependencies. The Swagger description of the routes is
+built from them the first time /swagger.json is requested.
+"""
+import inspect
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from http import HTTPStatus
+
+from flask import Flask, Response, current_app, g, request
+from flask.views import MethodView
+from werkzeug.exceptions import HTTPException
 
+from flask_weather import health, schema
+from flask_weather.context import init_app
+from flask_weather.helper import encoding, metrics, tracing
+from flask_weather.helper.freshness import ResponseFreshness, is_conditional, not_modified
+from flask_weather.helper.land_mask import LandMaskValidator
+from flask_weather.helper.profiling import parse_capture
+from flask_weather.weather import spatial, subscriptions
+from flask_weather.weather.aggregation import aggregate_temperature, provider_weights
 
-from flask import Flask, make_response, request
-from flask_restplus import Resource, Api
+from .exceptions import InputValidationException, ServiceNotAvailable, SureWeatherException, \
+    ForbiddenException, AppErrorCodes
 
-from flask_weather.helper import google_maps
-from flask_weather.weather import get_available_weather_services
+# Application state from init_app, set by create_app
+global_context = None
 
-from .exceptions import InputValidationException, WeatherServiceException, ServiceNotAvailable, \
-    SureWeatherException, AppErrorCodes
+# Tuples (path, Resource class) of the routes, registered by create_app
+ROUTES = list()
 
 
-def init_logger(logger_level):
+def route(path: str):
     """
-    Initialize the logger
-    :param logger_level:
-    :return:
+    Declares the route of a Resource
+    :param path: URL rule
+    :return: class decorator
     """
-    logger_format = '%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'
-    logging.basicConfig(format=logger_format,
-                        level=logger_level,
-                        datefmt='%d-%m-%Y:%H:%M:%S')
+    def register(resource):
+        ROUTES.append((path, resource))
+        return resource
+    return register
 
 
-def init_app():
+class Resource(MethodView):
     """
-    Initializes the application
-    :return web.Application object
+    Class based view whose handlers return a Response, or a response body and optionally
+    its status, encoded by json_response
     """
-    init_logger(os.environ.get('LOGGING_LEVEL', logging.INFO))
 
-    _context = dict()
+    def dispatch_request(self, *args, **kwargs):
+        result = super().dispatch_request(*args, **kwargs)
+        if isinstance(result, Response):
+            return result
+        if isinstance(result, tuple):
+            return json_response(*result)
+        return json_response(result)
 
-    # Get the available external weather services
-    weather_services = get_available_weather_services()
-    if not weather_services:
-        logging.error("No weather services available")
-        sys.exit(1)
-    _context['weather_services'] = weather_services
 
-    # Checking if maps can be used for validation and zipcode lookup
-    google_maps_key = os.environ.get('GOOGLE_MAPS_APIKEY', None)
-    if google_maps_key:
-        logging.error("Google Maps service available")
-        _context['google_maps'] = google_maps.GoogleMaps(google_maps_key)
-    else:
-        logging.error("Google Maps service NOT available")
+def begin_trace():
+    g.trace = global_context['tracer'].begin(request.path,
+                                             request.headers.get(tracing.TRACE_HEADER))
 
-    return _context
 
+def end_trace(response: Response) -> Response:
+    trace = global_context['tracer'].end(g.pop('trace', None), response.status_code,
+                                         request.path)
+    if trace is not None:
+        response.headers[tracing.TRACE_HEADER] = trace.trace_id
+    return response
 
-app = Flask(__name__)
-api = Api(app)
-global_context = init_app()
 
+def abort_trace(err=None):
+    # Ends the trace when the request failed before its after_request hooks ran
+    if 'trace' in g:
+        global_context['tracer'].end(g.pop('trace'), HTTPStatus.INTERNAL_SERVER_ERROR.value,
+                                     request.path)
+
+
+def http_error(err: HTTPException) -> Response:
+    """
+    Unknown routes and methods get a JSON body, as the resources do
+    :param err: HTTPException raised by Flask
+    :return: Response object
+    """
+    return json_response({'message': err.description}, err.code)
 
-@api.route('/current_weather')
-class CurrentWeather(Resource):
-    LATITUDE_KEY = 'latitude'
-    LONGITUDE_KEY = 'longitude'
-    SERVICES_KEY = 'services'
-    ZIPCODE = 'zipcode'
 
+def _describe(obj) -> str:
+    """
+    :return: docstring of obj without its :param: and :return: fields
+    """
+    lines = inspect.cleandoc(obj.__doc__ or '').split('\n')
+    fields = [index for index, line in enumerate(lines) if line.startswith(':')]
+    return ' '.join(lines[:fields[0]] if fields else lines).strip()
+
+
+def swagger() -> Response:
+    """
+    GET handler for /swagger.json, Swagger 2.0 description of the routes, built on first use
+    :return: Response object
+    """
+    spec = current_app.extensions.get('swagger')
+    if spec is None:
+        paths = dict()
+        for path, resource in ROUTES:
+            paths[path] = {method.lower(): {
+                'summary': _describe(resource),
+                'description': _describe(getattr(resource, method.lower())),
+                'responses': {str(HTTPStatus.OK.value): {'description': 'Success'}},
+            } for method in sorted(resource.methods)}
+        spec = current_app.extensions['swagger'] = {
+            'swagger': '2.0',
+            'info': {'title': 'sure_weather', 'version': '1.0'},
+            'paths': paths,
+        }
+    return json_response(spec)
+
+
+def create_app(context: dict = None) -> Flask:
+    """
+    Creates the Flask application
+    :param context: application state from init_app, initialized when not given
+    :return: Flask object
+    """
+    global global_context  # pylint: disable=global-statement
+    global_context = context if context is not None else init_app()
+
+    flask_app = Flask(__name__)
+    flask_app.before_request(begin_trace)
+    flask_app.after_request(end_trace)
+    flask_app.teardown_request(abort_trace)
+    flask_app.register_error_handler(HTTPException, http_error)
+    for path, resource in ROUTES:
+        flask_app.add_url_rule(path, view_func=resource.as_view(resource.__name__))
+    flask_app.add_url_rule('/swagger.json', view_func=swagger)
+    return flask_app
+
+
+def __getattr__(name: str):
+    # The module level `app` is created the first time it is imported
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def json_response(data, status: int = HTTPStatus.OK.value, headers: dict = None) -> Response:
+    """
+    Encodes the response body with the ResponseEncoder, compressed when the client accepts
+    gzip and the body is large enough
+    :param data: response body
+    :param status: HTTP status
+    :param headers: extra headers
+    :return: Response object
+    """
+    encoder = global_context['response_encoder']
+    with tracing.span('encode'):
+        body = encoder.dumps(data)
+    response = Response(body, status=status, headers=headers,
+                        content_type=encoding.JSON_CONTENT_TYPE)
+    if len(body) >= encoder.compress_min_bytes and \
+            encoder.accepts_gzip(request.headers.get('Accept-Encoding')):
+        response.set_data(encoder.compress(body))
+        response.headers['Content-Encoding'] = encoding.GZIP
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def error_response(err: SureWeatherException) -> Response:
+    """
+    :param err: exception the request failed with
+    :return: Response object with the encoded error, reused for the same error
+    """
+    return Response(global_context['response_encoder'].error_body(err), status=err.HTTP_CODE,
+                    content_type=encoding.JSON_CONTENT_TYPE)
+
+
+@route('/current_weather')
+class CurrentWeather(Resource):
     """
     Main class that handles the router /current_weather
     """
+    LATITUDE_KEY = schema.LATITUDE_KEY
+    LONGITUDE_KEY = schema.LONGITUDE_KEY
+    SERVICES_KEY = schema.SERVICES_KEY
+    ZIPCODE = schema.ZIPCODE
 
     def get_latlon(self, zipcode: str):
         """
-        Uses google maps to get latitude and longitude from a given zipcode
+        Uses the local zipcode index, or else google maps, to get latitude and longitude
+        from a given zipcode
         :param zipcode:
         :return: tuple (latitude, longitude)
         """
+        if 'gazetteer' in global_context:
+            return global_context['gazetteer'].get_latlon(int(zipcode))
+
         if 'google_maps' not in global_context:
             raise ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
                                       'Google maps service not setup')
@@ -85,11 +214,21 @@ class CurrentWeather(Resource):
 
     def parse_request(self, query_params: dict) -> tuple:
         """
-        Parses the request and returns a tuple of (latitude, longitude, services)
-        This method groups the errors if it encounters any
+        Parses the request and returns a tuple of (latitude, longitude, services, strategy)
+        Valid latitude and longitude requests take the fast path of the RequestValidator,
+        the others are parsed again to group the errors if it encounters any
         :param query_params:
-        :return: tuple of (latitude, longitude, services)
+        :return: tuple of (latitude, longitude, services, aggregation strategy)
         """
+        parsed = global_context['request_validator'].validate(
+            query_params, global_context['weather_services'])
+        if parsed is not None:
+            validator = global_context['location_validator']
+            if validator and not validator.validate_location(parsed[0], parsed[1]):
+                raise InputValidationException(AppErrorCodes.INVALID_INPUT,
+                                               [schema.INVALID_LOCATION_ERROR])
+            return parsed
+
         errors = []
         latitude, longitude = None, None
 
@@ -97,111 +236,747 @@ class CurrentWeather(Resource):
             try:
                 latitude, longitude = self.get_latlon(query_params[self.ZIPCODE])
             except ValueError:
-                errors.append('Invalid zipcode {}'.format(query_params[self.ZIPCODE]))
-
-        elif self.LATITUDE_KEY in query_params and self.LATITUDE_KEY in query_params:
-
-            logging.info(query_params)
-            try:
-                latitude = float(query_params[self.LATITUDE_KEY])
+                errors.append(schema.invalid_zipcode_error(query_params[self.ZIPCODE]))
 
-                if not -90 <= latitude <= 90:
-                    errors.append(
-                        'latitude invalid, must be decimal point number between -90 and +90')
-
-            except ValueError:
-                errors.append('latitude invalid, must be decimal point number between -90 and +90')
-
-            try:
-                longitude = float(query_params[self.LONGITUDE_KEY])
+        elif schema.has_latlon(query_params):
+            latitude, longitude = schema.parse_latlon(query_params, errors)
 
-                if not -180 <= longitude <= 180:
-                    errors.append(
-                        'longitude invalid, must be decimal point number between -180 and +180')
-
-            except ValueError:
-                errors.append(
-                    'longitude invalid, must be decimal point number between -180 and +180')
-
-            if 'google_maps' in global_context and not \
-                    global_context['google_maps'].validate_location(latitude, longitude):
-                errors.append('This location is invalid')
+            validator = global_context['location_validator']
+            if not errors and validator and not validator.validate_location(latitude, longitude):
+                errors.append(schema.INVALID_LOCATION_ERROR)
 
         else:
-            errors.append('[latitude, longitude] pair or zipcode must be present')
+            errors.append(schema.MISSING_LOCATION_ERROR)
 
-        if self.SERVICES_KEY in query_params:
-            services = query_params[self.SERVICES_KEY].split(',')
-            invalid_services = set(services).difference(global_context['weather_services'].keys())
-            if invalid_services:
-                errors.append('Invalid services {}'.format(invalid_services))
-        else:
-            services = list(global_context['weather_services'].keys())
+        services = schema.parse_services(query_params, global_context['weather_services'].keys(),
+                                         errors)
+        strategy = schema.parse_aggregation(query_params, errors)
+        schema.parse_lookup(query_params, errors)
 
         if errors:
-            logging.error(errors)
             raise InputValidationException(AppErrorCodes.INVALID_INPUT, errors)
 
-        return latitude, longitude, services
+        return latitude, longitude, services, strategy
+
+    @staticmethod
+    def provider_weights(weather_services) -> dict:
+        """
+        Weights of the readings of the given services
+        :param weather_services: service names
+        :return: dict of service name to weight
+        """
+        return provider_weights(global_context['weather_services'].select(weather_services),
+                                global_context['circuit_breakers'])
+
+    def get_readings(self, latitude: float, longitude: float, weather_services: list,
+                     mode: str = spatial.LIVE):
+        """
+        Gets weather from a given list of services in parallel, or interpolates it from the
+        recent readings around the location when asked to and there are enough of them
+        :param latitude:
+        :param longitude:
+        :param weather_services:
+        :param mode: lookup mode, `live` or `interpolate`
+        :return: FanoutResult with the readings of the services that responded before
+                 the deadline, or InterpolatedResult
+        """
+        if mode == spatial.INTERPOLATE and global_context['reading_index'] is not None:
+            with metrics.REQUEST_SECONDS.time('current_weather', 'interpolate'):
+                result = global_context['reading_index'].interpolate(latitude, longitude,
+                                                                     weather_services)
+            if result is not None:
+                return result
+
+        services = global_context['weather_services'].select(weather_services)
+        with metrics.REQUEST_SECONDS.time('current_weather', 'providers'):
+            return global_context['fanout'].fan_out(services, latitude, longitude)
 
     def get_current_temperature(self, latitude: float, longitude: float,
-                                      weather_services: list) -> tuple:
+                                weather_services: list, strategy: str = None,
+                                mode: str = spatial.LIVE) -> tuple:
         """
-        Gets weather from a given list of services and returns average of the temperature
+        Gets weather from a given list of services in parallel and aggregates the
+        temperature reported by the services that responded before the deadline
         :param latitude:
         :param longitude:
         :param weather_services:
-        :return: tuple (average_fahrenheit, average_celcius)
+        :param strategy: aggregation strategy, defaults to AGGREGATION_STRATEGY
+        :param mode: lookup mode, `live` or `interpolate`
+        :return: tuple (Aggregate, FanoutResult)
+        """
+        result = self.get_readings(latitude, longitude, weather_services, mode)
+
+        with metrics.REQUEST_SECONDS.time('current_weather', 'aggregate'):
+            aggregate = aggregate_temperature(
+                result.readings, self.provider_weights(result.responded), strategy)
+        return aggregate, result
+
+    def fetch(self, query_params: dict, mode: str = None) -> schema.Lookup:
+        """
+        Validates the query parameters and gets the readings, without aggregating them
+        :param query_params:
+        :param mode: lookup mode, defaults to the requested one
+        :return: Lookup
+        """
+        with metrics.REQUEST_SECONDS.time('current_weather', 'parse'):
+            latitude, longitude, services, strategy = self.parse_request(query_params)
+        if 'refresher' in global_context:
+            global_context['refresher'].record(latitude, longitude, services)
+        result = self.get_readings(latitude, longitude, services,
+                                   mode or schema.lookup_mode(query_params))
+        return schema.Lookup(latitude, longitude, services, strategy, result)
+
+    def lookup(self, query_params: dict, headers=None) -> tuple:
+        """
+        Validates the query parameters and gets the current weather. A conditional live
+        lookup whose conditions hold for the readings in the reading cache is not fetched
+        :param query_params:
+        :param headers: request headers, with the conditions of a conditional request
+        :return: tuple (response dict, None when not modified, Validators, None when HTTP
+                 caching is disabled)
+        """
+        with metrics.REQUEST_SECONDS.time('current_weather', 'parse'):
+            latitude, longitude, services, strategy = self.parse_request(query_params)
+        if 'refresher' in global_context:
+            global_context['refresher'].record(latitude, longitude, services)
+
+        mode = schema.lookup_mode(query_params)
+        freshness = global_context['freshness']
+        if freshness is not None and mode == spatial.LIVE and headers is not None and \
+                is_conditional(headers):
+            validators = freshness.cached(latitude, longitude, services, strategy,
+                                          self.provider_weights(services))
+            if validators is not None and not_modified(validators, headers):
+                return None, validators
+
+        aggregate, result = self.get_current_temperature(latitude, longitude, services, strategy,
+                                                         mode)
+        response = schema.build_response(latitude, longitude, services, result, aggregate)
+        return response, \
+            freshness.of_response(latitude, longitude, response) if freshness is not None else None
+
+    def interpolate_many(self, items: list) -> dict:
+        """
+        Interpolates, in one query of the reading index, the locations of a batch asked to
+        be interpolated that are valid latitude and longitude requests
+        :param items: list of query parameter dicts
+        :return: dict of the position in items of each such location to its Lookup, None
+                 when there were not enough readings around it
+        """
+        index = global_context['reading_index']
+        if index is None:
+            return {}
+
+        validator = global_context['location_validator']
+        candidates = list()
+        for position, query_params in enumerate(items):
+            if schema.lookup_mode(query_params) != spatial.INTERPOLATE:
+                continue
+            parsed = global_context['request_validator'].validate(
+                query_params, global_context['weather_services'])
+            if parsed is None or \
+                    validator and not validator.validate_location(parsed[0], parsed[1]):
+                continue
+            candidates.append((position, parsed))
+
+        with metrics.REQUEST_SECONDS.time('batch', 'interpolate'):
+            results = index.interpolate_many([parsed[:2] for _, parsed in candidates],
+                                             [parsed[2] for _, parsed in candidates])
+        return {position: schema.Lookup(*parsed, result) if result is not None else None
+                for (position, parsed), result in zip(candidates, results)}
+
+    def get(self):
         """
-        curr_temp_list = list()
+        GET method handler for /current_weather
+        :return:
+        """
+        query_params = request.args
+        started = time.monotonic()
+        try:
+            with metrics.REQUEST_SECONDS.time('current_weather', 'total'):
+                response, validators = self.lookup(query_params, request.headers)
+            if validators is None:
+                global_context['request_log'].log('current_weather', query_params,
+                                                  HTTPStatus.OK.value, started,
+                                                  responded=response['services_responded'])
+                return response
+
+            conditional = is_conditional(request.headers)
+            if response is None or conditional and not_modified(validators, request.headers):
+                metrics.CONDITIONAL_REQUESTS.inc('not_modified' if response is None else
+                                                 'revalidated')
+                global_context['request_log'].log('current_weather', query_params,
+                                                  HTTPStatus.NOT_MODIFIED.value, started)
+                not_modified_response = Response(status=HTTPStatus.NOT_MODIFIED.value,
+                                                 headers=ResponseFreshness.headers(validators))
+                # A 304 has no body, only the validators and caching headers
+                del not_modified_response.headers['Content-Type']
+                return not_modified_response
+
+            if conditional:
+                metrics.CONDITIONAL_REQUESTS.inc('modified')
+            global_context['request_log'].log('current_weather', query_params,
+                                              HTTPStatus.OK.value, started,
+                                              responded=response['services_responded'])
+            return json_response(response, headers=ResponseFreshness.headers(validators))
 
-        for service_name in weather_services:
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'current_weather')
+            global_context['request_log'].log('current_weather', query_params, err.HTTP_CODE,
+                                              started, error=err)
+            return error_response(err)
+
+
+@route('/current_weather/batch')
+class CurrentWeatherBatch(Resource):
+    """
+    Handles the route /current_weather/batch, current weather of many locations in one request.
+    Identical locations are looked up once, and up to BATCH_CONCURRENCY locations are looked
+    up at a time. Batches larger than BATCH_STREAM_THRESHOLD, or requests that accept
+    application/x-ndjson, get one result per line as the results complete. The readings of
+    the locations that completed together are aggregated in one call
+    """
+    MAX_ITEMS = int(os.environ.get(schema.BATCH_MAX_ITEMS_KEY, schema.DEFAULT_BATCH_MAX_ITEMS))
+    STREAM_THRESHOLD = int(os.environ.get(schema.BATCH_STREAM_THRESHOLD_KEY,
+                                          schema.DEFAULT_BATCH_STREAM_THRESHOLD))
+
+    @staticmethod
+    def _fetch(query_params: dict, mode: str = None) -> tuple:
+        try:
+            return CurrentWeather().fetch(query_params, mode), None
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'batch')
+            return None, err
+
+    @staticmethod
+    def respond(fetched: list) -> list:
+        """
+        Aggregates the readings of completed lookups and builds their responses
+        :param fetched: list of tuples (Lookup, SureWeatherException), one of them None
+        :return: list of tuples (response dict, SureWeatherException), one of them None
+        """
+        lookups = [lookup for lookup, error in fetched if error is None]
+        services = {name for lookup in lookups for name in lookup.result.responded}
+        with metrics.REQUEST_SECONDS.time('batch', 'aggregate'):
+            responses = iter(schema.build_responses(
+                lookups, CurrentWeather.provider_weights(services)))
+
+        results = list()
+        for lookup, error in fetched:
+            response, error = (None, error) if error is not None else next(responses)
+            if response is None and lookup is not None:
+                metrics.ERRORS.inc(error.error_code.name, 'batch')
+            results.append((response, error))
+        return results
+
+    @classmethod
+    def interpolated_results(cls, interpolated: dict, indices: list) -> list:
+        """
+        Aggregates the readings of the interpolated locations in one call
+        :param interpolated: dict of location position to Lookup, from interpolate_many
+        :param indices: indices in the request of each location
+        :return: list of batch results
+        """
+        lookups = [(position, lookup) for position, lookup in interpolated.items()
+                   if lookup is not None]
+        if not lookups:
+            return []
+
+        results = list()
+        responses = cls.respond([(lookup, None) for _, lookup in lookups])
+        for (position, _), (response, error) in zip(lookups, responses):
+            results.extend(schema.batch_result(index, response, error)
+                           for index in indices[position])
+        return results
+
+    def results(self, items: list):
+        """
+        Looks up the locations on the batch worker pool
+        :param items: list of query parameter dicts
+        :return: generator of batch results, in the order they complete
+        """
+        unique_items, indices = schema.dedupe_batch(items)
+        interpolated = CurrentWeather().interpolate_many(unique_items)
+        yield from self.interpolated_results(interpolated, indices)
+
+        # Locations that could not be interpolated are looked up live
+        executor = global_context['batch_executor']
+        futures = {executor.submit(tracing.propagate(self._fetch), query_params,
+                                   spatial.LIVE if position in interpolated else None): position
+                   for position, query_params in enumerate(unique_items)
+                   if interpolated.get(position) is None}
+
+        try:
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                done = list(done)
+                responses = self.respond([future.result() for future in done])
+                for future, (response, error) in zip(done, responses):
+                    for index in indices[futures[future]]:
+                        yield schema.batch_result(index, response, error)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def post(self):
+        """
+        POST method handler for /current_weather/batch
+        :return:
+        """
+        try:
+            items = schema.parse_batch(request.get_json(force=True, silent=True),
+                                       self.MAX_ITEMS)
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'batch')
+            return error_response(err)
+
+        logging.info('Batch of %d locations', len(items))
+        if len(items) > self.STREAM_THRESHOLD or \
+                request.accept_mimetypes.best == schema.NDJSON_CONTENT_TYPE:
+            encoder = global_context['response_encoder']
+            lines = (encoder.dumps(result) + b'\n' for result in self.results(items))
+            if not encoder.accepts_gzip(request.headers.get('Accept-Encoding')):
+                return Response(lines, mimetype=schema.NDJSON_CONTENT_TYPE)
+            return Response(encoder.compress_stream(lines), mimetype=schema.NDJSON_CONTENT_TYPE,
+                            headers={'Content-Encoding': encoding.GZIP,
+                                     'Vary': 'Accept-Encoding'})
+
+        return json_response({'results': sorted(self.results(items),
+                                                key=lambda result: result['index'])})
+
+
+@route('/current_weather/subscribe')
+class CurrentWeatherSubscription(Resource):
+    """
+    Handles the route /current_weather/subscribe, streams the current weather of a set of
+    locations, then an update whenever the temperature of one of them changes, as server-sent
+    events, or NDJSON lines to requests that accept application/x-ndjson. GET subscribes to
+    the location of its query parameters, POST to the locations of a batch body. Each
+    distinct location is polled once for all the clients subscribed to it
+    """
+
+    @staticmethod
+    def lookup_location(location: subscriptions.Location) -> dict:
+        """
+        Polls a subscribed location, runs on the SubscriptionHub pool
+        :param location:
+        :return: response dict
+        """
+        services = list(location.services)
+        with metrics.REQUEST_SECONDS.time('subscription', 'providers'):
+            result = global_context['fanout'].fan_out(
+                global_context['weather_services'].select(services), location.latitude,
+                location.longitude)
+        aggregate = aggregate_temperature(result.readings,
+                                          CurrentWeather.provider_weights(result.responded),
+                                          location.strategy)
+        return schema.build_response(location.latitude, location.longitude, services, result,
+                                     aggregate)
+
+    @staticmethod
+    def parse_locations(items: list) -> OrderedDict:
+        """
+        :param items: list of query parameter dicts, one per location
+        :return: OrderedDict of Location to the list of its indices in items
+        """
+        errors = []
+        parsed = []
+        for index, query_params in enumerate(items):
             try:
-                service = global_context['weather_services'][service_name]
-                curr_temp_list.append(service.get_current_temperature(latitude, longitude))
-            except WeatherServiceException as err:
-                logging.exception(err)
+                parsed.append(CurrentWeather().parse_request(query_params))
+            except InputValidationException as err:
+                errors.extend(err.message if len(items) == 1 else
+                              ['location {}: {}'.format(index, message)
+                               for message in err.message])
+
+        if errors:
+            raise InputValidationException(AppErrorCodes.INVALID_INPUT, errors)
+        return subscriptions.group_locations(parsed)
 
-        logging.info(curr_temp_list)
-        curr_temp_list = [curr_temp for curr_temp in curr_temp_list if curr_temp]
+    def stream(self, items: list) -> Response:
+        """
+        Subscribes to the locations and streams their updates until the client disconnects
+        :param items: list of query parameter dicts, one per location
+        :return: Response object
+        """
+        hub = global_context['subscriptions']
+        ready = threading.Event()
+        try:
+            locations = self.parse_locations(items)
+            hub.start(self.lookup_location)
+            subscription = hub.subscribe(locations, ready.set)
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'subscription')
+            return error_response(err)
+
+        content_type = subscriptions.NDJSON_CONTENT_TYPE \
+            if request.accept_mimetypes.best == subscriptions.NDJSON_CONTENT_TYPE \
+            else subscriptions.SSE_CONTENT_TYPE
+        encoder = global_context['response_encoder']
+
+        def events():
+            while True:
+                if not ready.wait(hub.heartbeat):
+                    yield subscriptions.heartbeat(content_type)
+                    continue
+                ready.clear()
+                yield b''.join(
+                    subscriptions.format_event(
+                        encoder.dumps(schema.batch_result(index, response, error)),
+                        content_type)
+                    for location, response, error in subscription.take()
+                    for index in locations[location])
+
+        logging.info('Subscription to %d locations', len(locations))
+        response = Response(events(), content_type=content_type,
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Runs when the client disconnected, even if the stream never started
+        response.call_on_close(lambda: hub.unsubscribe(subscription))
+        return response
+
+    def get(self):
+        """
+        GET method handler for /current_weather/subscribe, with the query parameters of
+        /current_weather
+        :return:
+        """
+        return self.stream([request.args])
+
+    def post(self):
+        """
+        POST method handler for /current_weather/subscribe, with the body of
+        /current_weather/batch
+        :return:
+        """
+        try:
+            items = schema.parse_batch(request.get_json(force=True, silent=True),
+                                       global_context['subscriptions'].max_locations)
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'subscription')
+            return error_response(err)
+        return self.stream(items)
 
-        if not curr_temp_list:
-            raise ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
-                                      "No weather service available")
 
-        average_fahrenheit = statistics.mean(curr_temp_list)
-        average_celcius = round((average_fahrenheit - 32) * 5 / 9, 2)
-        return average_fahrenheit, average_celcius
+@route('/health/live')
+class Liveness(Resource):
+    """
+    Handles the route /health/live, the process is up
+    """
 
     def get(self):
         """
-        GET method handler for /current_weather
+        GET method handler for /health/live
+        :return:
+        """
+        return health.liveness()
+
+
+@route('/health/ready')
+class Readiness(Resource):
+    """
+    Handles the route /health/ready, 503 while no weather service is available
+    """
+
+    def get(self):
+        """
+        GET method handler for /health/ready
+        :return:
+        """
+        ready, status = health.readiness(global_context)
+        return status, 200 if ready else 503
+
+
+@route('/metrics')
+class Metrics(Resource):
+    """
+    Handles the route /metrics, latency histograms and error counters in the Prometheus
+    text format
+    """
+
+    def get(self):
+        """
+        GET method handler for /metrics
+        :return:
+        """
+        return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@route('/stats/http')
+class HttpPoolStats(Resource):
+    """
+    Handles the route /stats/http, reports connection reuse of the shared HTTP transport
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/http
+        :return:
+        """
+        from flask_weather.helper.http_transport import get_transport
+
+        return get_transport().pool_stats()
+
+
+@route('/stats/cache')
+class ReadingCacheStats(Resource):
+    """
+    Handles the route /stats/cache, reports the hit ratio of the weather reading cache
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/cache
+        :return:
+        """
+        return global_context['reading_cache'].stats()
+
+
+@route('/stats/single_flight')
+class SingleFlightStats(Resource):
+    """
+    Handles the route /stats/single_flight, reports how many lookups shared an upstream call
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/single_flight
+        :return:
+        """
+        stats = {'weather_services': global_context['single_flight'].stats()}
+        if 'google_maps' in global_context:
+            stats['google_maps'] = global_context['google_maps'].single_flight.stats()
+        return stats
+
+
+@route('/stats/circuit_breakers')
+class CircuitBreakerStats(Resource):
+    """
+    Handles the route /stats/circuit_breakers, reports the health of each weather service
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/circuit_breakers
+        :return:
+        """
+        return global_context['circuit_breakers'].stats()
+
+
+@route('/stats/admission')
+class AdmissionStats(Resource):
+    """
+    Handles the route /stats/admission, reports the rate and adaptive concurrency limits
+    of each weather service
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/admission
+        :return:
+        """
+        if global_context['admission'] is None:
+            return {}
+        return global_context['admission'].stats()
+
+
+@route('/stats/hedging')
+class HedgingStats(Resource):
+    """
+    Handles the route /stats/hedging, reports how often slow calls were hedged and won
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/hedging
+        :return:
+        """
+        if global_context['hedgers'] is None:
+            return {}
+        return global_context['hedgers'].stats()
+
+
+@route('/stats/refresher')
+class RefresherStats(Resource):
+    """
+    Handles the route /stats/refresher, reports background refreshes of the hot locations
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/refresher
+        :return:
+        """
+        if 'refresher' not in global_context:
+            return {}
+        return global_context['refresher'].stats()
+
+
+@route('/stats/subscriptions')
+class SubscriptionStats(Resource):
+    """
+    Handles the route /stats/subscriptions, reports the open subscriptions, the distinct
+    locations they poll and how many polls changed the temperature
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/subscriptions
+        :return:
+        """
+        return global_context['subscriptions'].stats()
+
+
+@route('/stats/zipcode_index')
+class ZipcodeIndexStats(Resource):
+    """
+    Handles the route /stats/zipcode_index, reports hits and geocode fallbacks of the index
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/zipcode_index
+        :return:
+        """
+        if 'gazetteer' not in global_context:
+            return {}
+        return global_context['gazetteer'].stats()
+
+
+@route('/stats/land_mask')
+class LandMaskStats(Resource):
+    """
+    Handles the route /stats/land_mask, reports checks and google fallbacks of the land mask
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/land_mask
+        :return:
+        """
+        validator = global_context['location_validator']
+        if not isinstance(validator, LandMaskValidator):
+            return {}
+        return validator.stats()
+
+
+@route('/stats/providers')
+class ProviderStats(Resource):
+    """
+    Handles the route /stats/providers, reports the declared weather services and their settings
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/providers
+        :return:
+        """
+        return global_context['weather_services'].stats()
+
+
+@route('/stats/encoding')
+class EncodingStats(Resource):
+    """
+    Handles the route /stats/encoding, reports the response encoder and compression settings
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/encoding
+        :return:
+        """
+        return global_context['response_encoder'].stats()
+
+
+@route('/stats/reading_index')
+class ReadingIndexStats(Resource):
+    """
+    Handles the route /stats/reading_index, reports the recent readings indexed for
+    interpolation and how often locations were interpolated
+    """
+
+    def get(self):
+        """
+        GET method handler for /stats/reading_index
+        :return:
+        """
+        if global_context['reading_index'] is None:
+            return {}
+        return global_context['reading_index'].stats()
+
+
+def authorize_debug():
+    """
+    :raises ForbiddenException: when DEBUG_TOKEN is set and the request does not carry it
+    """
+    if not tracing.authorized(request.headers.get(tracing.DEBUG_TOKEN_HEADER)):
+        raise ForbiddenException(AppErrorCodes.FORBIDDEN,
+                                 'Missing or invalid {}'.format(tracing.DEBUG_TOKEN_HEADER))
+
+
+@route('/debug/profile')
+class Profile(Resource):
+    """
+    Handles the route /debug/profile, starts and stops the sampling profiler and serves the
+    stacks it captured
+    """
+
+    def get(self):
+        """
+        GET method handler for /debug/profile
+        :return: collapsed stacks of the running or last capture, as text
+        """
+        try:
+            authorize_debug()
+        except SureWeatherException as err:
+            return error_response(err)
+        return Response(global_context['profiler'].collapsed(), content_type='text/plain')
+
+    def post(self):
+        """
+        POST method handler for /debug/profile, starts a capture of `seconds`, or of
+        `requests` requests, sampling every `interval` seconds
         :return:
         """
-        query_params = request.args.to_dict()
-        logging.info('Query params: %s', query_params)
         try:
-            latitude, longitude, services = self.parse_request(query_params)
-            fahrenheit, celcius = self.get_current_temperature(latitude, longitude, services)
-            curr_dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-            response = {
-                'latitude': round(latitude, 2),
-                'longitude': round(longitude, 2),
-                'datetime': curr_dt,
-                "services": services,
-                'temperature': {
-                    "fahrenheit": round(fahrenheit, 2),
-                    "celsius": round(celcius, 2)
-                }
-            }
-            logging.info(response)
-            return response
+            authorize_debug()
+            capture = parse_capture(request.args)
+        except SureWeatherException as err:
+            return error_response(err)
 
+        profiler = global_context['profiler']
+        started = profiler.start(**capture)
+        return profiler.stats(), \
+            HTTPStatus.ACCEPTED.value if started else HTTPStatus.CONFLICT.value
+
+    def delete(self):
+        """
+        DELETE method handler for /debug/profile, stops the running capture
+        :return:
+        """
+        try:
+            authorize_debug()
         except SureWeatherException as err:
-            return make_response({
-                "status": err.HTTP_CODE,
-                "content_type": "application/json",
-                "text": json.dumps(err.to_dict())})
+            return error_response(err)
+        global_context['profiler'].stop()
+        return global_context['profiler'].stats()
 
 
+@route('/debug/slow_requests')
+class SlowRequests(Resource):
+    """
+    Handles the route /debug/slow_requests, the last traced requests slower than
+    TRACE_SLOW_SECONDS with the time spent in each of their stages
+    """
 
+    def get(self):
+        """
+        GET method handler for /debug/slow_requests
+        :return:
+        """
+        try:
+            authorize_debug()
+        except SureWeatherException as err:
+            return error_response(err)
+        tracer = global_context['tracer']
+        return dict(tracer.stats(), slow_requests=tracer.slow_requests())
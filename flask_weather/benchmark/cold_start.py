@@ -0,0 +1,152 @@
+"""
+Measures the cold start of the Flask and asyncio apps in fresh interpreters, and
+fails when it regressed.
+
+    python3 -m flask_weather.benchmark.cold_start --runs 7 --save-baseline cold_start.json
+    python3 -m flask_weather.benchmark.cold_start --runs 7 --baseline cold_start.json
+
+Each run starts a new interpreter that imports the app module and creates the
+app. Times are the best of the runs, in seconds, as noise only adds to them:
+    import      importing flask_weather.app or flask_weather.routes
+    app         importing and creating the app, when a server can start serving
+    ready       until the startup has loaded the weather services, /health/ready
+    process     the whole interpreter, from the parent
+
+The benchmark exits with status 1 when a time exceeds its baseline by more
+than --tolerance, when the app takes longer than --max-app-seconds, when the
+startup fails, or when one of the DEFERRED_MODULES is imported to create the app.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+MODES = ('flask', 'async')
+TIMES = ('import', 'app', 'ready', 'process')
+
+# Modules that must not be imported until they are used
+DEFERRED_MODULES = ('flask_restplus', 'jsonschema')
+
+# Seconds a time may exceed its baseline by, on top of the tolerance, for timer noise
+SLACK = 0.02
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+if sys.argv[1] == 'async':
+    from flask_weather import routes
+    imported = time.perf_counter()
+    application = routes.create_app()
+    startup = application['startup']
+else:
+    from flask_weather import app
+    imported = time.perf_counter()
+    application = app.create_app()
+    startup = app.global_context['startup']
+created = time.perf_counter()
+deferred = [name for name in sys.argv[2].split(',') if name in sys.modules]
+startup.wait(float(sys.argv[3]))
+print(json.dumps({'import': imported - start, 'app': created - start,
+                  'ready': time.perf_counter() - start, 'status': startup.state,
+                  'deferred': deferred}))
+'''
+
+
+def run_once(mode: str, env: dict, timeout: float) -> dict:
+    """
+    Starts the app in a new interpreter
+    :return: dict of the TIMES in seconds, startup status and deferred modules imported
+    """
+    start = time.perf_counter()
+    child = subprocess.run([sys.executable, '-c', CHILD, mode, ','.join(DEFERRED_MODULES),
+                            str(timeout)],
+                           env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if child.returncode:
+        sys.stderr.write(child.stderr.decode())
+        raise RuntimeError('{} app exited with status {}'.format(mode, child.returncode))
+    result = json.loads(child.stdout.decode().strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - start
+    return result
+
+
+def measure(mode: str, runs: int, env: dict, timeout: float) -> dict:
+    """
+    :return: dict of the best of each of the TIMES, the startup statuses and the deferred
+             modules imported
+    """
+    results = [run_once(mode, env, timeout) for _ in range(runs)]
+    summary = {name: min(result[name] for result in results) for name in TIMES}
+    summary['status'] = sorted({result['status'] for result in results})
+    summary['deferred'] = sorted({name for result in results for name in result['deferred']})
+    return summary
+
+
+def regressions(mode: str, summary: dict, baseline: dict, tolerance: float,
+                max_app_seconds: float) -> list:
+    """
+    :return: list of messages, one per regression
+    """
+    found = list()
+    for name in TIMES:
+        limit = baseline.get(mode, {}).get(name)
+        if limit is not None and summary[name] > limit * (1 + tolerance) + SLACK:
+            found.append('{} {} {:.3f}s, baseline {:.3f}s'.format(mode, name, summary[name],
+                                                                   limit))
+    if max_app_seconds and summary['app'] > max_app_seconds:
+        found.append('{} app {:.3f}s, budget {:.3f}s'.format(mode, summary['app'],
+                                                             max_app_seconds))
+    if summary['status'] != ['ready']:
+        found.append('{} startup {}'.format(mode, ', '.join(summary['status'])))
+    if summary['deferred']:
+        found.append('{} imports {} to create the app'.format(mode,
+                                                             ', '.join(summary['deferred'])))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--baseline', help='JSON file of the times to compare with')
+    parser.add_argument('--save-baseline', help='write the times to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction a time may exceed its baseline by')
+    parser.add_argument('--max-app-seconds', type=float, default=None)
+    parser.add_argument('--ready-timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    # The weather services only need their URLs to be created, they are not called
+    env = dict(os.environ, LOGGING_LEVEL='ERROR')
+    for key in ('WEATHERDOTCOM_URL', 'ACCUWEATHER_URL', 'NOAA_URL'):
+        env.setdefault(key, 'http://localhost:5000')
+
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print('{:<6} {:>8} {:>8} {:>8} {:>8}   (seconds, best of {} runs)'.format(
+        'mode', *TIMES, args.runs))
+    summaries, found = dict(), list()
+    for mode in args.modes.split(','):
+        summary = measure(mode, args.runs, env, args.ready_timeout)
+        summaries[mode] = {name: round(summary[name], 4) for name in TIMES}
+        print('{:<6} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'.format(
+            mode, *(summary[name] for name in TIMES)))
+        found.extend(regressions(mode, summary, baseline, args.tolerance,
+                                 args.max_app_seconds))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(summaries, baseline_file, indent=2)
+
+    for message in found:
+        print('REGRESSION: ' + message)
+    sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Measures the CPU cost per response of encoding /current_weather responses,
+error responses and batch responses, for every available encoder.
+
+    python3 -m flask_weather.benchmark.encoding --responses 50000
+
+Cases:
+    response    a /current_weather response
+    error       an error response encoded every time
+    error_body  the error response body reused by ResponseEncoder.error_body
+    batch       a batch response of --batch-size locations
+    batch_gzip  the same batch response, gzip compressed
+"""
+import argparse
+import time
+
+from flask_weather import schema
+from flask_weather.exceptions import InputValidationException, AppErrorCodes
+from flask_weather.helper import encoding
+from flask_weather.weather.aggregation import aggregate_temperature
+from flask_weather.weather.fanout import FanoutResult
+
+
+def sample_response(number: int) -> dict:
+    result = FanoutResult()
+    result.readings.update([('weather.com', 60.0 + number % 7), ('accuweather', 58.5),
+                            ('noaa', 61.25)])
+    return schema.build_response(40.0 + number % 10 / 10, -70.0, result.responded, result,
+                                 aggregate_temperature(result.readings))
+
+
+def measure(func, count: int, repeat: int) -> float:
+    """
+    :return: microseconds per call of func, best of repeat runs
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6 / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--responses', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs')
+    args = parser.parse_args()
+
+    response = sample_response(0)
+    batch = {'results': [schema.batch_result(index, sample_response(index))
+                         for index in range(args.batch_size)]}
+    error = InputValidationException(AppErrorCodes.INVALID_INPUT,
+                                     [schema.MISSING_LOCATION_ERROR])
+    batch_count = max(args.responses // args.batch_size, 10)
+
+    names = [name for name in encoding.ENCODERS
+             if name != encoding.OrjsonEncoder.name or encoding.orjson is not None]
+    print('{:<8} {:>12} {:>12} {:>12} {:>12} {:>12}   (microseconds per response)'.format(
+        'encoder', 'response', 'error', 'error_body', 'batch', 'batch_gzip'))
+    for name in names:
+        encoder = encoding.ResponseEncoder(encoding.get_encoder(name))
+        batch_body = encoder.dumps(batch)
+        results = (
+            measure(lambda: encoder.dumps(response), args.responses, args.repeat),
+            measure(lambda: encoder.dumps(error.to_dict()), args.responses, args.repeat),
+            measure(lambda: encoder.error_body(error), args.responses, args.repeat),
+            measure(lambda: encoder.dumps(batch), batch_count, args.repeat),
+            measure(lambda: encoder.compress(encoder.dumps(batch)), batch_count, args.repeat),
+        )
+        print('{:<8} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.1f} {:>12.1f}'.format(name, *results))
+        print('{:<8} batch of {} locations: {} bytes, {} bytes gzip compressed'.format(
+            '', args.batch_size, len(batch_body), len(encoder.compress(batch_body))))
+
+
+if __name__ == '__main__':
+    main()
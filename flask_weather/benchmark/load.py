@@ -0,0 +1,286 @@
+"""
+Load tests sure_weather against local mocks of the weather and geocode APIs.
+
+Every scenario starts a fresh server, so caches start cold, drives it with a
+closed loop of concurrent clients and reports throughput, latency
+percentiles and the calls that reached the mocked services.
+
+    python3 -m flask_weather.benchmark.load --scenario all --mode async --concurrency 32
+    python3 -m flask_weather.benchmark.load --scenario provider_outage --latency 0.1 --json out.json
+
+Scenarios:
+    cold_cache       every request is for a location not seen before
+    hot_keys         requests concentrate on a few locations, zipf distributed
+    provider_outage  NOAA answers every call with 503
+    provider_throttling  NOAA answers 429 to calls beyond 4 at a time
+    zipcode_heavy    most requests are zipcodes resolved through the geocode API
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import requests
+
+from flask_weather.benchmark.mock_services import MockServices
+
+Scenario = namedtuple('Scenario', ['description', 'paths', 'setup'])
+
+
+def _latlon_path(latitude: float, longitude: float) -> str:
+    return '/current_weather?latitude={:.4f}&longitude={:.4f}'.format(latitude, longitude)
+
+
+def _random_locations(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [(rng.uniform(-60, 70), rng.uniform(-170, 170)) for _ in range(count)]
+
+
+def cold_cache_paths(sequence):
+    """
+    Paths of locations that do not repeat, spaced further apart than a cache grid cell
+    :param sequence: shared itertools.count
+    :return: callable returning the next path
+    """
+    def next_path(_rng):
+        number = next(sequence)
+        return _latlon_path(-60 + (number // 2000) * 0.05 % 130, -170 + (number % 2000) * 0.17)
+    return next_path
+
+
+def hot_keys_paths(_sequence):
+    locations = _random_locations(20, seed=1)
+    weights = [1.0 / rank for rank in range(1, len(locations) + 1)]
+
+    def next_path(rng):
+        return _latlon_path(*rng.choices(locations, weights)[0])
+    return next_path
+
+
+def provider_outage_paths(_sequence):
+    locations = _random_locations(500, seed=2)
+
+    def next_path(rng):
+        return _latlon_path(*rng.choice(locations))
+    return next_path
+
+
+def zipcode_heavy_paths(_sequence):
+    zipcodes = random.Random(3).sample(range(10000, 99999), 2000)
+    locations = _random_locations(200, seed=4)
+
+    def next_path(rng):
+        if rng.random() < 0.9:
+            return '/current_weather?zipcode={}'.format(rng.choice(zipcodes))
+        return _latlon_path(*rng.choice(locations))
+    return next_path
+
+
+def _outage(mocks: MockServices):
+    mocks.configure('noaa', error_rate=1.0)
+
+
+def _throttling(mocks: MockServices):
+    mocks.configure('noaa', capacity=4)
+
+
+SCENARIOS = OrderedDict([
+    ('cold_cache', Scenario('every request is a new location', cold_cache_paths, None)),
+    ('hot_keys', Scenario('20 locations, zipf distributed', hot_keys_paths, None)),
+    ('provider_outage', Scenario('500 locations, NOAA always fails', provider_outage_paths,
+                                 _outage)),
+    ('provider_throttling', Scenario('500 locations, NOAA takes 4 calls at a time',
+                                     provider_outage_paths, _throttling)),
+    ('zipcode_heavy', Scenario('90% of requests by zipcode', zipcode_heavy_paths, None)),
+])
+
+
+def _percentile(latencies: list, fraction: float) -> float:
+    if not latencies:
+        return float('nan')
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def run_load(base_url: str, next_path, concurrency: int, duration: float,
+             seed: int = 0) -> dict:
+    """
+    Sends requests from `concurrency` clients, each one waiting for its response
+    before sending the next, for `duration` seconds
+    :param base_url: url of the server
+    :param next_path: callable taking a random.Random and returning a request path
+    :param concurrency: number of clients
+    :param duration: seconds
+    :param seed: seed of the per client random generators
+    :return: dict with requests, errors, rps and latency percentiles in milliseconds
+    """
+    latencies = [list() for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start_barrier = threading.Barrier(concurrency + 1)
+    deadline = [0.0]
+
+    def client(index: int):
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            path = next_path(rng)
+            start = time.perf_counter()
+            try:
+                response = session.get(base_url + path, timeout=30)
+                response.content
+                if response.status_code != 200:
+                    errors[index] += 1
+            except requests.RequestException:
+                errors[index] += 1
+            latencies[index].append(time.perf_counter() - start)
+        session.close()
+
+    threads = [threading.Thread(target=client, args=(index,), daemon=True)
+               for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    deadline[0] = started + duration
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    merged = sorted(itertools.chain.from_iterable(latencies))
+    return {
+        'requests': len(merged),
+        'errors': sum(errors),
+        'rps': round(len(merged) / elapsed, 1),
+        'p50_ms': round(_percentile(merged, 0.50) * 1000, 2),
+        'p95_ms': round(_percentile(merged, 0.95) * 1000, 2),
+        'p99_ms': round(_percentile(merged, 0.99) * 1000, 2),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode: str, environment: dict, workers: int = 0,
+                 timeout: float = 30.0) -> tuple:
+    """
+    Starts sure_weather in a subprocess and waits until it accepts connections
+    :param mode: flask or async
+    :param environment: variables added to the current environment
+    :param workers: pre-forked worker processes, 0 for the single process servers
+    :param timeout: seconds to wait for the server
+    :return: tuple (subprocess.Popen, base url)
+    """
+    port = _free_port()
+    env = dict(os.environ, **environment)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask_weather', '--mode', mode, '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(workers)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('sure_weather exited with {}'.format(process.returncode))
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process, 'http://127.0.0.1:{}'.format(port)
+        except OSError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError('sure_weather did not start in {} seconds'.format(timeout))
+
+
+def run_scenario(name: str, args) -> dict:
+    """
+    Runs one scenario against a fresh server and fresh mocks
+    :param name: key of SCENARIOS
+    :param args: parsed command line arguments
+    :return: dict report
+    """
+    scenario = SCENARIOS[name]
+    mocks = MockServices(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                         seed=args.seed).start()
+    if scenario.setup is not None:
+        scenario.setup(mocks)
+
+    environment = mocks.environment()
+    for assignment in args.env:
+        key, _, value = assignment.partition('=')
+        environment[key] = value
+
+    process, base_url = start_server(args.mode, environment, args.workers)
+    try:
+        report = run_load(base_url, scenario.paths(itertools.count()), args.concurrency,
+                          args.duration, args.seed)
+    finally:
+        process.terminate()
+        process.wait()
+        mocks.stop()
+
+    upstream = mocks.counts()
+    report['upstream_calls'] = {service: counts['calls'] for service, counts in upstream.items()}
+    report['upstream_throttled'] = sum(counts['throttled'] for counts in upstream.values())
+    report['upstream_calls_per_request'] = round(
+        sum(report['upstream_calls'].values()) / max(report['requests'], 1), 3)
+    return OrderedDict([('scenario', name), ('mode', args.mode)] + list(report.items()))
+
+
+def print_report(reports: list):
+    header = '{:<20} {:>6} {:>8} {:>6} {:>9} {:>9} {:>9} {:>10}  {}'.format(
+        'scenario', 'mode', 'requests', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms',
+        'upstream calls (per request)')
+    print(header)
+    for report in reports:
+        upstream = ' '.join('{}={}'.format(service, calls)
+                            for service, calls in report['upstream_calls'].items())
+        print('{:<20} {:>6} {:>8} {:>6} {:>9} {:>9} {:>9} {:>10}  {} ({})'.format(
+            report['scenario'], report['mode'], report['requests'], report['errors'],
+            report['rps'], report['p50_ms'], report['p95_ms'], report['p99_ms'], upstream,
+            report['upstream_calls_per_request']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=list(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--mode', choices=('flask', 'async'), default='flask',
+                        help='serving mode of sure_weather')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='pre-forked worker processes of the server, 0 for a single process')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run each scenario')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds of simulated latency of every mocked service')
+    parser.add_argument('--jitter', type=float, default=0.02,
+                        help='up to this many seconds are added to the latency at random')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of mocked calls answered with 503')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment variable of the server, can be repeated')
+    parser.add_argument('--json', metavar='PATH', help='also write the reports as JSON')
+    args = parser.parse_args()
+
+    names = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    reports = [run_scenario(name, args) for name in names]
+    print_report(reports)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(reports, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
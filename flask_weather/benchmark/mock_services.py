@@ -0,0 +1,304 @@
+"""
+In-process stand-ins for the weather.com, AccuWeather, NOAA and geocode APIs,
+and for a memcached server.
+
+All of them are served by one local HTTP server. Each service has its own
+latency, jitter, error rate and capacity, which can be changed while the
+server runs, and every call is counted so benchmarks can report upstream
+traffic.
+"""
+import json
+import random
+import socketserver
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+SERVICE_PATHS = {
+    '/weatherdotcom': 'weather.com',
+    '/accuweather': 'accuweather',
+    '/noaa': 'noaa',
+    '/geocode': 'geocode',
+}
+
+
+def _temperature(latitude: float, longitude: float) -> float:
+    return round(60.0 + 30.0 * (1 - abs(latitude) / 90.0) + (longitude % 7), 1)
+
+
+def weather_report(service: str, latitude: float, longitude: float) -> dict:
+    """
+    Report of a weather service in the format its client parses
+    :param service: service name
+    :param latitude:
+    :param longitude:
+    :return: dict
+    """
+    fahrenheit = _temperature(latitude, longitude)
+    if service == 'weather.com':
+        return {'query': {'results': {'channel': {'condition': {'temp': str(fahrenheit)}}}}}
+    if service == 'accuweather':
+        return {'simpleforecast': {'forecastday': [{'current': {'fahrenheit': fahrenheit}}]}}
+    return {'today': {'current': {'fahrenheit': str(fahrenheit)}}}
+
+
+def geocode_report(query: dict) -> dict:
+    """
+    Geocode API response, every location is valid and every zipcode is found
+    :param query: parsed query string
+    :return: dict
+    """
+    if 'address' in query:
+        zipcode = int(query['address'][0])
+        location = {'lat': (zipcode % 180) - 90.0, 'lng': (zipcode % 360) - 180.0}
+        return {'status': 'OK', 'results': [{'geometry': {'location': location}}]}
+    return {'status': 'OK', 'results': [{'formatted_address': 'benchmark'}]}
+
+
+class MockServices:
+    """
+    Local server of the mocked APIs
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: int = None):
+        """
+        :param latency: seconds every service waits before responding
+        :param jitter: up to this many seconds are added to the latency at random
+        :param error_rate: fraction of calls answered with 503
+        :param seed: seed of the random jitter and errors
+        """
+        self.latency = {name: latency for name in SERVICE_PATHS.values()}
+        self.jitter = {name: jitter for name in SERVICE_PATHS.values()}
+        self.error_rate = {name: error_rate for name in SERVICE_PATHS.values()}
+        self.capacity = {name: None for name in SERVICE_PATHS.values()}
+        self.in_flight = Counter()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.throttled = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def configure(self, name: str, latency: float = None, jitter: float = None,
+                  error_rate: float = None, capacity: int = None):
+        """
+        Changes the behaviour of one service, an error_rate of 1 is an outage
+        :param name: service name, or geocode
+        :param capacity: calls the service handles at a time, the others are answered
+                         with 429
+        :return:
+        """
+        if latency is not None:
+            self.latency[name] = latency
+        if jitter is not None:
+            self.jitter[name] = jitter
+        if error_rate is not None:
+            self.error_rate[name] = error_rate
+        if capacity is not None:
+            self.capacity[name] = capacity
+
+    def _respond(self, name: str) -> int:
+        """
+        Counts the call, waits the latency of the service and decides whether it fails
+        :param name: service name
+        :return: HTTP status of the response
+        """
+        with self._lock:
+            self.calls[name] += 1
+            capacity = self.capacity[name]
+            if capacity is not None and self.in_flight[name] >= capacity:
+                self.throttled[name] += 1
+                return 429
+            self.in_flight[name] += 1
+            delay = self.latency[name] + self._random.uniform(0, self.jitter[name])
+            failed = self._random.random() < self.error_rate[name]
+            if failed:
+                self.errors[name] += 1
+
+        try:
+            if delay > 0:
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.in_flight[name] -= 1
+        return 503 if failed else 200
+
+    def start(self):
+        """
+        Starts the server on a free local port
+        :return: self
+        """
+        services = self
+
+        class MockHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _send(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self, body: dict):
+                url = urlparse(self.path)
+                name = SERVICE_PATHS.get(url.path)
+                if name is None:
+                    self._send(404, {'error': 'not found'})
+                    return
+
+                query = parse_qs(url.query)
+                status = services._respond(name)
+                if status == 429:
+                    self._send(status, {'error': 'too many requests'})
+                elif status != 200:
+                    self._send(status, {'error': 'injected failure'})
+                elif name == 'geocode':
+                    self._send(200, geocode_report(query))
+                elif name == 'weather.com':
+                    self._send(200, weather_report(name, float(body.get('lat', 0)),
+                                                   float(body.get('lon', 0))))
+                elif name == 'accuweather':
+                    self._send(200, weather_report(name, float(query['latitude'][0]),
+                                                   float(query['longitude'][0])))
+                else:
+                    latitude, longitude = query['latlon'][0].split(',')
+                    self._send(200, weather_report(name, float(latitude), float(longitude)))
+
+            def do_GET(self):
+                self._handle({})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length) if length else b''
+                try:
+                    body = json.loads(data) if data else {}
+                except ValueError:
+                    body = {}
+                self._handle(body if isinstance(body, dict) else {})
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def environment(self) -> dict:
+        """
+        Environment variables that point the sure_weather services at the mocks
+        :return: dict
+        """
+        return {
+            'WEATHERDOTCOM_URL': self.url,
+            'ACCUWEATHER_URL': self.url,
+            'NOAA_URL': self.url,
+            'GOOGLE_MAPS_URL': self.url + '/geocode',
+            'GOOGLE_MAPS_APIKEY': 'benchmark',
+        }
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.throttled.clear()
+
+    def counts(self) -> dict:
+        """
+        Calls, injected errors and throttled calls per service since the last reset
+        :return: dict
+        """
+        with self._lock:
+            return {name: {'calls': self.calls[name], 'errors': self.errors[name],
+                           'throttled': self.throttled[name]}
+                    for name in SERVICE_PATHS.values()}
+
+
+class MemcachedStandIn:
+    """
+    Local stand-in of a memcached server for the memcached cache backend,
+    supports get, set, delete and flush_all of the text protocol
+    """
+
+    def __init__(self):
+        self.entries = dict()
+        self.commands = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """
+        Starts the server on a free local port
+        :return: self
+        """
+        stand_in = self
+
+        class MemcachedHandler(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                for line in iter(self.rfile.readline, b''):
+                    parts = line.split()
+                    if not parts:
+                        continue
+                    command = parts[0].decode()
+                    noreply = parts[-1] == b'noreply'
+                    with stand_in._lock:
+                        stand_in.commands[command] += 1
+
+                    if command == 'get':
+                        with stand_in._lock:
+                            value = stand_in.entries.get(parts[1])
+                        if value is not None:
+                            self.wfile.write(b'VALUE %s 0 %d\r\n%s\r\n' % (parts[1], len(value),
+                                                                           value))
+                        self.wfile.write(b'END\r\n')
+                    elif command == 'set':
+                        value = self.rfile.read(int(parts[4]) + 2)[:-2]
+                        with stand_in._lock:
+                            stand_in.entries[parts[1]] = value
+                        if not noreply:
+                            self.wfile.write(b'STORED\r\n')
+                    elif command == 'delete':
+                        with stand_in._lock:
+                            stand_in.entries.pop(parts[1], None)
+                        if not noreply:
+                            self.wfile.write(b'DELETED\r\n')
+                    elif command == 'flush_all':
+                        with stand_in._lock:
+                            stand_in.entries.clear()
+                        if not noreply:
+                            self.wfile.write(b'OK\r\n')
+                    else:
+                        self.wfile.write(b'ERROR\r\n')
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), MemcachedHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def address(self) -> str:
+        return '127.0.0.1:{}'.format(self._server.server_address[1])
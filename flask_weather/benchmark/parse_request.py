@@ -0,0 +1,115 @@
+"""
+Measures the cost per request of parsing and validating the /current_weather
+query parameters, and of logging the request, without any server or network.
+
+    python3 -m flask_weather.benchmark.parse_request --requests 200000
+
+Parsers:
+    validator   the RequestValidator fast path, used for valid latitude/longitude requests
+    full        parse_latlon, parse_services and parse_aggregation collecting the errors,
+                used for zipcodes and invalid requests
+Logging:
+    unsampled   the params and the response logged at INFO on every request
+    sampled     RequestLog at REQUEST_LOG_SAMPLE_RATE
+"""
+import argparse
+import logging
+import os
+import random
+import time
+
+from flask_weather import schema
+from flask_weather.helper.request_log import RequestLog
+from flask_weather.weather.aggregation import STRATEGIES
+
+SERVICES = ('weather.com', 'accuweather', 'noaa')
+
+
+def make_requests(count: int, seed: int) -> list:
+    """
+    Valid latitude/longitude requests, a third of them also naming services
+    and an aggregation strategy
+    :return: list of query parameter dicts
+    """
+    rng = random.Random(seed)
+    requests = list()
+    for number in range(count):
+        query_params = {schema.LATITUDE_KEY: '{:.4f}'.format(rng.uniform(-90, 90)),
+                        schema.LONGITUDE_KEY: '{:.4f}'.format(rng.uniform(-180, 180))}
+        if number % 3 == 0:
+            query_params[schema.SERVICES_KEY] = ','.join(rng.sample(SERVICES, 2))
+            query_params[schema.AGGREGATION_KEY] = rng.choice(STRATEGIES)
+        requests.append(query_params)
+    return requests
+
+
+def full_parse(query_params: dict, available_services) -> tuple:
+    errors = []
+    latitude, longitude = schema.parse_latlon(query_params, errors)
+    services = schema.parse_services(query_params, available_services, errors)
+    strategy = schema.parse_aggregation(query_params, errors)
+    if errors:
+        raise ValueError(errors)
+    return latitude, longitude, services, strategy
+
+
+def measure(func, requests: list) -> float:
+    """
+    :return: nanoseconds per call of func on each request
+    """
+    start = time.perf_counter()
+    for query_params in requests:
+        func(query_params)
+    return (time.perf_counter() - start) * 1e9 / len(requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5, help='best of this many runs')
+    parser.add_argument('--sample-rate', type=float, default=RequestLog.DEFAULT_SAMPLE_RATE)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    requests = make_requests(args.requests, args.seed)
+    available = dict.fromkeys(SERVICES)
+    validator = schema.RequestValidator()
+
+    # Log records are formatted and written to /dev/null, as a server would write them
+    devnull = open(os.devnull, 'w')
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    request_log = RequestLog(sample_rate=args.sample_rate)
+    response = {'services_responded': list(SERVICES)}
+
+    def unsampled(query_params):
+        logging.info('Query params: %s', query_params)
+        logging.info(response)
+
+    def sampled(query_params):
+        request_log.log('current_weather', query_params, 200, time.monotonic(),
+                        responded=response['services_responded'])
+
+    cases = (
+        ('validator', lambda query_params: validator.validate(query_params, available)),
+        ('full', lambda query_params: full_parse(query_params, available)),
+        ('unsampled', unsampled),
+        ('sampled', sampled),
+    )
+    results = {name: min(measure(func, requests) for _ in range(args.repeat))
+               for name, func in cases}
+    root.removeHandler(handler)
+    devnull.close()
+
+    for name, nanoseconds in results.items():
+        print('{:<10} {:>10.0f} ns/request'.format(name, nanoseconds))
+    print('parse + validate speedup {:.2f}x, logging speedup {:.2f}x'.format(
+        results['full'] / results['validator'], results['unsampled'] / results['sampled']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Compares zipcode lookups per second of the local zipcode index against the
+remote geocode path. The remote path is served by a local stand-in of the
+geocode API, so the numbers are a best case for Google Maps.
+
+    python3 -m flask_weather.benchmark.zipcode_lookup --zipcodes 40000 --latency 0.02
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from flask_weather.helper.gazetteer import ZipcodeGazetteer
+from flask_weather.helper.google_maps import GoogleMaps
+from flask_weather.helper.http_transport import HttpTransport
+
+
+def start_geocode_server(latency: float) -> ThreadingHTTPServer:
+    """
+    Starts a stand-in for the geocode API on a free local port
+    :param latency: seconds to sleep before every response
+    :return: ThreadingHTTPServer object
+    """
+
+    class GeocodeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            query = parse_qs(urlparse(self.path).query)
+            zipcode = int(query.get('address', ['0'])[0])
+            time.sleep(latency)
+            body = json.dumps({
+                'status': 'OK',
+                'results': [{'geometry': {'location': {'lat': (zipcode % 180) - 90.0,
+                                                       'lng': (zipcode % 360) - 180.0}}}]
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GeocodeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(lookup, zipcodes: list, duration: float) -> tuple:
+    """
+    Calls `lookup` on the zipcodes round robin for `duration` seconds
+    :return: tuple (lookups, lookups per second)
+    """
+    count = 0
+    zipcode_cycle = itertools.cycle(zipcodes)
+    start = time.perf_counter()
+    deadline = start + duration
+    while True:
+        for zipcode in itertools.islice(zipcode_cycle, 100):
+            lookup(zipcode)
+        count += 100
+        if time.perf_counter() >= deadline:
+            break
+    elapsed = time.perf_counter() - start
+    return count, count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--zipcodes', type=int, default=40000,
+                        help='number of zipcodes in the index')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds to run each path')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of simulated geocode API latency')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    locations = [(zipcode, rng.uniform(-90, 90), rng.uniform(-180, 180))
+                 for zipcode in rng.sample(range(10000, 999999), args.zipcodes)]
+    zipcodes = [location[0] for location in locations]
+    rng.shuffle(zipcodes)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_path = os.path.join(tmp_dir, 'zipcodes.idx')
+
+        start = time.perf_counter()
+        ZipcodeGazetteer.write_index(index_path, locations)
+        gazetteer = ZipcodeGazetteer(index_path)
+        load_time = time.perf_counter() - start
+
+        local_count, local_rate = measure(gazetteer.get_latlon, zipcodes, args.duration)
+
+        server = start_geocode_server(args.latency)
+        maps = GoogleMaps('benchmark', transport=HttpTransport(),
+                          geocode_url='http://127.0.0.1:{}/geocode'.format(server.server_port))
+        # Every lookup should reach the geocode stand-in
+        maps.cache_ttl = 0
+        remote_count, remote_rate = measure(maps.get_latlon, zipcodes, args.duration)
+        server.shutdown()
+
+    print('index build + load : {:.3f} s for {} zipcodes'.format(load_time, args.zipcodes))
+    print('local index        : {:>12,.0f} lookups/s ({:.2f} us/lookup, {} lookups)'.format(
+        local_rate, 1e6 / local_rate, local_count))
+    print('remote geocode     : {:>12,.0f} lookups/s ({:.2f} us/lookup, {} lookups)'.format(
+        remote_rate, 1e6 / remote_rate, remote_count))
+    print('speedup            : {:>12,.0f}x'.format(local_rate / remote_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_weather import schema
+
+from flask_weather.helper.encoding import ResponseEncoder
+from flask_weather.helper.freshness import ResponseFreshness
+from flask_weather.helper.gazetteer import ZipcodeGazetteer
+from flask_weather.helper.land_mask import LandMaskValidator
+from flask_weather.helper.profiling import SamplingProfiler
+from flask_weather.helper.request_log import RequestLog
+from flask_weather.helper.single_flight import SingleFlight
+from flask_weather.helper.tracing import Tracer
+from flask_weather.startup import Startup
+from flask_weather.weather import get_available_weather_services
+from flask_weather.weather.admission import AdmissionControllers
+from flask_weather.weather.cache import ReadingCache
+from flask_weather.weather.circuit_breaker import CircuitBreakers
+from flask_weather.weather.fanout import ProviderFanout
+from flask_weather.weather.hedging import Hedgers
+from flask_weather.weather.refresher import HotLocationRefresher
+from flask_weather.weather.spatial import ReadingIndex
+from flask_weather.weather.subscriptions import SubscriptionHub
+
+
+def init_logger(logger_level):
+    """
+    Initialize the logger
+    :param logger_level:
+    :return:
+    """
+    logger_format = '%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'
+    logging.basicConfig(format=logger_format,
+                        level=logger_level,
+                        datefmt='%d-%m-%Y:%H:%M:%S')
+
+
+def load_weather_services(weather_services):
+    """
+    Imports and creates every declared weather service
+    :param weather_services: ProviderRegistry
+    :return:
+    """
+    weather_services.load_all()
+    if not weather_services:
+        raise RuntimeError('No weather services available')
+
+
+def init_app(background: bool = None):
+    """
+    Initializes the application state shared by the Flask and asyncio servers. The weather
+    services are loaded by the startup, in the background unless STARTUP_BACKGROUND=0
+    :param background: load the weather services in the background, defaults to
+                       STARTUP_BACKGROUND
+    :return dict
+    """
+    init_logger(os.environ.get('LOGGING_LEVEL', logging.INFO))
+
+    _context = dict()
+
+    # Get the available external weather services
+    weather_services = get_available_weather_services()
+    if not weather_services:
+        logging.error("No weather services available")
+        sys.exit(1)
+    _context['weather_services'] = weather_services
+    _context['startup'] = Startup(background)
+    _context['request_validator'] = schema.RequestValidator()
+    _context['request_log'] = RequestLog()
+    _context['response_encoder'] = ResponseEncoder()
+    _context['profiler'] = SamplingProfiler()
+    _context['tracer'] = Tracer(profiler=_context['profiler'])
+    _context['reading_cache'] = ReadingCache()
+    _context['single_flight'] = SingleFlight()
+    _context['circuit_breakers'] = CircuitBreakers()
+    _context['hedgers'] = Hedgers() if Hedgers.enabled() else None
+    _context['admission'] = AdmissionControllers() if AdmissionControllers.enabled() else None
+    _context['reading_index'] = ReadingIndex() if ReadingIndex.enabled() else None
+    _context['fanout'] = ProviderFanout(reading_cache=_context['reading_cache'],
+                                        single_flight=_context['single_flight'],
+                                        circuit_breakers=_context['circuit_breakers'],
+                                        hedgers=_context['hedgers'],
+                                        admission=_context['admission'],
+                                        reading_index=_context['reading_index'])
+    _context['freshness'] = ResponseFreshness(_context['reading_cache'],
+                                              _context['reading_index']) \
+        if ResponseFreshness.enabled() else None
+
+    # Keeps the most requested locations fresh and lets the cache serve stale readings
+    # while they are refreshed, REFRESH_HOT_LOCATIONS=0 disables both
+    hot_locations = int(os.environ.get(HotLocationRefresher.HOT_LOCATIONS_KEY,
+                                       HotLocationRefresher.DEFAULT_HOT_LOCATIONS))
+    if hot_locations > 0:
+        _context['refresher'] = HotLocationRefresher(_context['fanout'], weather_services,
+                                                     hot_locations=hot_locations)
+        _context['reading_cache'].refresher = _context['refresher']
+
+    # Locations subscribed to by streaming clients, each polled once for all its subscribers
+    _context['subscriptions'] = SubscriptionHub()
+
+    # Locations of batch requests are looked up on their own pool, each lookup fans out
+    # on the fanout pool, so keep BATCH_CONCURRENCY * services below FANOUT_MAX_WORKERS
+    _context['batch_executor'] = ThreadPoolExecutor(
+        max_workers=int(os.environ.get(schema.BATCH_CONCURRENCY_KEY,
+                                       schema.DEFAULT_BATCH_CONCURRENCY)),
+        thread_name_prefix='batch')
+
+    # Checking if maps can be used for validation and zipcode lookup
+    google_maps_key = os.environ.get('GOOGLE_MAPS_APIKEY', None)
+    if google_maps_key:
+        from flask_weather.helper import google_maps
+
+        logging.error("Google Maps service available")
+        _context['google_maps'] = google_maps.GoogleMaps(google_maps_key)
+    else:
+        logging.error("Google Maps service NOT available")
+
+    # Local zipcode index, google maps is only used for zipcodes missing from it
+    zipcode_index = os.environ.get(ZipcodeGazetteer.INDEX_PATH_KEY, None)
+    if zipcode_index:
+        fallback = None
+        if 'google_maps' in _context and \
+                os.environ.get(ZipcodeGazetteer.FALLBACK_KEY, '1') != '0':
+            fallback = _context['google_maps'].get_latlon
+        _context['gazetteer'] = ZipcodeGazetteer(zipcode_index, fallback)
+
+    _context['location_validator'] = init_location_validator(_context.get('google_maps'))
+
+    _context['startup'].run([
+        ('weather_services', lambda: load_weather_services(weather_services)),
+    ])
+    if not _context['startup'].background and _context['startup'].state == Startup.FAILED:
+        sys.exit(1)
+
+    return _context
+
+
+def init_location_validator(maps):
+    """
+    Selects how lat/lon locations are validated with LOCATION_VALIDATOR, one of
+    `land_mask` (local, needs LAND_MASK_PATH), `google` or `none`. Defaults to the
+    land mask when LAND_MASK_PATH is set, else google maps when available
+    :param maps: GoogleMaps object or None
+    :return: object with validate_location(latitude, longitude), or None
+    """
+    mask_path = os.environ.get(LandMaskValidator.PATH_KEY, None)
+    default = 'land_mask' if mask_path else 'google' if maps else 'none'
+    validator = os.environ.get('LOCATION_VALIDATOR', default)
+
+    if validator == 'land_mask' and mask_path:
+        fallback = maps if os.environ.get(LandMaskValidator.FALLBACK_KEY, '0') == '1' else None
+        return LandMaskValidator(mask_path, fallback)
+
+    if validator in ('land_mask', 'google') and maps:
+        logging.info("Validating locations with Google Maps")
+        return maps
+
+    logging.info("Locations are not validated")
+    return None
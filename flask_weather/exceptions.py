@@ -12,6 +12,7 @@ class AppErrorCodes(Enum):
     WEATHER_SERVICE_ERROR = 4
     GOOGLE_MAPS_ERROR = 5
     SERVICE_NOT_AVAILABLE = 6
+    FORBIDDEN = 7
 
 
 class SureWeatherException(Exception, ABC):
@@ -39,8 +40,15 @@ class InputValidationException(SureWeatherException):
 class WeatherServiceException(SureWeatherException):
     HTTP_CODE = HTTPStatus.SERVICE_UNAVAILABLE.value
 
-    def __init__(self, error_code: AppErrorCodes, message: str):
+    def __init__(self, error_code: AppErrorCodes, message: str, status: int = None,
+                 retry_after: float = None):
+        """
+        :param status: HTTP status the weather service answered with, if any
+        :param retry_after: seconds the weather service asked to wait before calling again
+        """
         super().__init__(error_code, message)
+        self.status = status
+        self.retry_after = retry_after
 
 
 class ServiceNotAvailable(SureWeatherException):
@@ -48,3 +56,38 @@ class ServiceNotAvailable(SureWeatherException):
 
     def __init__(self, error_code: AppErrorCodes, message: str):
         super().__init__(error_code, message)
+
+
+class ForbiddenException(SureWeatherException):
+    HTTP_CODE = HTTPStatus.FORBIDDEN.value
+
+    def __init__(self, error_code: AppErrorCodes, message: str):
+        super().__init__(error_code, message)
+
+
+class ProviderSkippedException(WeatherServiceException):
+    """
+    Raised instead of calling a weather service that must not be called now,
+    the service is skipped rather than counted as failed
+    """
+
+    def __init__(self, error_code: AppErrorCodes, message: str):
+        super().__init__(error_code, message)
+
+
+class CircuitOpenException(ProviderSkippedException):
+    """
+    Raised instead of calling a weather service whose circuit breaker is open
+    """
+
+    def __init__(self, error_code: AppErrorCodes, message: str):
+        super().__init__(error_code, message)
+
+
+class ProviderSaturatedException(ProviderSkippedException):
+    """
+    Raised instead of calling a weather service that is at its rate or concurrency limit
+    """
+
+    def __init__(self, error_code: AppErrorCodes, message: str):
+        super().__init__(error_code, message)
@@ -0,0 +1,37 @@
+"""
+Liveness and readiness of a sure_weather process, shared by the Flask and aiohttp apps.
+"""
+import os
+
+from flask_weather.weather.circuit_breaker import CircuitBreaker
+
+
+def liveness() -> dict:
+    """
+    The process is up and answering requests
+    :return: dict
+    """
+    return {'status': 'alive', 'pid': os.getpid()}
+
+
+def readiness(context: dict) -> tuple:
+    """
+    The process can answer /current_weather: the startup has completed, at least one weather
+    service is configured and its circuit breaker is not open
+    :param context: application state from init_app
+    :return: tuple (ready, dict)
+    """
+    startup = context['startup']
+    if not startup.ready:
+        return False, dict(startup.status(), pid=os.getpid())
+
+    breakers = context['circuit_breakers']
+    providers = {name: breakers.get(name).state for name in context['weather_services']}
+    available = [name for name, state in providers.items() if state != CircuitBreaker.OPEN]
+
+    return bool(available), {
+        'status': 'ready' if available else 'unavailable',
+        'pid': os.getpid(),
+        'providers': providers,
+        'available': len(available),
+    }
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from http import HTTPStatus
+
+import aiohttp
+
+from flask_weather.exceptions import ServiceNotAvailable, AppErrorCodes
+from flask_weather.helper import metrics
+from flask_weather.helper.single_flight import AsyncSingleFlight
+
+
+class AsyncGoogleMaps:
+    """
+    Non-blocking client of the geocode API, shares the key, url, cache and response handling
+    of a GoogleMaps object
+    """
+
+    def __init__(self, maps, session: aiohttp.ClientSession):
+        """
+        :param maps: GoogleMaps object
+        :param session: aiohttp.ClientSession object
+        """
+        self.maps = maps
+        self.session = session
+        self.single_flight = AsyncSingleFlight()
+
+    async def _geocode(self, params: dict) -> tuple:
+        """
+        Calls the geocode API
+        :param params:
+        :return: tuple (status code, json data or None)
+        """
+        try:
+            async with self.session.post(self.maps.geocode_url, params=params) as response:
+                data = None
+                if response.status == HTTPStatus.OK:
+                    data = await response.json(content_type=None)
+                return response.status, data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            logging.exception(err)
+            raise ServiceNotAvailable(AppErrorCodes.GOOGLE_MAPS_ERROR,
+                                      'Google maps request failed') from err
+
+    async def _validate_location(self, latitude: float, longitude: float) -> bool:
+        status, data = await self._geocode(self.maps.validate_params(latitude, longitude))
+        return self.maps.is_valid_location(status, data)
+
+    async def validate_location(self, latitude: float, longitude: float) -> bool:
+        """
+        Checks with the geocode API that the location is valid
+        :param latitude:
+        :param longitude:
+        :return: True if valid
+        """
+        key = ('latlng', latitude, longitude)
+        with metrics.timed_call(metrics.GOOGLE_MAPS_SECONDS, 'validate_location', 'google_maps'):
+            found, valid = self.maps.cached(key)
+            if not found:
+                valid = await self.single_flight.do(
+                    key, lambda: self._validate_location(latitude, longitude))
+                self.maps.remember(key, valid)
+            return valid
+
+    async def _get_latlon(self, zipcode: int) -> tuple:
+        status, data = await self._geocode(self.maps.latlon_params(zipcode))
+        return self.maps.parse_latlon(zipcode, status, data)
+
+    async def get_latlon(self, zipcode: int) -> tuple:
+        """
+        Gets the latitude and longitude of a zipcode from the geocode API
+        :param zipcode:
+        :return: tuple (latitude, longitude)
+        """
+        key = ('address', zipcode)
+        with metrics.timed_call(metrics.GOOGLE_MAPS_SECONDS, 'get_latlon', 'google_maps'):
+            found, location = self.maps.cached(key)
+            if not found:
+                try:
+                    location = await self.single_flight.do(key,
+                                                           lambda: self._get_latlon(zipcode))
+                except ValueError:
+                    location = None
+                self.maps.remember(key, location)
+
+        if location is None:
+            raise ValueError(f'Invalid zipcode: {zipcode}')
+        return location
@@ -0,0 +1,429 @@
+"""
+Storage backends of the reading and geocode caches.
+
+A backend stores entries `(expires_at, value, error)` under tuple keys, where
+`expires_at` is a wall clock timestamp so that every process agrees on it,
+`value` is None, a bool, a float or a pair of floats, and `error` is None or a
+tuple `(AppErrorCodes, message)`. Expiry, negative caching and statistics are
+left to the caches, backends only store, look up and evict entries.
+
+* MemoryBackend keeps the entries in the process, least recently used first.
+* SharedMemoryBackend keeps them in a memory mapped file, usually under
+  /dev/shm, that every worker process on a node maps. Readers take no lock,
+  each slot is guarded by a sequence number, writers lock the slot with fcntl
+  against other processes and with a striped thread lock against the other
+  threads of their own, as fcntl locks are held per process.
+* MemcachedBackend is a client of the memcached text protocol, for caches
+  shared between nodes.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from flask_weather.exceptions import AppErrorCodes
+
+BACKEND_KEY = 'CACHE_BACKEND'
+SHARED_DIR_KEY = 'CACHE_SHARED_DIR'
+SHARED_SLOTS_KEY = 'CACHE_SHARED_SLOTS'
+MEMCACHED_KEY = 'CACHE_MEMCACHED'
+MEMCACHED_TIMEOUT_KEY = 'CACHE_MEMCACHED_TIMEOUT'
+
+DEFAULT_BACKEND = 'memory'
+DEFAULT_SHARED_SLOTS = 65536
+DEFAULT_MEMCACHED = '127.0.0.1:11211'
+DEFAULT_MEMCACHED_TIMEOUT = 0.05
+
+_NONE, _FALSE, _TRUE, _FLOAT, _PAIR, _ERROR = range(6)
+_HEADER = struct.Struct('<dB')
+_FLOAT_STRUCT = struct.Struct('<d')
+_PAIR_STRUCT = struct.Struct('<dd')
+MAX_MESSAGE = 54
+
+
+def encode_entry(entry: tuple) -> bytes:
+    """
+    Packs an entry into at most 64 bytes
+    :param entry: tuple (expires_at, value, error)
+    :return: bytes
+    """
+    expires_at, value, error = entry
+    if error is not None:
+        error_code, message = error
+        return _HEADER.pack(expires_at, _ERROR) + bytes((error_code.value,)) + \
+            str(message).encode()[:MAX_MESSAGE]
+    if value is None:
+        return _HEADER.pack(expires_at, _NONE)
+    if value is True or value is False:
+        return _HEADER.pack(expires_at, _TRUE if value else _FALSE)
+    if isinstance(value, tuple):
+        return _HEADER.pack(expires_at, _PAIR) + _PAIR_STRUCT.pack(*value)
+    return _HEADER.pack(expires_at, _FLOAT) + _FLOAT_STRUCT.pack(value)
+
+
+def decode_entry(data: bytes) -> tuple:
+    """
+    Unpacks an entry packed by encode_entry
+    :param data: bytes
+    :return: tuple (expires_at, value, error)
+    """
+    expires_at, tag = _HEADER.unpack_from(data)
+    body = data[_HEADER.size:]
+    if tag == _ERROR:
+        return expires_at, None, (AppErrorCodes(body[0]), body[1:].decode(errors='replace'))
+    if tag == _FLOAT:
+        return expires_at, _FLOAT_STRUCT.unpack(body)[0], None
+    if tag == _PAIR:
+        return expires_at, _PAIR_STRUCT.unpack(body), None
+    return expires_at, {_NONE: None, _FALSE: False, _TRUE: True}[tag], None
+
+
+def encode_key(namespace: str, key: tuple) -> bytes:
+    return '{}:{}'.format(namespace, '|'.join(str(part) for part in key)).encode()
+
+
+class CacheBackend(ABC):
+    """
+    Storage of cache entries
+    """
+    NAME = None
+
+    @abstractmethod
+    def get(self, key: tuple):
+        """
+        :param key: tuple
+        :return: tuple (expires_at, value, error), None if missing
+        """
+
+    @abstractmethod
+    def set(self, key: tuple, entry: tuple):
+        """
+        :param key: tuple
+        :param entry: tuple (expires_at, value, error)
+        :return:
+        """
+
+    @abstractmethod
+    def delete(self, key: tuple):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'backend': self.NAME}
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In process, least recently used entries are evicted beyond `max_entries`
+    """
+    NAME = 'memory'
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: tuple, entry: tuple):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'backend': self.NAME,
+            'size': size,
+            'max_entries': self.max_entries,
+            'evictions': self.evictions,
+        }
+
+
+class SharedMemoryBackend(CacheBackend):
+    """
+    Hash table of fixed size slots in a memory mapped file.
+
+    A key hashes to a slot and may live in any of the next `PROBES` slots. When
+    all of them are taken, the entry that expires first is replaced. Slot layout:
+    sequence number (uint32), key length (uint8), data length (uint8),
+    2 bytes padding, 56 bytes key, 64 bytes data. The sequence number is odd
+    while a writer is changing the slot, readers retry when it is odd or
+    changes while they read.
+    """
+    NAME = 'shared'
+    MAGIC = b'SWCACHE1'
+    FILE_HEADER = struct.Struct('<8sI')
+    SLOT_HEADER = struct.Struct('<IBBxx')
+    SLOT_SIZE = 128
+    KEY_SIZE = 56
+    DATA_SIZE = 64
+    PROBES = 8
+    READ_RETRIES = 4
+    LOCK_STRIPES = 64
+
+    # fcntl locks do not exclude the threads of the process that holds them
+    _header_lock = threading.Lock()
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        self.evictions = 0
+        self.oversized = 0
+        self.size = self.FILE_HEADER.size + slots * self.SLOT_SIZE
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._header_lock:
+            self._init_file()
+
+        self._map = mmap.mmap(self._fd, self.size)
+
+    def _init_file(self):
+        path, slots = self.path, self.slots
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.FILE_HEADER.size, 0)
+        try:
+            header = os.pread(self._fd, self.FILE_HEADER.size, 0)
+            if len(header) < self.FILE_HEADER.size or \
+                    self.FILE_HEADER.unpack(header) != (self.MAGIC, slots):
+                logging.info('Creating shared cache %s with %d slots', path, slots)
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, self.FILE_HEADER.pack(self.MAGIC, slots), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.FILE_HEADER.size, 0)
+
+    def _offsets(self, key_bytes: bytes):
+        start = zlib.crc32(key_bytes) % self.slots
+        for probe in range(self.PROBES):
+            yield self.FILE_HEADER.size + ((start + probe) % self.slots) * self.SLOT_SIZE
+
+    def _read_slot(self, offset: int):
+        """
+        :return: tuple (key bytes, data bytes), None while a writer holds the slot
+        """
+        for _ in range(self.READ_RETRIES):
+            sequence, key_length, data_length = self.SLOT_HEADER.unpack_from(self._map, offset)
+            if sequence % 2:
+                continue
+            slot = self._map[offset:offset + self.SLOT_SIZE]
+            if self.SLOT_HEADER.unpack_from(self._map, offset)[0] != sequence:
+                continue
+            key_start = self.SLOT_HEADER.size
+            data_start = key_start + self.KEY_SIZE
+            return slot[key_start:key_start + key_length], \
+                slot[data_start:data_start + data_length]
+        return None
+
+    def _write_slot(self, offset: int, key_bytes: bytes, data: bytes):
+        stripe = (offset // self.SLOT_SIZE) % self.LOCK_STRIPES
+        with self._locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT_SIZE, offset)
+            try:
+                sequence = self.SLOT_HEADER.unpack_from(self._map, offset)[0]
+                self.SLOT_HEADER.pack_into(self._map, offset, (sequence + 1) & 0xFFFFFFFF, 0, 0)
+                key_start = offset + self.SLOT_HEADER.size
+                self._map[key_start:key_start + len(key_bytes)] = key_bytes
+                data_start = key_start + self.KEY_SIZE
+                self._map[data_start:data_start + len(data)] = data
+                self.SLOT_HEADER.pack_into(self._map, offset, (sequence + 2) & 0xFFFFFFFF,
+                                           len(key_bytes), len(data))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT_SIZE, offset)
+
+    def get(self, key: tuple):
+        key_bytes = encode_key('', key)
+        for offset in self._offsets(key_bytes):
+            slot = self._read_slot(offset)
+            if slot is None:
+                continue
+            if slot[0] == key_bytes and slot[1]:
+                return decode_entry(slot[1])
+            if not slot[0]:
+                return None
+        return None
+
+    def set(self, key: tuple, entry: tuple):
+        key_bytes = encode_key('', key)
+        if len(key_bytes) > self.KEY_SIZE:
+            self.oversized += 1
+            return
+
+        data = encode_entry(entry)
+        victim, victim_expires = None, None
+        for offset in self._offsets(key_bytes):
+            slot = self._read_slot(offset)
+            if slot is None:
+                continue
+            if slot[0] == key_bytes or not slot[0]:
+                self._write_slot(offset, key_bytes, data)
+                return
+            expires_at = _HEADER.unpack_from(slot[1])[0] if slot[1] else 0.0
+            if victim is None or expires_at < victim_expires:
+                victim, victim_expires = offset, expires_at
+
+        if victim is not None:
+            self.evictions += 1
+            self._write_slot(victim, key_bytes, data)
+
+    def delete(self, key: tuple):
+        key_bytes = encode_key('', key)
+        for offset in self._offsets(key_bytes):
+            slot = self._read_slot(offset)
+            if slot is not None and slot[0] == key_bytes:
+                # Keeps the key so that lookups still probe past this slot
+                self._write_slot(offset, key_bytes, b'')
+                return
+
+    def clear(self):
+        for slot in range(self.slots):
+            offset = self.FILE_HEADER.size + slot * self.SLOT_SIZE
+            if self.SLOT_HEADER.unpack_from(self._map, offset)[1]:
+                self._write_slot(offset, b'', b'')
+
+    def stats(self) -> dict:
+        used = sum(1 for slot in range(self.slots)
+                   if self.SLOT_HEADER.unpack_from(
+                       self._map, self.FILE_HEADER.size + slot * self.SLOT_SIZE)[2])
+        return {
+            'backend': self.NAME,
+            'path': self.path,
+            'size': used,
+            'slots': self.slots,
+            'evictions': self.evictions,
+            'oversized_keys': self.oversized,
+        }
+
+
+class MemcachedBackend(CacheBackend):
+    """
+    Client of a memcached server, one connection per thread. A failing server is
+    treated as an empty cache so requests never fail because of the cache.
+    """
+    NAME = 'memcached'
+
+    def __init__(self, address: str, namespace: str, timeout: float):
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.namespace = namespace
+        self.timeout = timeout
+        self.errors = 0
+        self._local = threading.local()
+
+    def _key(self, key: tuple) -> bytes:
+        return encode_key(self.namespace, key).replace(b' ', b'_')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = self._local.connection = (sock, sock.makefile('rb'))
+            self._local.pid = os.getpid()
+        return connection
+
+    def _command(self, command: bytes, read_response):
+        try:
+            sock, reader = self._connection()
+            sock.sendall(command)
+            return read_response(reader)
+        except (OSError, ValueError) as err:
+            logging.warning('memcached %s: %s', self.address, err)
+            self.errors += 1
+            connection = getattr(self._local, 'connection', None)
+            self._local.connection = None
+            if connection is not None:
+                connection[0].close()
+            return None
+
+    @staticmethod
+    def _read_value(reader):
+        line = reader.readline()
+        if line.startswith(b'VALUE '):
+            length = int(line.split()[3])
+            data = reader.read(length + 2)[:length]
+            if reader.readline() != b'END\r\n':
+                raise ValueError('unexpected response')
+            return data
+        if line != b'END\r\n':
+            raise ValueError('unexpected response {!r}'.format(line))
+        return None
+
+    def get(self, key: tuple):
+        data = self._command(b'get ' + self._key(key) + b'\r\n', self._read_value)
+        return decode_entry(data) if data else None
+
+    def set(self, key: tuple, entry: tuple):
+        data = encode_entry(entry)
+        # memcached expires the entry itself, some time after the caches stop using it
+        exptime = max(int(entry[0] - time.time()) + 3600, 1)
+        self._command(b'set %s 0 %d %d noreply\r\n%s\r\n' % (self._key(key), exptime, len(data),
+                                                              data),
+                      lambda reader: None)
+
+    def delete(self, key: tuple):
+        self._command(b'delete ' + self._key(key) + b' noreply\r\n', lambda reader: None)
+
+    def clear(self):
+        self._command(b'flush_all noreply\r\n', lambda reader: None)
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.NAME,
+            'address': '{}:{}'.format(*self.address),
+            'errors': self.errors,
+        }
+
+
+def create_backend(namespace: str, max_entries: int) -> CacheBackend:
+    """
+    Creates the backend selected with CACHE_BACKEND: memory, shared or memcached
+    :param namespace: name of the cache, keeps the entries of different caches apart
+    :param max_entries: size of the memory backend
+    :return: CacheBackend object
+    """
+    name = os.environ.get(BACKEND_KEY, DEFAULT_BACKEND)
+
+    if name == SharedMemoryBackend.NAME:
+        shared_dir = os.environ.get(SHARED_DIR_KEY) or \
+            ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+        return SharedMemoryBackend(os.path.join(shared_dir, 'sure_weather_' + namespace),
+                                   int(os.environ.get(SHARED_SLOTS_KEY, DEFAULT_SHARED_SLOTS)))
+
+    if name == MemcachedBackend.NAME:
+        return MemcachedBackend(os.environ.get(MEMCACHED_KEY, DEFAULT_MEMCACHED), namespace,
+                                float(os.environ.get(MEMCACHED_TIMEOUT_KEY,
+                                                     DEFAULT_MEMCACHED_TIMEOUT)))
+
+    if name != MemoryBackend.NAME:
+        logging.error('Unknown cache backend %s, using memory', name)
+    return MemoryBackend(max_entries)
@@ -0,0 +1,168 @@
+"""
+Encoding of the JSON responses, shared by the Flask and the asyncio servers.
+
+The encoder is selected with RESPONSE_ENCODER: `orjson` when it is installed,
+which is the default, or `json` for the standard library. The bodies of error
+responses are encoded once and reused, and large bodies are gzip compressed
+for clients that accept it.
+"""
+import json
+import logging
+import os
+import threading
+import zlib
+
+try:
+    import orjson
+except ImportError:  # optional, the standard json module is used without it
+    orjson = None
+
+ENCODER_KEY = 'RESPONSE_ENCODER'
+COMPRESS_MIN_BYTES_KEY = 'RESPONSE_COMPRESS_MIN_BYTES'
+COMPRESS_LEVEL_KEY = 'RESPONSE_COMPRESS_LEVEL'
+
+DEFAULT_COMPRESS_MIN_BYTES = 1024
+DEFAULT_COMPRESS_LEVEL = 5
+
+JSON_CONTENT_TYPE = 'application/json'
+GZIP = 'gzip'
+
+# Error bodies kept, error messages that embed request input can be many
+MAX_ERROR_BODIES = 256
+
+
+class JsonEncoder:
+    """
+    Standard library encoder, without the whitespace after separators
+    """
+    name = 'json'
+
+    def __init__(self):
+        self._encode = json.JSONEncoder(separators=(',', ':')).encode
+
+    def dumps(self, obj) -> bytes:
+        return self._encode(obj).encode()
+
+
+class OrjsonEncoder:
+    """
+    orjson encoder, several times faster than the standard library
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        self._dumps = orjson.dumps
+        self._option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj) -> bytes:
+        return self._dumps(obj, option=self._option)
+
+
+ENCODERS = {
+    JsonEncoder.name: JsonEncoder,
+    OrjsonEncoder.name: OrjsonEncoder,
+}
+
+
+def get_encoder(name: str = None):
+    """
+    :param name: one of ENCODERS, defaults to RESPONSE_ENCODER, else orjson if installed
+    :return: encoder with dumps(obj) -> bytes
+    """
+    name = name or os.environ.get(ENCODER_KEY)
+    if name == OrjsonEncoder.name and orjson is None:
+        logging.error('%s %s is not installed, using json', ENCODER_KEY, name)
+        name = JsonEncoder.name
+    elif name not in ENCODERS:
+        if name:
+            logging.error('Unknown %s %s', ENCODER_KEY, name)
+        name = OrjsonEncoder.name if orjson is not None else JsonEncoder.name
+    return ENCODERS[name]()
+
+
+class GzipStream:
+    """
+    Gzip compression of a streamed body
+    """
+
+    def __init__(self, level: int = DEFAULT_COMPRESS_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk: bytes, flush: bool = True) -> bytes:
+        """
+        :param chunk: next bytes of the body
+        :param flush: flush the compressor, so the client can read the chunk right away
+        :return: compressed bytes to write
+        """
+        data = self._compressor.compress(chunk)
+        return data + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else data
+
+    def close(self) -> bytes:
+        """
+        :return: the last compressed bytes of the body
+        """
+        return self._compressor.flush()
+
+
+class ResponseEncoder:
+    """
+    Encodes response bodies, reuses the bodies of error responses seen before and
+    compresses bodies of at least RESPONSE_COMPRESS_MIN_BYTES, 0 disables compression
+    """
+
+    def __init__(self, encoder=None):
+        self.encoder = encoder or get_encoder()
+        self.dumps = self.encoder.dumps
+        self.compress_min_bytes = int(os.environ.get(COMPRESS_MIN_BYTES_KEY,
+                                                     DEFAULT_COMPRESS_MIN_BYTES))
+        self.compress_level = int(os.environ.get(COMPRESS_LEVEL_KEY, DEFAULT_COMPRESS_LEVEL))
+        self._error_bodies = dict()
+        self._lock = threading.Lock()
+
+    def error_body(self, error) -> bytes:
+        """
+        :param error: SureWeatherException
+        :return: encoded error.to_dict(), the same bytes object for the same error
+        """
+        message = error.message
+        key = (error.error_code, tuple(message) if isinstance(message, list) else message)
+        body = self._error_bodies.get(key)
+        if body is None:
+            body = self.dumps(error.to_dict())
+            if len(self._error_bodies) < MAX_ERROR_BODIES:
+                with self._lock:
+                    self._error_bodies.setdefault(key, body)
+        return body
+
+    def accepts_gzip(self, accept_encoding: str) -> bool:
+        """
+        :param accept_encoding: Accept-Encoding header of the request
+        :return: True if responses to it are compressed when large enough
+        """
+        return self.compress_min_bytes > 0 and GZIP in (accept_encoding or '')
+
+    def compress(self, body: bytes) -> bytes:
+        """
+        :param body: response body of at least compress_min_bytes
+        :return: gzip compressed body
+        """
+        stream = GzipStream(self.compress_level)
+        return stream.compress(body, flush=False) + stream.close()
+
+    def compress_stream(self, chunks):
+        """
+        :param chunks: iterable of bytes of a streamed body
+        :return: generator of the gzip compressed body, one piece per chunk
+        """
+        stream = GzipStream(self.compress_level)
+        for chunk in chunks:
+            yield stream.compress(chunk)
+        yield stream.close()
+
+    def stats(self) -> dict:
+        return {
+            'encoder': self.encoder.name,
+            'error_bodies': len(self._error_bodies),
+            'compress_min_bytes': self.compress_min_bytes,
+            'compress_level': self.compress_level,
+        }
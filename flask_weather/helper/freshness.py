@@ -0,0 +1,184 @@
+"""
+HTTP caching of /current_weather responses.
+
+Responses carry a weak ETag computed from the rounded location, the requested
+services, the aggregation, the readings and the rounded aggregate temperature,
+so it changes when the weights of the readings move the temperature. They also
+carry `Cache-Control: public, max-age` set to the seconds until the first of
+their readings expires from the reading cache, at most HTTP_CACHE_MAX_AGE, and
+a `Last-Modified` of when the newest of their readings was fetched.
+
+A live lookup with If-None-Match or If-Modified-Since is first checked against
+the readings in the reading cache, aggregated with the current weights. When
+every requested service has a fresh entry and the response would not have
+changed, it is answered with 304 without calling the weather services.
+"""
+import hashlib
+import os
+import time
+from collections import namedtuple
+from email.utils import formatdate, parsedate_to_datetime
+
+from flask_weather.weather.aggregation import aggregate_temperature
+from flask_weather.weather.fanout import MEASURED
+from flask_weather.weather.spatial import INTERPOLATED
+
+IF_NONE_MATCH = 'If-None-Match'
+IF_MODIFIED_SINCE = 'If-Modified-Since'
+
+# etag: weak entity tag, last_modified: time() the newest reading was fetched, None when
+# unknown, max_age: seconds the response can be reused for
+Validators = namedtuple('Validators', ['etag', 'last_modified', 'max_age'])
+
+
+def make_etag(latitude: float, longitude: float, services: list, strategy: str,
+              readings: dict, fahrenheit: float, source: str) -> str:
+    """
+    :param latitude: requested latitude
+    :param longitude: requested longitude
+    :param services: requested service names
+    :param strategy: aggregation strategy
+    :param readings: dict of service name to temperature in fahrenheit
+    :param fahrenheit: aggregate temperature
+    :param source: `measured` or `interpolated`
+    :return: weak entity tag, the same in every process for the same arguments
+    """
+    key = repr((round(latitude, 2), round(longitude, 2), tuple(services), strategy,
+                sorted((name, round(value, 2)) for name, value in readings.items()),
+                round(fahrenheit, 2), source))
+    return 'W/"{}"'.format(hashlib.blake2b(key.encode(), digest_size=8).hexdigest())
+
+
+def is_conditional(headers) -> bool:
+    """
+    :param headers: request headers
+    :return: True if the request has If-None-Match or If-Modified-Since
+    """
+    return IF_NONE_MATCH in headers or IF_MODIFIED_SINCE in headers
+
+
+def not_modified(validators: Validators, headers) -> bool:
+    """
+    Evaluates the conditions of a request, If-Modified-Since is ignored when it also
+    has If-None-Match
+    :param validators: Validators of the response
+    :param headers: request headers
+    :return: True if the request can be answered with 304
+    """
+    if_none_match = headers.get(IF_NONE_MATCH)
+    if if_none_match is not None:
+        opaque = validators.etag[2:]
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == opaque:
+                return True
+        return False
+
+    if_modified_since = headers.get(IF_MODIFIED_SINCE)
+    if if_modified_since is None or validators.last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(validators.last_modified) <= since
+
+
+class ResponseFreshness:
+    """
+    Validators and caching headers of /current_weather responses
+    """
+    ENABLED_KEY = 'HTTP_CACHE_ENABLED'
+    MAX_AGE_KEY = 'HTTP_CACHE_MAX_AGE'
+
+    DEFAULT_MAX_AGE = 300
+
+    def __init__(self, reading_cache, reading_index=None, max_age: int = None):
+        """
+        :param reading_cache: ReadingCache the readings of live lookups are served from
+        :param reading_index: ReadingIndex the interpolated readings come from, if any
+        :param max_age: longest max-age sent, in seconds
+        """
+        self.reading_cache = reading_cache
+        self.reading_index = reading_index
+        self.max_age = max_age if max_age is not None else \
+            int(os.environ.get(self.MAX_AGE_KEY, self.DEFAULT_MAX_AGE))
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return os.environ.get(cls.ENABLED_KEY, '1') == '1'
+
+    def _max_age(self, seconds: float) -> int:
+        return int(min(max(seconds, 0), self.max_age))
+
+    def cached(self, latitude: float, longitude: float, services: list, strategy: str,
+               weights: dict) -> Validators:
+        """
+        Validators of the response a live lookup would get from the reading cache alone
+        :param latitude:
+        :param longitude:
+        :param services: requested service names
+        :param strategy: aggregation strategy
+        :param weights: dict of service name to the weight its reading would be aggregated with
+        :return: Validators, None when a service has no fresh entry or none has a reading
+        """
+        now = time.time()
+        readings, fetched, expires = dict(), list(), list()
+        for name in services:
+            entry = self.reading_cache.peek(name, latitude, longitude)
+            # A stale reading would be revalidated by the lookup
+            if entry is None or entry[2] <= now:
+                return None
+            value, fetched_at, expires_at = entry
+            if value is not None:
+                readings[name] = value
+                fetched.append(fetched_at)
+            expires.append(expires_at)
+
+        if not readings:
+            return None
+        fahrenheit = aggregate_temperature(readings, weights, strategy).fahrenheit
+        return Validators(make_etag(latitude, longitude, services, strategy, readings,
+                                    fahrenheit, MEASURED),
+                          max(fetched), self._max_age(min(expires) - now))
+
+    def of_response(self, latitude: float, longitude: float, response: dict) -> Validators:
+        """
+        :param latitude: requested latitude
+        :param longitude: requested longitude
+        :param response: /current_weather response
+        :return: Validators of the response
+        """
+        etag = make_etag(latitude, longitude, response['services'], response['aggregation'],
+                         response['readings'], response['temperature']['fahrenheit'],
+                         response['source'])
+        now = time.time()
+        if response['source'] == INTERPOLATED:
+            max_age = self.reading_index.max_age - response['interpolation']['oldest_seconds'] \
+                if self.reading_index is not None else 0
+            return Validators(etag, None, self._max_age(max_age))
+
+        fetched, expires = list(), list()
+        for name in response['services_responded']:
+            entry = self.reading_cache.peek(name, latitude, longitude)
+            # A reading that was not cached was fetched for this request
+            fetched_at, expires_at = entry[1:] if entry is not None else (now, now)
+            fetched.append(fetched_at)
+            expires.append(expires_at)
+        return Validators(etag, max(fetched, default=now),
+                          self._max_age(min(expires, default=now) - now))
+
+    @staticmethod
+    def headers(validators: Validators) -> dict:
+        """
+        :param validators: Validators of the response
+        :return: dict of the ETag, Last-Modified and Cache-Control headers, sent with the
+                 response and with 304
+        """
+        headers = {
+            'ETag': validators.etag,
+            'Cache-Control': 'public, max-age={}'.format(validators.max_age),
+        }
+        if validators.last_modified is not None:
+            headers['Last-Modified'] = formatdate(validators.last_modified, usegmt=True)
+        return headers
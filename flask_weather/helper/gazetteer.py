@@ -0,0 +1,264 @@
+"""
+Offline zipcode to (latitude, longitude) index.
+
+The index file is a small header followed by three column arrays sorted by
+zipcode (uint32 zipcodes, float64 latitudes, float64 longitudes). Lookups
+are a binary search over the in-memory zipcode array. Locations learnt from
+the fallback geocoder are appended to the end of the file as
+(zipcode, latitude, longitude) records and folded in on the next load.
+
+Build an index from a CSV file with:
+    python3 -m flask_weather.helper.gazetteer build zipcodes.csv zipcodes.idx
+"""
+import argparse
+import csv
+import logging
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+
+class ZipcodeGazetteer:
+    """
+    Resolves zipcodes to (latitude, longitude) from a local index file
+    """
+    INDEX_PATH_KEY = 'ZIPCODE_INDEX'
+    FALLBACK_KEY = 'ZIPCODE_INDEX_FALLBACK'
+
+    MAGIC = b'ZIPIDX1\0'
+    HEADER = struct.Struct('<8sI')
+    RECORD = struct.Struct('<Idd')
+    # Zipcodes are stored as uint32
+    MAX_ZIPCODE = 0xFFFFFFFF
+
+    ZIPCODE_COLUMNS = ('zipcode', 'zip', 'postal_code', 'postcode')
+    LATITUDE_COLUMNS = ('latitude', 'lat')
+    LONGITUDE_COLUMNS = ('longitude', 'lon', 'lng')
+
+    def __init__(self, path: str, fallback=None):
+        """
+        :param path: index file, created empty if it does not exist
+        :param fallback: optional callable(zipcode) -> (latitude, longitude) used on misses
+        """
+        self.path = path
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+        if not os.path.exists(path):
+            self.write_index(path, [])
+
+        self._zipcodes, self._latitudes, self._longitudes, self._learnt = self._load(path)
+        logging.info('Loaded %d zipcodes from %s', len(self), path)
+
+    def __len__(self):
+        return len(self._zipcodes) + len(self._learnt)
+
+    @staticmethod
+    def _column(fmt: str, data: bytes):
+        values = array(fmt)
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    @classmethod
+    def _load(cls, path: str) -> tuple:
+        with open(path, 'rb') as index_file:
+            data = index_file.read()
+
+        magic, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError('{} is not a zipcode index'.format(path))
+
+        offset = cls.HEADER.size
+        zipcodes = cls._column('I', data[offset:offset + 4 * count])
+        offset += 4 * count
+        latitudes = cls._column('d', data[offset:offset + 8 * count])
+        offset += 8 * count
+        longitudes = cls._column('d', data[offset:offset + 8 * count])
+        offset += 8 * count
+
+        learnt = dict()
+        tail = len(data) - (len(data) - offset) % cls.RECORD.size
+        for zipcode, latitude, longitude in cls.RECORD.iter_unpack(data[offset:tail]):
+            learnt[zipcode] = (latitude, longitude)
+
+        return zipcodes, latitudes, longitudes, learnt
+
+    @classmethod
+    def write_index(cls, path: str, locations) -> int:
+        """
+        Writes a sorted index file
+        :param path:
+        :param locations: iterable of (zipcode, latitude, longitude)
+        :return: number of zipcodes written
+        """
+        rows = sorted({int(zipcode): (float(lat), float(lon))
+                       for zipcode, lat, lon in locations}.items())
+
+        zipcodes = array('I', (zipcode for zipcode, _ in rows))
+        latitudes = array('d', (location[0] for _, location in rows))
+        longitudes = array('d', (location[1] for _, location in rows))
+        if sys.byteorder == 'big':
+            for column in (zipcodes, latitudes, longitudes):
+                column.byteswap()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(cls.HEADER.pack(cls.MAGIC, len(rows)))
+            zipcodes.tofile(index_file)
+            latitudes.tofile(index_file)
+            longitudes.tofile(index_file)
+        os.replace(tmp_path, path)
+
+        return len(rows)
+
+    @classmethod
+    def build(cls, csv_path: str, index_path: str) -> int:
+        """
+        Builds an index file from a CSV file with a header row, recognised column names are
+        zipcode/zip/postal_code/postcode, latitude/lat and longitude/lon/lng
+        :param csv_path:
+        :param index_path:
+        :return: number of zipcodes written
+        """
+
+        def _find(fieldnames, candidates):
+            lowered = {name.strip().lower(): name for name in fieldnames}
+            for candidate in candidates:
+                if candidate in lowered:
+                    return lowered[candidate]
+            raise ValueError('None of the columns {} found in {}'.format(candidates, csv_path))
+
+        with open(csv_path, newline='') as csv_file:
+            reader = csv.DictReader(csv_file)
+            zip_col = _find(reader.fieldnames, cls.ZIPCODE_COLUMNS)
+            lat_col = _find(reader.fieldnames, cls.LATITUDE_COLUMNS)
+            lon_col = _find(reader.fieldnames, cls.LONGITUDE_COLUMNS)
+
+            locations = list()
+            for row in reader:
+                try:
+                    zipcode = int(row[zip_col])
+                    if not cls.is_storable(zipcode):
+                        raise ValueError(zipcode)
+                    locations.append((zipcode, float(row[lat_col]), float(row[lon_col])))
+                except (TypeError, ValueError):
+                    logging.warning('Skipping invalid row %s', row)
+
+        return cls.write_index(index_path, locations)
+
+    @classmethod
+    def is_storable(cls, zipcode: int) -> bool:
+        return 0 <= zipcode <= cls.MAX_ZIPCODE
+
+    def _append(self, zipcode: int, latitude: float, longitude: float):
+        with open(self.path, 'ab') as index_file:
+            index_file.write(self.RECORD.pack(zipcode, latitude, longitude))
+
+    def lookup(self, zipcode: int):
+        """
+        Looks up a zipcode in the local index only
+        :param zipcode:
+        :return: tuple (latitude, longitude) or None
+        """
+        pos = bisect_left(self._zipcodes, zipcode)
+        if pos < len(self._zipcodes) and self._zipcodes[pos] == zipcode:
+            return self._latitudes[pos], self._longitudes[pos]
+
+        return self._learnt.get(zipcode)
+
+    def find(self, zipcode: int):
+        """
+        Looks up a zipcode in the local index and counts the hit or miss
+        :param zipcode:
+        :return: tuple (latitude, longitude) or None
+        """
+        location = self.lookup(zipcode)
+        if location is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return location
+
+    def get_latlon(self, zipcode: int) -> tuple:
+        """
+        Resolves a zipcode from the local index, falls back to the geocoder on a miss and
+        writes the result back into the index
+        :param zipcode:
+        :return: tuple (latitude, longitude)
+        """
+        location = self.find(zipcode)
+        if location is not None:
+            return location
+
+        if self.fallback is None:
+            raise ValueError(f'Invalid zipcode: {zipcode}')
+
+        latitude, longitude = self.fallback(zipcode)
+        self.learn(zipcode, latitude, longitude)
+        return latitude, longitude
+
+    def learn(self, zipcode: int, latitude: float, longitude: float):
+        """
+        Writes a location resolved by the fallback geocoder back into the index
+        :param zipcode:
+        :param latitude:
+        :param longitude:
+        :return:
+        """
+        with self._lock:
+            self.fallbacks += 1
+            if zipcode not in self._learnt:
+                self._learnt[zipcode] = (latitude, longitude)
+                if not self.is_storable(zipcode):
+                    logging.warning('Not writing zipcode %s to the index, it does not fit '
+                                    'a record', zipcode)
+                    return
+                try:
+                    self._append(zipcode, latitude, longitude)
+                except OSError as err:
+                    logging.exception(err)
+
+    def stats(self) -> dict:
+        return {
+            'zipcodes': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'fallbacks': self.fallbacks,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zipcode index tools')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser('build', help='Build an index from a CSV file')
+    build_parser.add_argument('csv_path', help='CSV file with zipcode, latitude and longitude')
+    build_parser.add_argument('index_path', help='Index file to write')
+
+    lookup_parser = subparsers.add_parser('lookup', help='Look up zipcodes in an index')
+    lookup_parser.add_argument('index_path')
+    lookup_parser.add_argument('zipcodes', nargs='+', type=int)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        count = ZipcodeGazetteer.build(args.csv_path, args.index_path)
+        print('Wrote {} zipcodes to {}'.format(count, args.index_path))
+    else:
+        gazetteer = ZipcodeGazetteer(args.index_path)
+        for zipcode in args.zipcodes:
+            print(zipcode, gazetteer.lookup(zipcode))
+
+
+if __name__ == '__main__':
+    main()
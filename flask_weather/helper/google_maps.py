@@ -1,46 +1,185 @@
 import logging
+import os
+import time
 from http import HTTPStatus
 
 import requests
 
+from flask_weather.exceptions import ServiceNotAvailable, AppErrorCodes
+from flask_weather.helper.cache_backends import create_backend
+from flask_weather.helper.http_transport import get_transport
+from flask_weather.helper import metrics
+from flask_weather.helper.single_flight import SingleFlight
+
 
 class GoogleMaps:
 
     HOST_NAME = 'maps.googleapis.com'
+    GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+    GEOCODE_URL_KEY = 'GOOGLE_MAPS_URL'
+    CACHE_TTL_KEY = 'GEOCODE_CACHE_TTL'
+    CACHE_MAX_ENTRIES_KEY = 'GEOCODE_CACHE_MAX_ENTRIES'
+    DEFAULT_CACHE_TTL = 86400.0
+    DEFAULT_CACHE_MAX_ENTRIES = 10000
+    # Geocode statuses that answer the request, any other is a failure of the call
+    # (OVER_QUERY_LIMIT, REQUEST_DENIED, UNKNOWN_ERROR, ...) and is not cached
+    DEFINITIVE_STATUSES = ('OK', 'ZERO_RESULTS')
     HEADERS = {
         'Content-Type': 'application/json',
         'Cache-Control': 'no-cache'
     }
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, transport=None, geocode_url: str = None, cache=None):
+        """
+        :param api_key:
+        :param transport: HttpTransport object, defaults to the shared one
+        :param geocode_url:
+        :param cache: CacheBackend object of geocode results, defaults to CACHE_BACKEND
+        """
         self.api_key = api_key
+        self.geocode_url = geocode_url or os.environ.get(self.GEOCODE_URL_KEY, self.GEOCODE_URL)
+        self.http = transport or get_transport()
+        self.single_flight = SingleFlight()
+        self.cache_ttl = float(os.environ.get(self.CACHE_TTL_KEY, self.DEFAULT_CACHE_TTL))
+        self.cache = cache or create_backend(
+            'geocode', int(os.environ.get(self.CACHE_MAX_ENTRIES_KEY,
+                                          self.DEFAULT_CACHE_MAX_ENTRIES)))
+
+    def cached(self, key: tuple) -> tuple:
+        """
+        Looks up a geocode result
+        :param key: tuple
+        :return: tuple (True if found, result)
+        """
+        if self.cache_ttl <= 0:
+            return False, None
+        entry = self.cache.get(key)
+        if entry is None or entry[0] <= time.time():
+            return False, None
+        return True, entry[1]
+
+    def remember(self, key: tuple, result):
+        """
+        Caches a definitive geocode result, None for a zipcode that was not found
+        :param key: tuple
+        :param result: bool, tuple (latitude, longitude) or None
+        :return:
+        """
+        if self.cache_ttl > 0:
+            self.cache.set(key, (time.time() + self.cache_ttl, result, None))
+
+    def _geocode(self, params: dict):
+        """
+        Calls the geocode API over the shared, pooled transport
+        :param params:
+        :return: requests.Response object
+        """
+        try:
+            return self.http.post(self.geocode_url, params=params, idempotent=True)
+        except requests.RequestException as err:
+            logging.exception(err)
+            raise ServiceNotAvailable(AppErrorCodes.GOOGLE_MAPS_ERROR,
+                                      'Google maps request failed') from err
 
     def validate_location(self, latitude: float, longitude: float):
+        """
+        Checks with the geocode API that the location is valid,
+        concurrent checks of the same location share one call
+        :param latitude:
+        :param longitude:
+        :return: True if valid
+        """
+        key = ('latlng', latitude, longitude)
+        with metrics.timed_call(metrics.GOOGLE_MAPS_SECONDS, 'validate_location', 'google_maps'):
+            found, valid = self.cached(key)
+            if not found:
+                valid = self.single_flight.do(
+                    key, lambda: self._validate_location(latitude, longitude))
+                self.remember(key, valid)
+            return valid
 
-        params = {
+    def validate_params(self, latitude: float, longitude: float) -> dict:
+        return {
             'latlng': '{},{}'.format(latitude, longitude),
             'key': self.api_key
         }
 
-        response = requests.post('https://maps.googleapis.com/maps/api/geocode/json', params=params)
-        if response.status_code == HTTPStatus.OK and response.json()['status'] == 'OK':
-            return True
+    @classmethod
+    def check_answered(cls, status_code: int, data):
+        """
+        Raises ServiceNotAvailable unless the geocode API answered the request, so that
+        failures are not cached as invalid locations or zipcodes
+        :param status_code: HTTP status of the response
+        :param data: json data of the response, None if the status is not OK
+        :return:
+        """
+        if status_code != HTTPStatus.OK or data.get('status') not in cls.DEFINITIVE_STATUSES:
+            logging.warning('Google maps returned HTTP %s, status %s', status_code,
+                            data.get('status') if data else None)
+            raise ServiceNotAvailable(AppErrorCodes.GOOGLE_MAPS_ERROR,
+                                      'Google maps request failed')
 
-        return False
+    @classmethod
+    def is_valid_location(cls, status_code: int, data) -> bool:
+        """
+        Interprets a geocode response for a location
+        :param status_code: HTTP status of the response
+        :param data: json data of the response, None if the status is not OK
+        :return: True if valid
+        """
+        cls.check_answered(status_code, data)
+        return data['status'] == 'OK'
+
+    def _validate_location(self, latitude: float, longitude: float):
+        response = self._geocode(self.validate_params(latitude, longitude))
+        data = response.json() if response.status_code == HTTPStatus.OK else None
+        return self.is_valid_location(response.status_code, data)
 
     def get_latlon(self, zipcode: int) -> tuple:
+        """
+        Gets the latitude and longitude of a zipcode from the geocode API,
+        concurrent lookups of the same zipcode share one call
+        :param zipcode:
+        :return: tuple (latitude, longitude)
+        """
+        key = ('address', zipcode)
+        with metrics.timed_call(metrics.GOOGLE_MAPS_SECONDS, 'get_latlon', 'google_maps'):
+            found, location = self.cached(key)
+            if not found:
+                try:
+                    location = self.single_flight.do(key, lambda: self._get_latlon(zipcode))
+                except ValueError:
+                    location = None
+                self.remember(key, location)
+
+        if location is None:
+            raise ValueError(f'Invalid zipcode: {zipcode}')
+        return location
 
-        params = {
-            'address': zipcode,
+    def latlon_params(self, zipcode: int) -> dict:
+        return {
+            'address': str(zipcode),
             'key': self.api_key
         }
 
-        response = requests.post('https://maps.googleapis.com/maps/api/geocode/json', params=params)
-        if response.status_code == HTTPStatus.OK.value:
-            data = response.json()
-            logging.info(data)
-            if data['results']:
-                location = data["results"][0]["geometry"]["location"]
-                return location["lat"], location["lng"]
+    @classmethod
+    def parse_latlon(cls, zipcode: int, status_code: int, data) -> tuple:
+        """
+        Interprets a geocode response for a zipcode
+        :param zipcode:
+        :param status_code: HTTP status of the response
+        :param data: json data of the response, None if the status is not OK
+        :return: tuple (latitude, longitude)
+        """
+        cls.check_answered(status_code, data)
+        logging.info(data)
+        if data['status'] == 'OK' and data['results']:
+            location = data["results"][0]["geometry"]["location"]
+            return location["lat"], location["lng"]
 
         raise ValueError(f'Invalid zipcode: {zipcode}')
+
+    def _get_latlon(self, zipcode: int) -> tuple:
+        response = self._geocode(self.latlon_params(zipcode))
+        data = response.json() if response.status_code == HTTPStatus.OK.value else None
+        return self.parse_latlon(zipcode, response.status_code, data)
@@ -0,0 +1,169 @@
+import logging
+import os
+import random
+import threading
+import time
+from http import HTTPStatus
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpTransport:
+    """
+    Shared HTTP client used by the weather services and google maps.
+
+    A single requests.Session keeps a keep-alive connection pool per host, so
+    consecutive calls to the same provider reuse the TCP (and TLS) connection.
+    Every call has connect/read timeouts and idempotent calls are retried with
+    exponential backoff on connection errors and gateway errors.
+    """
+    POOL_CONNECTIONS_KEY = 'HTTP_POOL_CONNECTIONS'
+    POOL_MAXSIZE_KEY = 'HTTP_POOL_MAXSIZE'
+    CONNECT_TIMEOUT_KEY = 'HTTP_CONNECT_TIMEOUT'
+    READ_TIMEOUT_KEY = 'HTTP_READ_TIMEOUT'
+    MAX_RETRIES_KEY = 'HTTP_MAX_RETRIES'
+    BACKOFF_FACTOR_KEY = 'HTTP_BACKOFF_FACTOR'
+
+    DEFAULT_POOL_CONNECTIONS = 10
+    DEFAULT_POOL_MAXSIZE = 32
+    DEFAULT_CONNECT_TIMEOUT = 1.0
+    DEFAULT_READ_TIMEOUT = 3.0
+    DEFAULT_MAX_RETRIES = 2
+    DEFAULT_BACKOFF_FACTOR = 0.05
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+    RETRY_STATUSES = frozenset([HTTPStatus.BAD_GATEWAY.value,
+                                HTTPStatus.SERVICE_UNAVAILABLE.value,
+                                HTTPStatus.GATEWAY_TIMEOUT.value])
+
+    def __init__(self, pool_connections: int = None, pool_maxsize: int = None,
+                 connect_timeout: float = None, read_timeout: float = None,
+                 max_retries: int = None, backoff_factor: float = None):
+
+        def _setting(value, key, default, cast):
+            return value if value is not None else cast(os.environ.get(key, default))
+
+        self.pool_connections = _setting(pool_connections, self.POOL_CONNECTIONS_KEY,
+                                         self.DEFAULT_POOL_CONNECTIONS, int)
+        self.pool_maxsize = _setting(pool_maxsize, self.POOL_MAXSIZE_KEY,
+                                     self.DEFAULT_POOL_MAXSIZE, int)
+        self.timeout = (_setting(connect_timeout, self.CONNECT_TIMEOUT_KEY,
+                                 self.DEFAULT_CONNECT_TIMEOUT, float),
+                        _setting(read_timeout, self.READ_TIMEOUT_KEY,
+                                 self.DEFAULT_READ_TIMEOUT, float))
+        self.max_retries = _setting(max_retries, self.MAX_RETRIES_KEY,
+                                    self.DEFAULT_MAX_RETRIES, int)
+        self.backoff_factor = _setting(backoff_factor, self.BACKOFF_FACTOR_KEY,
+                                       self.DEFAULT_BACKOFF_FACTOR, float)
+
+        # Retries are done by `request` so that POSTs can opt in per call
+        self.adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                   pool_maxsize=self.pool_maxsize,
+                                   max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self._lock = threading.Lock()
+        self._retries = 0
+
+    def _backoff(self, attempt: int):
+        """
+        Sleeps before the next attempt, exponential backoff with full jitter
+        :param attempt: zero based attempt number that just failed
+        :return:
+        """
+        with self._lock:
+            self._retries += 1
+        time.sleep(random.uniform(0, self.backoff_factor * (2 ** attempt)))
+
+    def request(self, method: str, url: str, idempotent: bool = None, **kwargs):
+        """
+        Sends a request over the pooled session
+        :param method: HTTP method
+        :param url:
+        :param idempotent: retry the call on failure, defaults to True for idempotent methods
+        :param kwargs: passed on to requests.Session.request
+        :return: requests.Response object
+        """
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            last_attempt = attempt + 1 == attempts
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if last_attempt:
+                    raise
+                logging.warning('%s %s failed, retrying: %s', method, url, err)
+                self._backoff(attempt)
+                continue
+
+            if response.status_code in self.RETRY_STATUSES and not last_attempt:
+                logging.warning('%s %s returned %d, retrying', method, url,
+                                response.status_code)
+                response.close()
+                self._backoff(attempt)
+                continue
+
+            return response
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, idempotent: bool = False, **kwargs):
+        return self.request('POST', url, idempotent=idempotent, **kwargs)
+
+    def pool_stats(self) -> dict:
+        """
+        Connection reuse statistics for every host pool currently held by the session
+        :return: dict with per host and total counts of connections opened and reused
+        """
+        pools = self.adapter.poolmanager.pools
+        hosts = dict()
+
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+
+            host = '{}://{}:{}'.format(key.key_scheme, pool.host, pool.port)
+            hosts[host] = {
+                'requests': pool.num_requests,
+                'connections_opened': pool.num_connections,
+                'connections_reused': max(pool.num_requests - pool.num_connections, 0),
+            }
+
+        return {
+            'hosts': hosts,
+            'connections_opened': sum(host['connections_opened'] for host in hosts.values()),
+            'connections_reused': sum(host['connections_reused'] for host in hosts.values()),
+            'retries': self._retries,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HttpTransport:
+    """
+    Returns the process wide HttpTransport, creating it on first use
+    :return: HttpTransport object
+    """
+    global _transport
+
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = HttpTransport()
+
+    return _transport
@@ -0,0 +1,244 @@
+"""
+Offline location validation against a land mask.
+
+The mask is a bit grid covering the globe, one bit per cell of `resolution`
+degrees, set when any part of the cell is on land, so that locations on the
+coast and on islands smaller than a cell are valid. Validating a location is
+a bounds check and a bit test, no network is needed.
+
+Build a mask from GeoJSON land polygons (for example Natural Earth's
+ne_10m_land.geojson) with:
+    python3 -m flask_weather.helper.land_mask build land.geojson land_mask.bin --resolution 0.1
+"""
+import argparse
+import json
+import logging
+import math
+import struct
+import threading
+
+
+class LandMaskValidator:
+    """
+    Validates locations against a land mask file. Optionally asks a fallback validator
+    (google maps) about cells the mask marks as water, and remembers its answer per cell.
+    """
+    PATH_KEY = 'LAND_MASK_PATH'
+    FALLBACK_KEY = 'LAND_MASK_FALLBACK'
+
+    MAGIC = b'LANDMSK1'
+    HEADER = struct.Struct('<8sdII')
+
+    def __init__(self, path: str, fallback=None):
+        """
+        :param path: land mask file
+        :param fallback: optional object with validate_location(latitude, longitude)
+        """
+        self.path = path
+        self.fallback = fallback
+        self.resolution, self.rows, self.cols, self._bits = self._load(path)
+        self._fallback_cells = dict()
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.fallbacks = 0
+        logging.info('Loaded %dx%d land mask from %s', self.rows, self.cols, path)
+
+    @classmethod
+    def _load(cls, path: str) -> tuple:
+        with open(path, 'rb') as mask_file:
+            data = mask_file.read()
+
+        magic, resolution, rows, cols = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError('{} is not a land mask'.format(path))
+
+        bits = bytes(data[cls.HEADER.size:])
+        if len(bits) * 8 < rows * cols:
+            raise ValueError('{} is truncated'.format(path))
+
+        return resolution, rows, cols, bits
+
+    def cell(self, latitude: float, longitude: float) -> int:
+        """
+        Index of the grid cell containing the location
+        :param latitude:
+        :param longitude:
+        :return: cell index
+        """
+        row = min(int((latitude + 90) / self.resolution), self.rows - 1)
+        col = min(int((longitude + 180) / self.resolution), self.cols - 1)
+        return row * self.cols + col
+
+    def is_land(self, latitude: float, longitude: float) -> bool:
+        cell = self.cell(latitude, longitude)
+        return bool(self._bits[cell >> 3] & (1 << (cell & 7)))
+
+    def validate_location(self, latitude: float, longitude: float) -> bool:
+        """
+        Checks that the location is within bounds and on land
+        :param latitude:
+        :param longitude:
+        :return: True if valid
+        """
+        if latitude is None or longitude is None or \
+                not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            return False
+
+        self.checks += 1
+        if self.is_land(latitude, longitude):
+            return True
+
+        if self.fallback is None:
+            return False
+
+        cell = self.cell(latitude, longitude)
+        valid = self._fallback_cells.get(cell)
+        if valid is None:
+            valid = self.fallback.validate_location(latitude, longitude)
+            self.fallbacks += 1
+            with self._lock:
+                self._fallback_cells[cell] = valid
+
+        return valid
+
+    def stats(self) -> dict:
+        return {
+            'resolution': self.resolution,
+            'checks': self.checks,
+            'fallbacks': self.fallbacks,
+            'fallback_cells': len(self._fallback_cells),
+        }
+
+    @classmethod
+    def write_mask(cls, path: str, resolution: float, bits: bytearray, rows: int, cols: int):
+        with open(path, 'wb') as mask_file:
+            mask_file.write(cls.HEADER.pack(cls.MAGIC, resolution, rows, cols))
+            mask_file.write(bits)
+
+    @staticmethod
+    def _edge_cells(start: list, end: list, resolution: float):
+        """
+        Cells crossed by an edge of a polygon, walked from cell to cell along the edge
+        :param start: point (longitude, latitude, ...)
+        :param end: point (longitude, latitude, ...)
+        :param resolution: cell size in degrees
+        :return: iterator of tuples (row, col)
+        """
+        x, y = (start[0] + 180) / resolution, (start[1] + 90) / resolution
+        dx, dy = (end[0] + 180) / resolution - x, (end[1] + 90) / resolution - y
+        col, row = math.floor(x), math.floor(y)
+        end_col, end_row = math.floor(x + dx), math.floor(y + dy)
+        step_col, step_row = (1 if dx > 0 else -1), (1 if dy > 0 else -1)
+        # Fraction of the edge walked at the next column and row boundary, and per cell
+        next_x = (col + (dx > 0) - x) / dx if dx else math.inf
+        next_y = (row + (dy > 0) - y) / dy if dy else math.inf
+        delta_x = abs(1 / dx) if dx else math.inf
+        delta_y = abs(1 / dy) if dy else math.inf
+
+        yield row, col
+        for _ in range(abs(end_col - col) + abs(end_row - row)):
+            if next_x < next_y:
+                col += step_col
+                next_x += delta_x
+            else:
+                row += step_row
+                next_y += delta_y
+            yield row, col
+
+    @classmethod
+    def build(cls, geojson_path: str, mask_path: str, resolution: float) -> int:
+        """
+        Rasterizes GeoJSON land polygons into a mask file. A cell overlapping a polygon
+        either contains part of its boundary, or has its centre inside it: every cell an
+        edge crosses is land, and so is every cell whose centre a scanline fill of the
+        row finds inside (even-odd rule, so the inside of holes in polygons is water)
+        :param geojson_path:
+        :param mask_path:
+        :param resolution: cell size in degrees
+        :return: number of land cells
+        """
+        rows = int(math.ceil(180 / resolution))
+        cols = int(math.ceil(360 / resolution))
+        bits = bytearray((rows * cols + 7) // 8)
+        land_cells = 0
+
+        def set_land(row: int, col: int):
+            nonlocal land_cells
+            cell = min(max(row, 0), rows - 1) * cols + min(max(col, 0), cols - 1)
+            if not bits[cell >> 3] & (1 << (cell & 7)):
+                bits[cell >> 3] |= 1 << (cell & 7)
+                land_cells += 1
+
+        with open(geojson_path) as geojson_file:
+            data = json.load(geojson_file)
+
+        features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+        polygons = list()
+        for feature in features:
+            geometry = feature.get('geometry', feature)
+            if geometry['type'] == 'Polygon':
+                polygons.append(geometry['coordinates'])
+            elif geometry['type'] == 'MultiPolygon':
+                polygons.extend(geometry['coordinates'])
+
+        for polygon in polygons:
+            edges = list()
+            for ring in polygon:
+                edges.extend(zip(ring, ring[1:] + ring[:1]))
+
+            for start, end in edges:
+                for row, col in cls._edge_cells(start, end, resolution):
+                    set_land(row, col)
+
+            min_lat = min(point[1] for point in polygon[0])
+            max_lat = max(point[1] for point in polygon[0])
+            first_row = max(int((min_lat + 90) / resolution), 0)
+            last_row = min(int((max_lat + 90) / resolution), rows - 1)
+
+            for row in range(first_row, last_row + 1):
+                latitude = -90 + (row + 0.5) * resolution
+                crossings = sorted(
+                    lon1 + (latitude - lat1) * (lon2 - lon1) / (lat2 - lat1)
+                    for (lon1, lat1, *_), (lon2, lat2, *_) in edges
+                    if (lat1 <= latitude) != (lat2 <= latitude))
+
+                for start, end in zip(crossings[::2], crossings[1::2]):
+                    first_col = max(int(math.ceil((start + 180) / resolution - 0.5)), 0)
+                    last_col = min(int(math.floor((end + 180) / resolution - 0.5)), cols - 1)
+                    for col in range(first_col, last_col + 1):
+                        set_land(row, col)
+
+        cls.write_mask(mask_path, resolution, bits, rows, cols)
+        return land_cells
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Land mask tools')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser('build', help='Build a mask from GeoJSON land polygons')
+    build_parser.add_argument('geojson_path')
+    build_parser.add_argument('mask_path')
+    build_parser.add_argument('--resolution', type=float, default=0.1,
+                              help='cell size in degrees')
+
+    check_parser = subparsers.add_parser('check', help='Validate locations against a mask')
+    check_parser.add_argument('mask_path')
+    check_parser.add_argument('locations', nargs='+', help='latitude,longitude')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        land_cells = LandMaskValidator.build(args.geojson_path, args.mask_path, args.resolution)
+        print('Wrote {} land cells to {}'.format(land_cells, args.mask_path))
+    else:
+        validator = LandMaskValidator(args.mask_path)
+        for location in args.locations:
+            latitude, longitude = (float(value) for value in location.split(','))
+            print(location, validator.validate_location(latitude, longitude))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Latency histograms and counters exported in the Prometheus text format.
+
+Metrics are kept in process. Recording takes a short per-metric lock to bump
+a few integers, no lock is ever held while calling a service. Timed blocks are
+also recorded as spans of the request's trace, when it is traced.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask_weather.helper import tracing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter with labels
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for labelvalues, value in sorted(values):
+            yield self.name, _labels(self.labelnames, labelvalues), value
+
+
+class Histogram:
+    """
+    Histogram with cumulative buckets and labels
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """
+        Observes the seconds spent in the with block, recorded as a span named after the
+        label values in a traced request
+        :param labelvalues:
+        :return:
+        """
+        trace = tracing.current()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.observe(end - start, *labelvalues)
+            if trace is not None:
+                trace.record(':'.join(labelvalues), start, end)
+
+    def samples(self):
+        with self._lock:
+            series = [(labelvalues, list(counts), total, count)
+                      for labelvalues, (counts, total, count) in self._series.items()]
+
+        for labelvalues, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket',
+                       _labels(self.labelnames, labelvalues, 'le="{}"'.format(_number(bound))),
+                       cumulative)
+            yield self.name + '_sum', _labels(self.labelnames, labelvalues), total
+            yield self.name + '_count', _labels(self.labelnames, labelvalues), count
+
+
+class Registry:
+    """
+    Collection of the metrics exported on /metrics
+    """
+
+    def __init__(self):
+        self._metrics = list()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        :return: str
+        """
+        lines = list()
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.TYPE))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'sure_weather_request_seconds',
+    'Time spent handling a request, by handler and stage',
+    ('handler', 'stage')))
+
+PROVIDER_SECONDS = REGISTRY.register(Histogram(
+    'sure_weather_provider_request_seconds',
+    'Time spent calling a weather service, by service and outcome',
+    ('service', 'outcome')))
+
+GOOGLE_MAPS_SECONDS = REGISTRY.register(Histogram(
+    'sure_weather_google_maps_seconds',
+    'Time spent in Google Maps lookups, by call and outcome',
+    ('call', 'outcome')))
+
+ERRORS = REGISTRY.register(Counter(
+    'sure_weather_errors_total',
+    'Errors by application error code and where they were raised',
+    ('code', 'source')))
+
+ADMISSIONS = REGISTRY.register(Counter(
+    'sure_weather_provider_admissions_total',
+    'Weather service calls that queued for admission, were rejected or were throttled by the '
+    'service, by service and outcome',
+    ('service', 'outcome')))
+
+HEDGES = REGISTRY.register(Counter(
+    'sure_weather_provider_hedges_total',
+    'Hedged weather service calls by service and event: fired, won or denied by the budget',
+    ('service', 'event')))
+
+INTERPOLATIONS = REGISTRY.register(Counter(
+    'sure_weather_interpolations_total',
+    'Locations asked to be interpolated from nearby readings, by outcome: interpolated or '
+    'fallback to a live lookup',
+    ('outcome',)))
+
+CONDITIONAL_REQUESTS = REGISTRY.register(Counter(
+    'sure_weather_conditional_requests_total',
+    'Conditional /current_weather requests by outcome: not_modified from the cached readings, '
+    'revalidated to 304 after a lookup, or modified',
+    ('outcome',)))
+
+SUBSCRIPTION_POLLS = REGISTRY.register(Counter(
+    'sure_weather_subscription_polls_total',
+    'Polls of subscribed locations, by outcome: changed and sent, unchanged or error',
+    ('outcome',)))
+
+
+@contextmanager
+def timed_call(histogram: Histogram, name: str, source: str = None):
+    """
+    Observes the duration of a call with an ok or error outcome, and counts
+    the SureWeatherExceptions it raises. In a traced request the call is recorded
+    as a span named after the source and the name
+    :param histogram: Histogram labelled by name and outcome
+    :param name: first label value
+    :param source: source label of the error counter, defaults to name
+    :return:
+    """
+    trace = tracing.current()
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    except Exception as err:
+        error_code = getattr(err, 'error_code', None)
+        if error_code is not None:
+            ERRORS.inc(error_code.name, source or name)
+        raise
+    finally:
+        end = time.perf_counter()
+        histogram.observe(end - start, name, outcome)
+        if trace is not None:
+            trace.record('{}:{}'.format(source, name) if source else name, start, end)
@@ -0,0 +1,203 @@
+"""
+Sampling profiler started on demand from /debug/profile.
+
+While a capture runs, a background thread samples the stacks of every thread
+of the process each PROFILER_INTERVAL seconds, until the capture has lasted
+its seconds or seen its number of requests. The stacks are counted in the
+collapsed format, one `root;caller;callee count` line per distinct stack,
+which flamegraph.pl, speedscope and similar tools read as they are.
+
+Threads waiting for work, such as idle pool workers or a server waiting on
+its sockets, are left out. When no capture runs the profiler costs nothing.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask_weather.exceptions import InputValidationException, AppErrorCodes
+
+# Threads whose innermost frame is in one of these modules, and which run no code of the
+# application, are waiting for work
+IDLE_MODULES = ('threading', 'queue')
+# An event loop waiting in select is idle, whichever code started it
+POLL_MODULE = 'selectors'
+# Threads of the application that wait between rounds of background work
+BACKGROUND_THREADS = ('refresher', 'subscriptions')
+APP_PACKAGE = 'flask_weather'
+
+
+def parse_capture(query_params: dict) -> dict:
+    """
+    Parses the seconds, requests and interval of a capture started from /debug/profile
+    :param query_params:
+    :return: dict of SamplingProfiler.start() keyword arguments
+    """
+    errors = []
+    capture = dict()
+    for key, kind in (('seconds', float), ('requests', int), ('interval', float)):
+        if key not in query_params:
+            continue
+        try:
+            capture[key] = kind(query_params[key])
+        except ValueError:
+            capture[key] = None
+        if capture[key] is None or capture[key] <= 0:
+            errors.append('Invalid {} {}, must be a positive number'.format(
+                key, query_params[key]))
+
+    if errors:
+        raise InputValidationException(AppErrorCodes.INVALID_INPUT, errors)
+    return capture
+
+
+class SamplingProfiler:
+    INTERVAL_KEY = 'PROFILER_INTERVAL'
+    MAX_SECONDS_KEY = 'PROFILER_MAX_SECONDS'
+
+    DEFAULT_INTERVAL = 0.005
+    DEFAULT_SECONDS = 10.0
+    DEFAULT_MAX_SECONDS = 300.0
+
+    def __init__(self, interval: float = None, max_seconds: float = None):
+        """
+        :param interval: default seconds between two samples
+        :param max_seconds: longest capture allowed
+        """
+        self.interval = interval or float(os.environ.get(self.INTERVAL_KEY,
+                                                         self.DEFAULT_INTERVAL))
+        self.max_seconds = max_seconds or float(os.environ.get(self.MAX_SECONDS_KEY,
+                                                               self.DEFAULT_MAX_SECONDS))
+        self.running = False
+        self._stacks = Counter()
+        self._labels = dict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._capture = dict()
+
+    def start(self, seconds: float = None, requests: int = None, interval: float = None) -> bool:
+        """
+        Starts a capture, dropping the stacks of the previous one
+        :param seconds: length of the capture, at most max_seconds
+        :param requests: stop once this many requests have finished, if before seconds
+        :param interval: seconds between two samples
+        :return: False if a capture is already running
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+            self._stacks = Counter()
+            self._stopped.clear()
+            self._capture = {
+                'seconds': min(seconds or self.DEFAULT_SECONDS, self.max_seconds),
+                'requests': requests,
+                'requests_left': requests,
+                'interval': interval or self.interval,
+                'samples': 0,
+                'started': time.time(),
+                'elapsed': 0.0,
+            }
+
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        logging.warning('Profiling for %.1f seconds or %s requests', self._capture['seconds'],
+                        requests or 'any number of')
+        return True
+
+    def stop(self):
+        """
+        Stops the running capture, its stacks are kept
+        :return:
+        """
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def request_finished(self):
+        """
+        Counts a request finished during the capture
+        :return:
+        """
+        with self._lock:
+            left = self._capture.get('requests_left')
+            if left is None:
+                return
+            self._capture['requests_left'] = left - 1
+        if left <= 1:
+            self._stopped.set()
+
+    def _run(self):
+        capture = self._capture
+        own = threading.get_ident()
+        started = time.perf_counter()
+        deadline = started + capture['seconds']
+        try:
+            while not self._stopped.wait(capture['interval']) and \
+                    time.perf_counter() < deadline:
+                self._sample(own)
+                capture['samples'] += 1
+        finally:
+            capture['elapsed'] = time.perf_counter() - started
+            with self._lock:
+                self.running = False
+            logging.warning('Profiled %d samples in %.1f seconds', capture['samples'],
+                            capture['elapsed'])
+
+    def _label(self, code) -> tuple:
+        """
+        :return: tuple (frame label, module name, True if the code is in the application)
+        """
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            label = self._labels[code] = ('{}:{}'.format(module, code.co_name), module,
+                                          APP_PACKAGE in code.co_filename)
+        return label
+
+    def _sample(self, own: int):
+        stacks = list()
+        background = {thread.ident for thread in threading.enumerate()
+                      if thread.name in BACKGROUND_THREADS}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own:
+                continue
+
+            module = self._label(frame.f_code)[1]
+            if module == POLL_MODULE:
+                continue
+
+            names = list()
+            in_app = False
+            while frame is not None:
+                name, _, app_code = self._label(frame.f_code)
+                names.append(name)
+                in_app = in_app or app_code
+                frame = frame.f_back
+            if module in IDLE_MODULES and (not in_app or ident in background):
+                continue
+            stacks.append(';'.join(reversed(names)))
+
+        with self._lock:
+            self._stacks.update(stacks)
+
+    def collapsed(self) -> str:
+        """
+        Stacks of the running or last capture
+        :return: one `frame;frame;frame count` line per stack, the most sampled first
+        """
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks)
+
+    def stats(self) -> dict:
+        with self._lock:
+            capture = dict(self._capture)
+            stacks = len(self._stacks)
+        capture.pop('requests_left', None)
+        capture.update(running=self.running, stacks=stacks)
+        return capture
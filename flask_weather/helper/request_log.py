@@ -0,0 +1,80 @@
+"""
+Sampled, structured request logging.
+
+Requests are logged as one JSON object per line on the `sure_weather.requests`
+logger. Successful requests are logged at REQUEST_LOG_SAMPLE_RATE and failed
+ones at REQUEST_LOG_ERROR_SAMPLE_RATE, so a request that is not sampled costs
+one random number and nothing is formatted for it.
+"""
+import json
+import logging
+import os
+import random
+import time
+
+from flask_weather.helper import tracing
+
+
+class RequestLog:
+    SAMPLE_RATE_KEY = 'REQUEST_LOG_SAMPLE_RATE'
+    ERROR_SAMPLE_RATE_KEY = 'REQUEST_LOG_ERROR_SAMPLE_RATE'
+
+    DEFAULT_SAMPLE_RATE = 0.01
+    DEFAULT_ERROR_SAMPLE_RATE = 1.0
+
+    LOGGER_NAME = 'sure_weather.requests'
+
+    def __init__(self, sample_rate: float = None, error_sample_rate: float = None):
+        self.sample_rate = sample_rate if sample_rate is not None else \
+            float(os.environ.get(self.SAMPLE_RATE_KEY, self.DEFAULT_SAMPLE_RATE))
+        self.error_sample_rate = error_sample_rate if error_sample_rate is not None else \
+            float(os.environ.get(self.ERROR_SAMPLE_RATE_KEY, self.DEFAULT_ERROR_SAMPLE_RATE))
+        self.logger = logging.getLogger(self.LOGGER_NAME)
+        self._random = random.random
+
+    def sampled(self, error: bool = False) -> bool:
+        """
+        :param error: True if the request failed
+        :return: True if the request is to be logged
+        """
+        rate = self.error_sample_rate if error else self.sample_rate
+        if rate <= 0 or rate < 1 and self._random() >= rate:
+            return False
+        return self.logger.isEnabledFor(logging.WARNING if error else logging.INFO)
+
+    def log(self, route: str, query_params, status: int, started: float, error=None,
+            responded: list = None):
+        """
+        Logs the request if it is sampled
+        :param route: route name, as in the metrics
+        :param query_params: query parameters of the request
+        :param status: HTTP status of the response
+        :param started: time.monotonic() when the request started
+        :param error: SureWeatherException the request failed with
+        :param responded: services that responded
+        :return:
+        """
+        if not self.sampled(error is not None):
+            return
+
+        with tracing.span('request_log'):
+            self._write(route, query_params, status, started, error, responded)
+
+    def _write(self, route: str, query_params, status: int, started: float, error,
+               responded: list):
+        record = {
+            'route': route,
+            'params': dict(query_params.items()),
+            'status': status,
+            'duration_ms': round((time.monotonic() - started) * 1000, 2),
+        }
+        if responded is not None:
+            record['services_responded'] = responded
+        trace = tracing.current()
+        if trace is not None:
+            record['trace_id'] = trace.trace_id
+        if error is not None:
+            record['error'] = error.to_dict()
+            self.logger.warning(json.dumps(record))
+        else:
+            self.logger.info(json.dumps(record))
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+
+
+class _Call:
+    """
+    An in-flight call that other callers can wait on
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key.
+
+    The first caller for a key runs the function, callers that arrive while
+    it is running wait for it and receive the same result or exception.
+    """
+
+    def __init__(self):
+        self._calls = dict()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Runs `func` once for all concurrent callers of `key`
+        :param key: hashable key identifying the call
+        :param func: callable without arguments
+        :return: the return value of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        """
+        Number of upstream calls made and the number of callers that shared one
+        :return: dict
+        """
+        with self._lock:
+            in_flight = len(self._calls)
+
+        return {
+            'calls': self.calls,
+            'shared': self.shared,
+            'in_flight': in_flight,
+        }
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines running on one event loop
+    """
+
+    def __init__(self):
+        self._calls = dict()
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, coro_func):
+        """
+        Awaits `coro_func()` once for all concurrent callers of `key`
+        :param key: hashable key identifying the call
+        :param coro_func: coroutine function without arguments
+        :return: the result of the coroutine
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(coro_func())
+        self._calls[key] = future
+        self.calls += 1
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(future)
+
+    def _finish(self, key, future):
+        self._calls.pop(key, None)
+        # Retrieve the exception so it is not reported as never retrieved when
+        # every caller was cancelled before the call finished
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'shared': self.shared,
+            'in_flight': len(self._calls),
+        }
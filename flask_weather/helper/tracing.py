@@ -0,0 +1,243 @@
+"""
+Per-request traces: a trace id and the timing of the stages of each request.
+
+With TRACING_ENABLED=1 every request gets a trace. The stages observed by the
+request histograms, the weather service and google maps calls, the decoding of
+the weather reports and the encoding of the response are recorded as spans of
+the trace, whether they run in the request's thread, on the fanout, hedging and
+batch pools or in the asyncio tasks of the request. The trace id is taken from
+the X-Trace-Id header of the request when it has one, is sent to the weather
+services in the same header and is returned with the response.
+
+Requests slower than TRACE_SLOW_SECONDS are logged with their spans, as one
+JSON object per line on the `sure_weather.slow_requests` logger, and the last
+TRACE_SLOW_KEEP of them are served on /debug/slow_requests. Outside a trace,
+recording a span costs one context variable lookup.
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+TRACE_HEADER = 'X-Trace-Id'
+DEBUG_TOKEN_HEADER = 'X-Debug-Token'
+DEBUG_TOKEN_KEY = 'DEBUG_TOKEN'
+
+# Trace ids longer than this, or not printable, are replaced by a new one
+MAX_TRACE_ID_LENGTH = 64
+
+_current = contextvars.ContextVar('sure_weather_trace', default=None)
+
+
+class Trace:
+    """
+    Spans of one request, as tuples (name, start, end, thread name) of perf_counter() times
+    """
+    __slots__ = ('trace_id', 'route', 'started', 'spans')
+
+    def __init__(self, trace_id: str, route: str):
+        self.trace_id = trace_id
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans = list()
+
+    def record(self, name: str, start: float, end: float):
+        self.spans.append((name, start, end, threading.current_thread().name))
+
+    def breakdown(self) -> list:
+        """
+        :return: list of the spans in the order they started, times in milliseconds since
+                 the start of the request
+        """
+        return [{'name': name,
+                 'start_ms': round((start - self.started) * 1000, 2),
+                 'duration_ms': round((end - start) * 1000, 2),
+                 'thread': thread}
+                for name, start, end, thread in sorted(self.spans, key=lambda span: span[1])]
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def current():
+    """
+    :return: Trace of the request being handled, None outside a trace
+    """
+    return _current.get()
+
+
+def span(name: str):
+    """
+    Records the with block as a span of the current trace, if any
+    :param name: span name
+    :return: context manager
+    """
+    trace = _current.get()
+    return _NO_SPAN if trace is None else _Span(trace, name)
+
+
+def propagate(func):
+    """
+    Binds func to the current trace, for running it on another thread
+    :param func: callable submitted to an executor
+    :return: func, run in a copy of the current context when there is a trace
+    """
+    if _current.get() is None:
+        return func
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def inject(kwargs: dict) -> dict:
+    """
+    Adds the trace id header to the keyword arguments of an outgoing request
+    :param kwargs: keyword arguments of the request, with optional headers
+    :return: kwargs
+    """
+    trace = _current.get()
+    if trace is not None:
+        headers = dict(kwargs.get('headers') or {})
+        headers[TRACE_HEADER] = trace.trace_id
+        kwargs['headers'] = headers
+    return kwargs
+
+
+def authorized(token: str) -> bool:
+    """
+    :param token: X-Debug-Token header of a request to a /debug route
+    :return: True if DEBUG_TOKEN is not set or the token matches it
+    """
+    expected = os.environ.get(DEBUG_TOKEN_KEY)
+    return not expected or token == expected
+
+
+class Tracer:
+    """
+    Starts and ends the trace of each request, logs the slow ones and tells the profiler
+    how many requests it has seen
+    """
+    ENABLED_KEY = 'TRACING_ENABLED'
+    SLOW_SECONDS_KEY = 'TRACE_SLOW_SECONDS'
+    SLOW_KEEP_KEY = 'TRACE_SLOW_KEEP'
+
+    DEFAULT_SLOW_SECONDS = 1.0
+    DEFAULT_SLOW_KEEP = 100
+
+    LOGGER_NAME = 'sure_weather.slow_requests'
+
+    def __init__(self, profiler=None, enabled: bool = None, slow_seconds: float = None,
+                 slow_keep: int = None):
+        """
+        :param profiler: SamplingProfiler counting the requests it captures
+        :param enabled: trace requests, defaults to TRACING_ENABLED
+        :param slow_seconds: requests taking at least this long are logged
+        :param slow_keep: slow requests kept for /debug/slow_requests
+        """
+        self.profiler = profiler
+        self.enabled = enabled if enabled is not None else \
+            os.environ.get(self.ENABLED_KEY, '0') == '1'
+        self.slow_seconds = slow_seconds if slow_seconds is not None else \
+            float(os.environ.get(self.SLOW_SECONDS_KEY, self.DEFAULT_SLOW_SECONDS))
+        self.logger = logging.getLogger(self.LOGGER_NAME)
+        self._slow = deque(maxlen=slow_keep or int(os.environ.get(self.SLOW_KEEP_KEY,
+                                                                  self.DEFAULT_SLOW_KEEP)))
+        self._lock = threading.Lock()
+        self.traced = 0
+        self.slow = 0
+
+    def begin(self, route: str, trace_id: str = None):
+        """
+        Starts the trace of a request in the current context
+        :param route: path of the request
+        :param trace_id: X-Trace-Id header of the request
+        :return: token for end(), None when tracing is disabled
+        """
+        if not self.enabled:
+            return None
+
+        if not trace_id or len(trace_id) > MAX_TRACE_ID_LENGTH or not trace_id.isprintable():
+            trace_id = uuid.uuid4().hex
+        trace = Trace(trace_id, route)
+        return trace, _current.set(trace)
+
+    def end(self, begun, status: int, route: str = None):
+        """
+        Ends the trace of a request, logging it if it was slow
+        :param begun: token returned by begin()
+        :param status: HTTP status of the response
+        :param route: path of the request, requests to /debug routes are not profiled
+        :return: the ended Trace, None when tracing is disabled
+        """
+        if self.profiler is not None and self.profiler.running and \
+                not (route or '').startswith('/debug/'):
+            self.profiler.request_finished()
+        if begun is None:
+            return None
+
+        trace, token = begun
+        _current.reset(token)
+        duration = time.perf_counter() - trace.started
+        with self._lock:
+            self.traced += 1
+        if duration >= self.slow_seconds:
+            self._log_slow(trace, status, duration)
+        return trace
+
+    def _log_slow(self, trace: Trace, status: int, duration: float):
+        record = {
+            'trace_id': trace.trace_id,
+            'route': trace.route,
+            'status': status,
+            'duration_ms': round(duration * 1000, 2),
+            'spans': trace.breakdown(),
+        }
+        with self._lock:
+            self.slow += 1
+            self._slow.append(record)
+        self.logger.warning(json.dumps(record))
+
+    def slow_requests(self) -> list:
+        """
+        :return: the last slow requests, newest first
+        """
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'slow_seconds': self.slow_seconds,
+            'traced': self.traced,
+            'slow': self.slow,
+        }
@@ -1,154 +1,892 @@
-import json
-import statistics
-from datetime import datetime
+"""
+asyncio serving mode of /current_weather, built on aiohttp.
+
+Requests are validated and answered with the same schema as the Flask
+endpoint, but the weather services and google maps are called without
+blocking, so one process can keep hundreds of requests in flight.
+"""
+import asyncio
+import functools
 import logging
+import os
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+
+import aiohttp
+from aiohttp import web
+
+from flask_weather import health, schema
+from flask_weather.context import init_app
+from flask_weather.helper import encoding, metrics, tracing
+from flask_weather.helper.async_google_maps import AsyncGoogleMaps
+from flask_weather.helper.freshness import ResponseFreshness, is_conditional, not_modified
+from flask_weather.helper.land_mask import LandMaskValidator
+from flask_weather.helper.profiling import parse_capture
+from flask_weather.helper.single_flight import AsyncSingleFlight
+from flask_weather.weather import spatial, subscriptions
+from flask_weather.weather.aggregation import aggregate_temperature, provider_weights
+from flask_weather.weather.async_client import AsyncProviderFanout
+
+from .exceptions import InputValidationException, ServiceNotAvailable, SureWeatherException, \
+    ForbiddenException, AppErrorCodes
+
+
+def json_response(request: web.Request, data, status: int = HTTPStatus.OK.value,
+                  headers: dict = None) -> web.Response:
+    """
+    Encodes the response body with the ResponseEncoder, compressed when the client accepts
+    gzip and the body is large enough
+    :param request: request answered
+    :param data: response body
+    :param status: HTTP status
+    :param headers: extra headers
+    :return: web.Response object
+    """
+    encoder = request.app['response_encoder']
+    with tracing.span('encode'):
+        body = encoder.dumps(data)
+    if len(body) < encoder.compress_min_bytes or \
+            not encoder.accepts_gzip(request.headers.get('Accept-Encoding')):
+        return web.Response(body=body, status=status, headers=headers,
+                            content_type=encoding.JSON_CONTENT_TYPE)
 
+    return web.Response(body=encoder.compress(body), status=status,
+                        content_type=encoding.JSON_CONTENT_TYPE,
+                        headers=dict(headers or {}, **{'Content-Encoding': encoding.GZIP,
+                                                       'Vary': 'Accept-Encoding'}))
 
-from .exceptions import InputValidationException, WeatherServiceException, ServiceNotAvailable, \
-    SureWeatherException, AppErrorCodes
 
-@api.route('/current_weather')
-class CurrentWeather(Resource):
-    LATITUDE_KEY = 'latitude'
-    LONGITUDE_KEY = 'longitude'
-    SERVICES_KEY = 'services'
-    ZIPCODE = 'zipcode'
+def error_response(request: web.Request, err: SureWeatherException) -> web.Response:
+    """
+    :param request: request answered
+    :param err: exception the request failed with
+    :return: web.Response object with the encoded error, reused for the same error
+    """
+    return web.Response(body=request.app['response_encoder'].error_body(err),
+                        status=err.HTTP_CODE, content_type=encoding.JSON_CONTENT_TYPE)
+
+
+@web.middleware
+async def trace_middleware(request: web.Request, handler):
+    """
+    Traces the request, the trace id is returned in the X-Trace-Id header of responses that
+    were not streamed
+    """
+    tracer = request.app['tracer']
+    begun = tracer.begin(request.path, request.headers.get(tracing.TRACE_HEADER))
+    response = None
+    try:
+        response = await handler(request)
+        return response
+    finally:
+        trace = tracer.end(begun, response.status if response is not None else
+                           HTTPStatus.INTERNAL_SERVER_ERROR.value, request.path)
+        if trace is not None and response is not None and not response.prepared:
+            response.headers[tracing.TRACE_HEADER] = trace.trace_id
 
+
+class CurrentWeather(web.View):
     """
     Main class that handles the router /current_weather
     """
+    LATITUDE_KEY = schema.LATITUDE_KEY
+    LONGITUDE_KEY = schema.LONGITUDE_KEY
+    SERVICES_KEY = schema.SERVICES_KEY
+    ZIPCODE = schema.ZIPCODE
+
+    @property
+    def clients(self) -> dict:
+        return self.request.app['async_clients']
 
-    def get_latlon(self, zipcode: str):
+    async def get_latlon(self, zipcode: str):
         """
-        Uses google maps to get latitude and longitude from a given zipcode
+        Uses the local zipcode index, or else google maps, to get latitude and longitude
+        from a given zipcode
         :param zipcode:
         :return: tuple (latitude, longitude)
         """
-        if 'google_maps' not in self.request.app:
+        zipcode = int(zipcode)
+        gazetteer = self.request.app.get('gazetteer')
+
+        if gazetteer is not None:
+            location = gazetteer.find(zipcode)
+            if location is not None:
+                return location
+            if gazetteer.fallback is None:
+                raise ValueError(f'Invalid zipcode: {zipcode}')
+
+        if 'google_maps' not in self.clients:
             raise ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
                                       'Google maps service not setup')
 
-        return self.request.app['google_maps'].get_latlon(int(zipcode))
+        latitude, longitude = await self.clients['google_maps'].get_latlon(zipcode)
+        if gazetteer is not None:
+            gazetteer.learn(zipcode, latitude, longitude)
+        return latitude, longitude
+
+    async def validate_location(self, latitude: float, longitude: float) -> bool:
+        """
+        Validates the location with the configured validator without blocking the loop
+        :param latitude:
+        :param longitude:
+        :return: True if valid
+        """
+        validator = self.request.app['location_validator']
+
+        if validator is None:
+            return True
 
-    def parse_request(self, query_params: dict) -> tuple:
+        if validator is self.request.app.get('google_maps'):
+            return await self.clients['google_maps'].validate_location(latitude, longitude)
+
+        if getattr(validator, 'fallback', None) is not None:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, validator.validate_location, latitude, longitude)
+
+        return validator.validate_location(latitude, longitude)
+
+    async def parse_request(self, query_params: dict) -> tuple:
         """
-        Parses the request and returns a tuple of (latitude, longitude, services)
-        This method groups the errors if it encounters any
+        Parses the request and returns a tuple of (latitude, longitude, services, strategy)
+        Valid latitude and longitude requests take the fast path of the RequestValidator,
+        the others are parsed again to group the errors if it encounters any
         :param query_params:
-        :return: tuple of (latitude, longitude, services)
+        :return: tuple of (latitude, longitude, services, aggregation strategy)
         """
+        parsed = self.request.app['request_validator'].validate(
+            query_params, self.request.app['weather_services'])
+        if parsed is not None:
+            if not await self.validate_location(parsed[0], parsed[1]):
+                raise InputValidationException(AppErrorCodes.INVALID_INPUT,
+                                               [schema.INVALID_LOCATION_ERROR])
+            return parsed
+
         errors = []
         latitude, longitude = None, None
 
         if self.ZIPCODE in query_params:
             try:
-                latitude, longitude = self.get_latlon(query_params[self.ZIPCODE])
+                latitude, longitude = await self.get_latlon(query_params[self.ZIPCODE])
             except ValueError:
-                errors.append('Invalid zipcode {}'.format(query_params[self.ZIPCODE]))
+                errors.append(schema.invalid_zipcode_error(query_params[self.ZIPCODE]))
 
-        elif self.LATITUDE_KEY in query_params and self.LATITUDE_KEY in query_params:
+        elif schema.has_latlon(query_params):
+            latitude, longitude = schema.parse_latlon(query_params, errors)
 
-            logging.info(query_params)
-            try:
-                latitude = float(query_params[self.LATITUDE_KEY])
+            if not errors and not await self.validate_location(latitude, longitude):
+                errors.append(schema.INVALID_LOCATION_ERROR)
+
+        else:
+            errors.append(schema.MISSING_LOCATION_ERROR)
 
-                if not -90 <= latitude <= 90:
-                    errors.append(
-                        'latitude invalid, must be decimal point number between -90 and +90')
+        services = schema.parse_services(query_params,
+                                         self.request.app['weather_services'].keys(), errors)
+        strategy = schema.parse_aggregation(query_params, errors)
+        schema.parse_lookup(query_params, errors)
 
-            except ValueError:
-                errors.append('latitude invalid, must be decimal point number between -90 and +90')
+        if errors:
+            raise InputValidationException(AppErrorCodes.INVALID_INPUT, errors)
+
+        return latitude, longitude, services, strategy
+
+    def provider_weights(self, weather_services) -> dict:
+        """
+        Weights of the readings of the given services
+        :param weather_services: service names
+        :return: dict of service name to weight
+        """
+        return provider_weights(self.request.app['weather_services'].select(weather_services),
+                                self.request.app['circuit_breakers'])
+
+    async def get_readings(self, latitude: float, longitude: float, weather_services: list,
+                           mode: str = spatial.LIVE):
+        """
+        Gets weather from a given list of services concurrently, or interpolates it from the
+        recent readings around the location when asked to and there are enough of them
+        :param latitude:
+        :param longitude:
+        :param weather_services:
+        :param mode: lookup mode, `live` or `interpolate`
+        :return: FanoutResult with the readings of the services that responded before
+                 the deadline, or InterpolatedResult
+        """
+        if mode == spatial.INTERPOLATE and self.request.app['reading_index'] is not None:
+            with metrics.REQUEST_SECONDS.time('current_weather', 'interpolate'):
+                result = self.request.app['reading_index'].interpolate(
+                    latitude, longitude, weather_services)
+            if result is not None:
+                return result
+
+        services = self.request.app['weather_services'].select(weather_services)
+        with metrics.REQUEST_SECONDS.time('current_weather', 'providers'):
+            return await self.clients['fanout'].fan_out(services, latitude, longitude)
+
+    async def get_current_temperature(self, latitude: float, longitude: float,
+                                      weather_services: list, strategy: str = None,
+                                      mode: str = spatial.LIVE) -> tuple:
+        """
+        Gets weather from a given list of services concurrently and aggregates the
+        temperature reported by the services that responded before the deadline
+        :param latitude:
+        :param longitude:
+        :param weather_services:
+        :param strategy: aggregation strategy, defaults to AGGREGATION_STRATEGY
+        :param mode: lookup mode, `live` or `interpolate`
+        :return: tuple (Aggregate, FanoutResult)
+        """
+        result = await self.get_readings(latitude, longitude, weather_services, mode)
+
+        with metrics.REQUEST_SECONDS.time('current_weather', 'aggregate'):
+            aggregate = aggregate_temperature(
+                result.readings, self.provider_weights(result.responded), strategy)
+        return aggregate, result
+
+    async def fetch(self, query_params: dict, mode: str = None) -> schema.Lookup:
+        """
+        Validates the query parameters and gets the readings, without aggregating them
+        :param query_params:
+        :param mode: lookup mode, defaults to the requested one
+        :return: Lookup
+        """
+        with metrics.REQUEST_SECONDS.time('current_weather', 'parse'):
+            latitude, longitude, services, strategy = await self.parse_request(query_params)
+        if 'refresher' in self.request.app:
+            self.request.app['refresher'].record(latitude, longitude, services)
+        result = await self.get_readings(latitude, longitude, services,
+                                         mode or schema.lookup_mode(query_params))
+        return schema.Lookup(latitude, longitude, services, strategy, result)
+
+    async def lookup(self, query_params: dict, headers=None) -> tuple:
+        """
+        Validates the query parameters and gets the current weather. A conditional live
+        lookup whose conditions hold for the readings in the reading cache is not fetched
+        :param query_params:
+        :param headers: request headers, with the conditions of a conditional request
+        :return: tuple (response dict, None when not modified, Validators, None when HTTP
+                 caching is disabled)
+        """
+        with metrics.REQUEST_SECONDS.time('current_weather', 'parse'):
+            latitude, longitude, services, strategy = await self.parse_request(query_params)
+        if 'refresher' in self.request.app:
+            self.request.app['refresher'].record(latitude, longitude, services)
+
+        mode = schema.lookup_mode(query_params)
+        freshness = self.request.app['freshness']
+        if freshness is not None and mode == spatial.LIVE and headers is not None and \
+                is_conditional(headers):
+            validators = freshness.cached(latitude, longitude, services, strategy,
+                                          self.provider_weights(services))
+            if validators is not None and not_modified(validators, headers):
+                return None, validators
+
+        aggregate, result = await self.get_current_temperature(
+            latitude, longitude, services, strategy, mode)
+        response = schema.build_response(latitude, longitude, services, result, aggregate)
+        return response, \
+            freshness.of_response(latitude, longitude, response) if freshness is not None else None
+
+    async def interpolate_many(self, items: list) -> dict:
+        """
+        Interpolates, in one query of the reading index, the locations of a batch asked to
+        be interpolated that are valid latitude and longitude requests
+        :param items: list of query parameter dicts
+        :return: dict of the position in items of each such location to its Lookup, None
+                 when there were not enough readings around it
+        """
+        index = self.request.app['reading_index']
+        if index is None:
+            return {}
+
+        candidates = list()
+        for position, query_params in enumerate(items):
+            if schema.lookup_mode(query_params) != spatial.INTERPOLATE:
+                continue
+            parsed = self.request.app['request_validator'].validate(
+                query_params, self.request.app['weather_services'])
+            if parsed is None or not await self.validate_location(parsed[0], parsed[1]):
+                continue
+            candidates.append((position, parsed))
+
+        with metrics.REQUEST_SECONDS.time('batch', 'interpolate'):
+            results = index.interpolate_many([parsed[:2] for _, parsed in candidates],
+                                             [parsed[2] for _, parsed in candidates])
+        return {position: schema.Lookup(*parsed, result) if result is not None else None
+                for (position, parsed), result in zip(candidates, results)}
+
+    async def get(self):
+        """
+        GET method handler for /current_weather
+        :return:
+        """
+        query_params = self.request.query
+        started = time.monotonic()
+        try:
+            with metrics.REQUEST_SECONDS.time('current_weather', 'total'):
+                response, validators = await self.lookup(query_params, self.request.headers)
+            if validators is None:
+                self.request.app['request_log'].log('current_weather', query_params,
+                                                    HTTPStatus.OK.value, started,
+                                                    responded=response['services_responded'])
+                return json_response(self.request, response)
+
+            conditional = is_conditional(self.request.headers)
+            if response is None or conditional and not_modified(validators, self.request.headers):
+                metrics.CONDITIONAL_REQUESTS.inc('not_modified' if response is None else
+                                                 'revalidated')
+                self.request.app['request_log'].log('current_weather', query_params,
+                                                    HTTPStatus.NOT_MODIFIED.value, started)
+                # aiohttp always sends a content type, that of the 200 rather than its default
+                return web.Response(status=HTTPStatus.NOT_MODIFIED.value,
+                                    headers=ResponseFreshness.headers(validators),
+                                    content_type=encoding.JSON_CONTENT_TYPE)
+
+            if conditional:
+                metrics.CONDITIONAL_REQUESTS.inc('modified')
+            self.request.app['request_log'].log('current_weather', query_params,
+                                                HTTPStatus.OK.value, started,
+                                                responded=response['services_responded'])
+            return json_response(self.request, response,
+                                 headers=ResponseFreshness.headers(validators))
+
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'current_weather')
+            self.request.app['request_log'].log('current_weather', query_params, err.HTTP_CODE,
+                                                started, error=err)
+            return error_response(self.request, err)
+
+
+class CurrentWeatherBatch(web.View):
+    """
+    Handles the route /current_weather/batch, current weather of many locations in one request.
+    Identical locations are looked up once, and up to BATCH_CONCURRENCY locations are looked
+    up at a time. Batches larger than BATCH_STREAM_THRESHOLD, or requests that accept
+    application/x-ndjson, get one result per line as the results complete. The readings of
+    the locations that completed together are aggregated in one call
+    """
+    MAX_ITEMS = int(os.environ.get(schema.BATCH_MAX_ITEMS_KEY, schema.DEFAULT_BATCH_MAX_ITEMS))
+    STREAM_THRESHOLD = int(os.environ.get(schema.BATCH_STREAM_THRESHOLD_KEY,
+                                          schema.DEFAULT_BATCH_STREAM_THRESHOLD))
+    CONCURRENCY = int(os.environ.get(schema.BATCH_CONCURRENCY_KEY,
+                                     schema.DEFAULT_BATCH_CONCURRENCY))
 
+    async def _fetch(self, semaphore: asyncio.Semaphore, query_params: dict,
+                     mode: str = None) -> tuple:
+        async with semaphore:
             try:
-                longitude = float(query_params[self.LONGITUDE_KEY])
+                return await CurrentWeather(self.request).fetch(query_params, mode), None
+            except SureWeatherException as err:
+                metrics.ERRORS.inc(err.error_code.name, 'batch')
+                return None, err
+
+    def respond(self, fetched: list) -> list:
+        """
+        Aggregates the readings of completed lookups and builds their responses
+        :param fetched: list of tuples (Lookup, SureWeatherException), one of them None
+        :return: list of tuples (response dict, SureWeatherException), one of them None
+        """
+        lookups = [lookup for lookup, error in fetched if error is None]
+        services = {name for lookup in lookups for name in lookup.result.responded}
+        with metrics.REQUEST_SECONDS.time('batch', 'aggregate'):
+            responses = iter(schema.build_responses(
+                lookups, CurrentWeather(self.request).provider_weights(services)))
+
+        results = list()
+        for lookup, error in fetched:
+            response, error = (None, error) if error is not None else next(responses)
+            if response is None and lookup is not None:
+                metrics.ERRORS.inc(error.error_code.name, 'batch')
+            results.append((response, error))
+        return results
+
+    def interpolated_results(self, interpolated: dict, indices: list) -> list:
+        """
+        Aggregates the readings of the interpolated locations in one call
+        :param interpolated: dict of location position to Lookup, from interpolate_many
+        :param indices: indices in the request of each location
+        :return: list of batch results
+        """
+        lookups = [(position, lookup) for position, lookup in interpolated.items()
+                   if lookup is not None]
+        if not lookups:
+            return []
+
+        results = list()
+        responses = self.respond([(lookup, None) for _, lookup in lookups])
+        for (position, _), (response, error) in zip(lookups, responses):
+            results.extend(schema.batch_result(index, response, error)
+                           for index in indices[position])
+        return results
+
+    async def results(self, items: list):
+        """
+        Looks up the locations concurrently
+        :param items: list of query parameter dicts
+        :return: async generator of batch results, in the order they complete
+        """
+        unique_items, indices = schema.dedupe_batch(items)
+        interpolated = await CurrentWeather(self.request).interpolate_many(unique_items)
+        for result in self.interpolated_results(interpolated, indices):
+            yield result
+
+        # Locations that could not be interpolated are looked up live
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        tasks = dict()
+        for position, query_params in enumerate(unique_items):
+            if interpolated.get(position) is None:
+                mode = spatial.LIVE if position in interpolated else None
+                tasks[asyncio.ensure_future(self._fetch(semaphore, query_params, mode))] = position
 
-                if not -180 <= longitude <= 180:
-                    errors.append(
-                        'longitude invalid, must be decimal point number between -180 and +180')
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done = list(done)
+                responses = self.respond([task.result() for task in done])
+                for task, (response, error) in zip(done, responses):
+                    for index in indices[tasks[task]]:
+                        yield schema.batch_result(index, response, error)
+        finally:
+            for task in tasks:
+                task.cancel()
 
+    async def post(self):
+        """
+        POST method handler for /current_weather/batch
+        :return:
+        """
+        try:
+            try:
+                body = await self.request.json()
             except ValueError:
-                errors.append(
-                    'longitude invalid, must be decimal point number between -180 and +180')
+                body = None
+            items = schema.parse_batch(body, self.MAX_ITEMS)
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'batch')
+            return error_response(self.request, err)
 
-            if 'google_maps' in self.request.app and not \
-                    self.request.app['google_maps'].validate_location(latitude,
-                                                                            longitude):
-                errors.append('This location is invalid')
+        logging.info('Batch of %d locations', len(items))
+        if len(items) <= self.STREAM_THRESHOLD and \
+                schema.NDJSON_CONTENT_TYPE not in self.request.headers.get('Accept', ''):
+            results = [result async for result in self.results(items)]
+            return json_response(self.request,
+                                 {'results': sorted(results, key=lambda result: result['index'])})
 
-        else:
-            errors.append('[latitude, longitude] pair or zipcode must be present')
+        encoder = self.request.app['response_encoder']
+        gzip = encoding.GzipStream(encoder.compress_level) \
+            if encoder.accepts_gzip(self.request.headers.get('Accept-Encoding')) else None
+        headers = {'Content-Type': schema.NDJSON_CONTENT_TYPE}
+        if gzip is not None:
+            headers.update({'Content-Encoding': encoding.GZIP, 'Vary': 'Accept-Encoding'})
 
-        if self.SERVICES_KEY in query_params:
-            services = query_params[self.SERVICES_KEY].split(',')
-            invalid_services = set(services).difference(self.request.app['weather_services'].keys())
-            if invalid_services:
-                errors.append('Invalid services {}'.format(invalid_services))
-        else:
-            services = list(self.request.app['weather_services'].keys())
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(self.request)
+        async for result in self.results(items):
+            line = encoder.dumps(result) + b'\n'
+            await response.write(gzip.compress(line) if gzip is not None else line)
+        if gzip is not None:
+            await response.write(gzip.close())
+        await response.write_eof()
+        return response
+
+
+async def lookup_location(app: web.Application, location: subscriptions.Location) -> dict:
+    """
+    Polls a subscribed location, runs on the event loop for the SubscriptionHub
+    :param app:
+    :param location:
+    :return: response dict
+    """
+    services = list(location.services)
+    with metrics.REQUEST_SECONDS.time('subscription', 'providers'):
+        result = await app['async_clients']['fanout'].fan_out(
+            app['weather_services'].select(services), location.latitude, location.longitude)
+    weights = provider_weights(app['weather_services'].select(result.responded),
+                               app['circuit_breakers'])
+    aggregate = aggregate_temperature(result.readings, weights, location.strategy)
+    return schema.build_response(location.latitude, location.longitude, services, result,
+                                 aggregate)
+
+
+class CurrentWeatherSubscription(web.View):
+    """
+    Handles the route /current_weather/subscribe, streams the current weather of a set of
+    locations, then an update whenever the temperature of one of them changes, as server-sent
+    events, or NDJSON lines to requests that accept application/x-ndjson. GET subscribes to
+    the location of its query parameters, POST to the locations of a batch body. Each
+    distinct location is polled once for all the clients subscribed to it
+    """
+
+    async def parse_locations(self, items: list) -> OrderedDict:
+        """
+        :param items: list of query parameter dicts, one per location
+        :return: OrderedDict of Location to the list of its indices in items
+        """
+        errors = []
+        parsed = []
+        for index, query_params in enumerate(items):
+            try:
+                parsed.append(await CurrentWeather(self.request).parse_request(query_params))
+            except InputValidationException as err:
+                errors.extend(err.message if len(items) == 1 else
+                              ['location {}: {}'.format(index, message)
+                               for message in err.message])
 
         if errors:
-            logging.error(errors)
             raise InputValidationException(AppErrorCodes.INVALID_INPUT, errors)
+        return subscriptions.group_locations(parsed)
+
+    async def stream(self, items: list) -> web.StreamResponse:
+        """
+        Subscribes to the locations and streams their updates until the client disconnects
+        :param items: list of query parameter dicts, one per location
+        :return: web.StreamResponse object
+        """
+        app = self.request.app
+        hub = app['subscriptions']
+        ready = asyncio.Event()
+        try:
+            locations = await self.parse_locations(items)
+            hub.start(functools.partial(lookup_location, app), asyncio.get_event_loop())
+            subscription = hub.subscribe(locations, ready.set)
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'subscription')
+            return error_response(self.request, err)
 
-        return latitude, longitude, services
+        content_type = subscriptions.NDJSON_CONTENT_TYPE \
+            if subscriptions.NDJSON_CONTENT_TYPE in self.request.headers.get('Accept', '') \
+            else subscriptions.SSE_CONTENT_TYPE
+        encoder = app['response_encoder']
+
+        logging.info('Subscription to %d locations', len(locations))
+        try:
+            response = web.StreamResponse(headers={'Content-Type': content_type,
+                                                   'Cache-Control': 'no-cache',
+                                                   'X-Accel-Buffering': 'no'})
+            await response.prepare(self.request)
+            # Runs until the client disconnects and the handler is cancelled
+            while True:
+                try:
+                    await asyncio.wait_for(ready.wait(), hub.heartbeat)
+                except asyncio.TimeoutError:
+                    await response.write(subscriptions.heartbeat(content_type))
+                    continue
+                ready.clear()
+                await response.write(b''.join(
+                    subscriptions.format_event(
+                        encoder.dumps(schema.batch_result(index, update, error)),
+                        content_type)
+                    for location, update, error in subscription.take()
+                    for index in locations[location]))
+        finally:
+            hub.unsubscribe(subscription)
 
-    def get_current_temperature(self, latitude: float, longitude: float,
-                                      weather_services: list) -> tuple:
+    async def get(self):
         """
-        Gets weather from a given list of services and returns average of the temperature
-        :param latitude:
-        :param longitude:
-        :param weather_services:
-        :return: tuple (average_fahrenheit, average_celcius)
+        GET method handler for /current_weather/subscribe, with the query parameters of
+        /current_weather
+        :return:
         """
-        curr_temp_list = list()
+        return await self.stream([self.request.query])
 
-        for service_name in weather_services:
+    async def post(self):
+        """
+        POST method handler for /current_weather/subscribe, with the body of
+        /current_weather/batch
+        :return:
+        """
+        try:
             try:
-                service = self.request.app['weather_services'][service_name]
-                curr_temp_list.append(service.get_current_temperature(latitude, longitude))
-            except WeatherServiceException as err:
-                logging.exception(err)
+                body = await self.request.json()
+            except ValueError:
+                body = None
+            items = schema.parse_batch(body, self.request.app['subscriptions'].max_locations)
+        except SureWeatherException as err:
+            metrics.ERRORS.inc(err.error_code.name, 'subscription')
+            return error_response(self.request, err)
+        return await self.stream(items)
 
-        logging.info(curr_temp_list)
-        curr_temp_list = [curr_temp for curr_temp in curr_temp_list if curr_temp]
 
-        if not curr_temp_list:
-            raise ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
-                                      "No weather service available")
+async def liveness_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /health/live, the process is up
+    :param request:
+    :return:
+    """
+    return json_response(request, health.liveness())
+
+
+async def readiness_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /health/ready, 503 while no weather service is available
+    :param request:
+    :return:
+    """
+    ready, status = health.readiness(request.app)
+    return json_response(request, status, status=200 if ready else 503)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /metrics, latency histograms and error counters in the Prometheus
+    text format
+    :param request:
+    :return:
+    """
+    return web.Response(body=metrics.REGISTRY.render().encode(),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def http_pool_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/http, connection reuse of the shared HTTP transport and the
+    limits of the aiohttp session the async clients share
+    :param request:
+    :return:
+    """
+    from flask_weather.helper.http_transport import get_transport
+
+    stats = get_transport().pool_stats()
+    session = request.app['async_clients'].get('session')
+    if session is not None:
+        stats['aiohttp'] = {
+            'limit': session.connector.limit,
+            'limit_per_host': session.connector.limit_per_host,
+        }
+    return json_response(request, stats)
+
+
+async def reading_cache_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/cache, the hit ratio of the weather reading cache
+    :param request:
+    :return:
+    """
+    return json_response(request, request.app['reading_cache'].stats())
+
+
+async def single_flight_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/single_flight, how many lookups shared an upstream call
+    :param request:
+    :return:
+    """
+    clients = request.app['async_clients']
+    stats = {'weather_services': clients['fanout'].single_flight.stats()}
+    if 'google_maps' in clients:
+        stats['google_maps'] = clients['google_maps'].single_flight.stats()
+    return json_response(request, stats)
+
+
+async def circuit_breaker_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/circuit_breakers, the health of each weather service
+    :param request:
+    :return:
+    """
+    return json_response(request, request.app['circuit_breakers'].stats())
+
+
+async def admission_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/admission, the rate and adaptive concurrency limits of each
+    weather service
+    :param request:
+    :return:
+    """
+    admission = request.app['admission']
+    return json_response(request, admission.stats() if admission is not None else {})
+
+
+async def hedging_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/hedging, how often slow calls were hedged and won
+    :param request:
+    :return:
+    """
+    hedgers = request.app['hedgers']
+    return json_response(request, hedgers.stats() if hedgers is not None else {})
+
+
+async def refresher_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/refresher, background refreshes of the hot locations
+    :param request:
+    :return:
+    """
+    if 'refresher' not in request.app:
+        return json_response(request, {})
+    return json_response(request, request.app['refresher'].stats())
+
+
+async def subscription_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/subscriptions, the open subscriptions, the distinct locations
+    they poll and how many polls changed the temperature
+    :param request:
+    :return:
+    """
+    return json_response(request, request.app['subscriptions'].stats())
+
+
+async def zipcode_index_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/zipcode_index, hits and geocode fallbacks of the index
+    :param request:
+    :return:
+    """
+    if 'gazetteer' not in request.app:
+        return json_response(request, {})
+    return json_response(request, request.app['gazetteer'].stats())
+
+
+async def land_mask_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/land_mask, checks and google fallbacks of the land mask
+    :param request:
+    :return:
+    """
+    validator = request.app['location_validator']
+    if not isinstance(validator, LandMaskValidator):
+        return json_response(request, {})
+    return json_response(request, validator.stats())
+
+
+async def provider_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/providers, the declared weather services and their settings
+    :param request:
+    :return:
+    """
+    return json_response(request, request.app['weather_services'].stats())
+
+
+async def encoding_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/encoding, the response encoder and compression settings
+    :param request:
+    :return:
+    """
+    return json_response(request, request.app['response_encoder'].stats())
+
+
+async def reading_index_stats_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /stats/reading_index, the recent readings indexed for interpolation
+    and how often locations were interpolated
+    :param request:
+    :return:
+    """
+    reading_index = request.app['reading_index']
+    return json_response(request, reading_index.stats() if reading_index is not None else {})
+
 
-        average_fahrenheit = statistics.mean(curr_temp_list)
-        average_celcius = round((average_fahrenheit - 32) * 5 / 9, 2)
-        return average_fahrenheit, average_celcius
+def authorize_debug(request: web.Request):
+    """
+    :raises ForbiddenException: when DEBUG_TOKEN is set and the request does not carry it
+    """
+    if not tracing.authorized(request.headers.get(tracing.DEBUG_TOKEN_HEADER)):
+        raise ForbiddenException(AppErrorCodes.FORBIDDEN,
+                                 'Missing or invalid {}'.format(tracing.DEBUG_TOKEN_HEADER))
+
+
+class Profile(web.View):
+    """
+    Handles the route /debug/profile, starts and stops the sampling profiler and serves the
+    stacks it captured
+    """
 
     async def get(self):
         """
-        GET method handler for /current_weather
+        GET method handler for /debug/profile
+        :return: collapsed stacks of the running or last capture, as text
+        """
+        try:
+            authorize_debug(self.request)
+        except SureWeatherException as err:
+            return error_response(self.request, err)
+        return web.Response(text=self.request.app['profiler'].collapsed())
+
+    async def post(self):
+        """
+        POST method handler for /debug/profile, starts a capture of `seconds`, or of
+        `requests` requests, sampling every `interval` seconds
         :return:
         """
-        query_params = dict(self.request.query)
-        logging.info('Query params: %s', query_params)
         try:
-            latitude, longitude, services = self.parse_request(query_params)
-            fahrenheit, celcius = self.get_current_temperature(latitude, longitude, services)
-            curr_dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
-            response = {
-                'latitude': round(latitude, 2),
-                'longitude': round(longitude, 2),
-                'datetime': curr_dt,
-                "services": services,
-                'temperature': {
-                    "fahrenheit": round(fahrenheit, 2),
-                    "celsius": round(celcius, 2)
-                }
-            }
-            logging.info(response)
-            return web.json_response(response)
+            authorize_debug(self.request)
+            capture = parse_capture(self.request.query)
+        except SureWeatherException as err:
+            return error_response(self.request, err)
+
+        profiler = self.request.app['profiler']
+        started = profiler.start(**capture)
+        return json_response(self.request, profiler.stats(),
+                             HTTPStatus.ACCEPTED.value if started else HTTPStatus.CONFLICT.value)
 
+    async def delete(self):
+        """
+        DELETE method handler for /debug/profile, stops the running capture
+        :return:
+        """
+        try:
+            authorize_debug(self.request)
         except SureWeatherException as err:
-            return web.Response(status=err.HTTP_CODE,
-                                content_type="application/json",
-                                text=json.dumps(err.to_dict()))
+            return error_response(self.request, err)
+        profiler = self.request.app['profiler']
+        await asyncio.get_event_loop().run_in_executor(None, profiler.stop)
+        return json_response(self.request, profiler.stats())
+
+
+async def slow_requests_handler(request: web.Request) -> web.Response:
+    """
+    GET handler for /debug/slow_requests, the last traced requests slower than
+    TRACE_SLOW_SECONDS with the time spent in each of their stages
+    :param request:
+    :return:
+    """
+    try:
+        authorize_debug(request)
+    except SureWeatherException as err:
+        return error_response(request, err)
+    tracer = request.app['tracer']
+    return json_response(request, dict(tracer.stats(), slow_requests=tracer.slow_requests()))
+
+
+async def start_clients(app: web.Application):
+    """
+    Opens the aiohttp session shared by the async weather and google maps clients,
+    sized and timed out with the same settings as the HttpTransport
+    :param app:
+    :return:
+    """
+    from flask_weather.helper.http_transport import HttpTransport
+
+    connector = aiohttp.TCPConnector(
+        limit_per_host=int(os.environ.get(HttpTransport.POOL_MAXSIZE_KEY,
+                                          HttpTransport.DEFAULT_POOL_MAXSIZE)),
+        limit=0)
+    timeout = aiohttp.ClientTimeout(
+        connect=float(os.environ.get(HttpTransport.CONNECT_TIMEOUT_KEY,
+                                     HttpTransport.DEFAULT_CONNECT_TIMEOUT)),
+        sock_read=float(os.environ.get(HttpTransport.READ_TIMEOUT_KEY,
+                                       HttpTransport.DEFAULT_READ_TIMEOUT)))
+    session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    clients = app['async_clients']
+    clients['session'] = session
+    clients['fanout'] = AsyncProviderFanout(session, reading_cache=app['reading_cache'],
+                                            single_flight=AsyncSingleFlight(),
+                                            circuit_breakers=app['circuit_breakers'],
+                                            hedgers=app['hedgers'],
+                                            admission=app['admission'],
+                                            reading_index=app['reading_index'])
+    if 'google_maps' in app:
+        clients['google_maps'] = AsyncGoogleMaps(app['google_maps'], session)
+
+
+async def close_clients(app: web.Application):
+    await app['async_clients']['session'].close()
 
 
 def add_routes(app: web.Application):
@@ -158,3 +896,44 @@ def add_routes(app: web.Application):
     :return:
     """
     app.router.add_view("/current_weather", CurrentWeather)
+    app.router.add_view("/current_weather/batch", CurrentWeatherBatch)
+    app.router.add_view("/current_weather/subscribe", CurrentWeatherSubscription)
+    app.router.add_get("/health/live", liveness_handler)
+    app.router.add_get("/health/ready", readiness_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/stats/http", http_pool_stats_handler)
+    app.router.add_get("/stats/cache", reading_cache_stats_handler)
+    app.router.add_get("/stats/single_flight", single_flight_stats_handler)
+    app.router.add_get("/stats/circuit_breakers", circuit_breaker_stats_handler)
+    app.router.add_get("/stats/admission", admission_stats_handler)
+    app.router.add_get("/stats/hedging", hedging_stats_handler)
+    app.router.add_get("/stats/refresher", refresher_stats_handler)
+    app.router.add_get("/stats/subscriptions", subscription_stats_handler)
+    app.router.add_get("/stats/zipcode_index", zipcode_index_stats_handler)
+    app.router.add_get("/stats/land_mask", land_mask_stats_handler)
+    app.router.add_get("/stats/providers", provider_stats_handler)
+    app.router.add_get("/stats/encoding", encoding_stats_handler)
+    app.router.add_get("/stats/reading_index", reading_index_stats_handler)
+    app.router.add_view("/debug/profile", Profile)
+    app.router.add_get("/debug/slow_requests", slow_requests_handler)
+
+
+def create_app(context: dict = None) -> web.Application:
+    """
+    Creates the aiohttp application
+    :param context: application state from init_app, initialized when not given
+    :return: web.Application object
+    """
+    app = web.Application(middlewares=[trace_middleware])
+    for key, value in (context or init_app()).items():
+        app[key] = value
+    app['async_clients'] = dict()
+
+    app.on_startup.append(start_clients)
+    app.on_cleanup.append(close_clients)
+    add_routes(app)
+    return app
+
+
+def run(host: str, port: int):
+    web.run_app(create_app(), host=host, port=port, access_log=None)
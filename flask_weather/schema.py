@@ -0,0 +1,321 @@
+"""
+Request validation and response schema of /current_weather, shared by the
+Flask and the asyncio servers
+"""
+from collections import namedtuple
+from datetime import datetime
+from http import HTTPStatus
+
+from flask_weather.exceptions import InputValidationException, ServiceNotAvailable, \
+    AppErrorCodes
+from flask_weather.weather import aggregation, spatial
+from flask_weather.weather.fanout import FanoutResult
+
+LATITUDE_KEY = 'latitude'
+LONGITUDE_KEY = 'longitude'
+SERVICES_KEY = 'services'
+ZIPCODE = 'zipcode'
+AGGREGATION_KEY = 'aggregation'
+LOOKUP_KEY = 'lookup'
+
+LATITUDE_ERROR = 'latitude invalid, must be decimal point number between -90 and +90'
+LONGITUDE_ERROR = 'longitude invalid, must be decimal point number between -180 and +180'
+INVALID_LOCATION_ERROR = 'This location is invalid'
+MISSING_LOCATION_ERROR = '[latitude, longitude] pair or zipcode must be present'
+
+
+def has_latlon(query_params: dict) -> bool:
+    return LATITUDE_KEY in query_params and LONGITUDE_KEY in query_params
+
+
+def parse_latlon(query_params: dict, errors: list) -> tuple:
+    """
+    Parses and range checks the latitude and longitude, appends to errors on failure
+    :param query_params:
+    :param errors:
+    :return: tuple (latitude, longitude)
+    """
+    latitude, longitude = None, None
+
+    try:
+        latitude = float(query_params[LATITUDE_KEY])
+
+        if not -90 <= latitude <= 90:
+            errors.append(LATITUDE_ERROR)
+
+    except ValueError:
+        errors.append(LATITUDE_ERROR)
+
+    try:
+        longitude = float(query_params[LONGITUDE_KEY])
+
+        if not -180 <= longitude <= 180:
+            errors.append(LONGITUDE_ERROR)
+
+    except ValueError:
+        errors.append(LONGITUDE_ERROR)
+
+    return latitude, longitude
+
+
+def invalid_zipcode_error(zipcode: str) -> str:
+    return 'Invalid zipcode {}'.format(zipcode)
+
+
+def parse_services(query_params: dict, available_services, errors: list) -> list:
+    """
+    Parses the requested services, defaults to all the available services
+    :param query_params:
+    :param available_services: names of the available services
+    :param errors:
+    :return: list of service names
+    """
+    if SERVICES_KEY in query_params:
+        services = query_params[SERVICES_KEY].split(',')
+        invalid_services = set(services).difference(available_services)
+        if invalid_services:
+            errors.append('Invalid services {}'.format(invalid_services))
+    else:
+        services = list(available_services)
+
+    return services
+
+
+def parse_aggregation(query_params: dict, errors: list) -> str:
+    """
+    Parses the requested aggregation strategy, defaults to AGGREGATION_STRATEGY
+    :param query_params:
+    :param errors:
+    :return: strategy name
+    """
+    if AGGREGATION_KEY not in query_params:
+        return aggregation.default_strategy()
+
+    strategy = query_params[AGGREGATION_KEY]
+    if strategy not in aggregation.STRATEGIES:
+        errors.append('Invalid aggregation {}, must be one of {}'.format(
+            strategy, ', '.join(aggregation.STRATEGIES)))
+    return strategy
+
+
+class RequestValidator:
+    """
+    Validates the query parameters of a /current_weather request for a latitude and
+    longitude without building an error list, so a valid request only pays for its float
+    conversions and lookups in sets prepared once. Anything else, a zipcode, a missing or
+    invalid parameter, is left to parse_latlon, parse_services and parse_aggregation,
+    which report every error of the request
+    """
+
+    def __init__(self, default_strategy: str = None):
+        """
+        :param default_strategy: strategy of requests without one, defaults to
+                                 AGGREGATION_STRATEGY
+        """
+        self.default_strategy = default_strategy or aggregation.default_strategy()
+        self.strategies = frozenset(aggregation.STRATEGIES)
+        self.lookup_modes = frozenset(spatial.LOOKUP_MODES)
+
+    def validate(self, query_params, available_services) -> tuple:
+        """
+        :param query_params: dict or multidict of the query parameters
+        :param available_services: names of the available services
+        :return: tuple (latitude, longitude, services, strategy), None when the request
+                 has to go through the full parser
+        """
+        if ZIPCODE in query_params:
+            return None
+
+        try:
+            latitude = float(query_params[LATITUDE_KEY])
+            longitude = float(query_params[LONGITUDE_KEY])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        # Also false for NaN
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return None
+
+        strategy = query_params.get(AGGREGATION_KEY, self.default_strategy)
+        if strategy not in self.strategies:
+            return None
+
+        mode = query_params.get(LOOKUP_KEY)
+        if mode is not None and mode not in self.lookup_modes:
+            return None
+
+        requested = query_params.get(SERVICES_KEY)
+        if requested is None:
+            return latitude, longitude, list(available_services), strategy
+
+        services = requested.split(',')
+        for name in services:
+            if name not in available_services:
+                return None
+        return latitude, longitude, services, strategy
+
+
+def parse_lookup(query_params: dict, errors: list) -> str:
+    """
+    Parses the requested lookup mode, defaults to LOOKUP_MODE
+    :param query_params:
+    :param errors:
+    :return: `live` or `interpolate`
+    """
+    mode = lookup_mode(query_params)
+    if mode not in spatial.LOOKUP_MODES:
+        errors.append('Invalid lookup {}, must be one of {}'.format(
+            mode, ', '.join(spatial.LOOKUP_MODES)))
+    return mode
+
+
+def lookup_mode(query_params: dict) -> str:
+    """
+    :param query_params: validated query parameters
+    :return: requested lookup mode, defaults to LOOKUP_MODE
+    """
+    return query_params.get(LOOKUP_KEY) or spatial.default_lookup_mode()
+
+
+def build_response(latitude: float, longitude: float, services: list, result: FanoutResult,
+                   aggregate: aggregation.Aggregate) -> dict:
+    """
+    Builds the /current_weather response
+    :param result: FanoutResult of the readings, or InterpolatedResult when they were
+                   interpolated from nearby readings
+    :return: dict
+    """
+    curr_dt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+    response = {
+        'latitude': round(latitude, 2),
+        'longitude': round(longitude, 2),
+        'datetime': curr_dt,
+        "services": services,
+        "services_responded": result.responded,
+        'temperature': {
+            "fahrenheit": round(aggregate.fahrenheit, 2),
+            "celsius": round(aggregate.celsius, 2)
+        },
+        'aggregation': aggregate.strategy,
+        'readings': aggregate.readings,
+        'readings_rejected': aggregate.rejected,
+        'spread': aggregate.spread,
+        'source': result.source,
+    }
+    if result.source == spatial.INTERPOLATED:
+        response['interpolation'] = result.details()
+    return response
+
+
+# Parsed request and provider readings of one location, before aggregation
+Lookup = namedtuple('Lookup', ['latitude', 'longitude', 'services', 'strategy', 'result'])
+
+
+def build_responses(lookups: list, weights: dict) -> list:
+    """
+    Aggregates the readings of many locations and builds their responses
+    :param lookups: list of Lookup
+    :param weights: dict of service name to weight of its readings
+    :return: list of tuples (response dict, None) or (None, SureWeatherException)
+    """
+    aggregates = aggregation.aggregate_batch([lookup.result.readings for lookup in lookups],
+                                             [lookup.strategy for lookup in lookups], weights)
+    responses = list()
+    for lookup, aggregate in zip(lookups, aggregates):
+        if aggregate is None:
+            responses.append((None, ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
+                                                        "No weather service available")))
+        else:
+            responses.append((build_response(lookup.latitude, lookup.longitude,
+                                             lookup.services, lookup.result, aggregate), None))
+    return responses
+
+
+BATCH_LOCATIONS_KEY = 'locations'
+BATCH_MAX_ITEMS_KEY = 'BATCH_MAX_ITEMS'
+BATCH_STREAM_THRESHOLD_KEY = 'BATCH_STREAM_THRESHOLD'
+BATCH_CONCURRENCY_KEY = 'BATCH_CONCURRENCY'
+
+DEFAULT_BATCH_MAX_ITEMS = 10000
+DEFAULT_BATCH_STREAM_THRESHOLD = 100
+DEFAULT_BATCH_CONCURRENCY = 8
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def parse_batch(body, max_items: int) -> list:
+    """
+    Parses a batch request body, either a list of locations or an object with a
+    `locations` list and optional `services`, `aggregation` and `lookup` applied to every
+    location.
+    A location has the same keys as the /current_weather query parameters
+    :param body: decoded json body
+    :param max_items: maximum number of locations
+    :return: list of query parameter dicts, one per location
+    """
+    services, strategy, mode = None, None, None
+    if isinstance(body, dict):
+        services = body.get(SERVICES_KEY)
+        strategy = body.get(AGGREGATION_KEY)
+        mode = body.get(LOOKUP_KEY)
+        body = body.get(BATCH_LOCATIONS_KEY)
+
+    if not isinstance(body, list) or not body:
+        raise InputValidationException(AppErrorCodes.INVALID_INPUT,
+                                       ['a non-empty list of locations must be present'])
+
+    if len(body) > max_items:
+        raise InputValidationException(AppErrorCodes.INVALID_INPUT,
+                                       ['at most {} locations per batch'.format(max_items)])
+
+    items = list()
+    for location in body:
+        if not isinstance(location, dict):
+            location = dict()
+        query_params = {str(key): ','.join(value) if isinstance(value, list) else str(value)
+                        for key, value in location.items()}
+        if services and SERVICES_KEY not in query_params:
+            query_params[SERVICES_KEY] = ','.join(services) \
+                if isinstance(services, list) else str(services)
+        if strategy and AGGREGATION_KEY not in query_params:
+            query_params[AGGREGATION_KEY] = str(strategy)
+        if mode and LOOKUP_KEY not in query_params:
+            query_params[LOOKUP_KEY] = str(mode)
+        items.append(query_params)
+
+    return items
+
+
+def dedupe_batch(items: list) -> tuple:
+    """
+    Groups identical locations so that each one is looked up once
+    :param items: list of query parameter dicts
+    :return: tuple (list of unique query parameter dicts, list of the indices of each)
+    """
+    positions = dict()
+    unique_items = list()
+    indices = list()
+
+    for index, query_params in enumerate(items):
+        key = tuple(sorted(query_params.items()))
+        if key not in positions:
+            positions[key] = len(unique_items)
+            unique_items.append(query_params)
+            indices.append([])
+        indices[positions[key]].append(index)
+
+    return unique_items, indices
+
+
+def batch_result(index: int, response: dict = None, error=None) -> dict:
+    """
+    Result of one location of a batch
+    :param index: position of the location in the request
+    :param response: /current_weather response on success
+    :param error: SureWeatherException on failure
+    :return: dict
+    """
+    if error is not None:
+        return {'index': index, 'status': error.HTTP_CODE, 'error': error.to_dict()}
+
+    return {'index': index, 'status': HTTPStatus.OK.value, 'result': response}
@@ -0,0 +1,101 @@
+"""
+Production server of sure_weather, gunicorn with pre-forked worker processes.
+
+The application is loaded once in the gunicorn master, so the weather
+services, caches and indexes are set up before forking and shared copy on
+write by the workers. The Flask app is served by threaded workers, the
+asyncio app by aiohttp workers.
+"""
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+WORKERS_KEY = 'SERVER_WORKERS'
+THREADS_KEY = 'SERVER_THREADS'
+PRELOAD_KEY = 'SERVER_PRELOAD'
+TIMEOUT_KEY = 'SERVER_TIMEOUT'
+KEEPALIVE_KEY = 'SERVER_KEEPALIVE'
+MAX_REQUESTS_KEY = 'SERVER_MAX_REQUESTS'
+
+DEFAULT_THREADS = 8
+DEFAULT_PRELOAD = '1'
+DEFAULT_TIMEOUT = 30
+DEFAULT_KEEPALIVE = 5
+DEFAULT_MAX_REQUESTS = 0
+
+
+def default_workers() -> int:
+    """
+    SERVER_WORKERS, or one worker per core when it is not set or not positive
+    :return: int
+    """
+    workers = int(os.environ.get(WORKERS_KEY, 0))
+    return workers if workers > 0 else multiprocessing.cpu_count()
+
+
+class SureWeatherServer(BaseApplication):
+    """
+    gunicorn application of the Flask or the asyncio app
+    """
+
+    def __init__(self, mode: str, options: dict):
+        """
+        :param mode: flask or async
+        :param options: gunicorn settings
+        """
+        self.mode = mode
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from flask_weather.context import init_app
+
+        # A preloaded app is forked with the state of the master, which must not be left
+        # to a startup thread that the workers would not inherit
+        context = init_app(background=False if self.cfg.preload_app else None)
+        if self.mode == 'async':
+            from flask_weather import routes
+            return routes.create_app(context)
+
+        from flask_weather import app
+        return app.create_app(context)
+
+
+def run(mode: str, host: str, port: int, workers: int = None, threads: int = None):
+    """
+    Serves the app with `workers` processes of `threads` threads each
+    :param mode: flask or async
+    :param host:
+    :param port:
+    :param workers: defaults to SERVER_WORKERS, or the number of cores
+    :param threads: threads per Flask worker, defaults to SERVER_THREADS
+    :return:
+    """
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': workers or default_workers(),
+        'preload_app': os.environ.get(PRELOAD_KEY, DEFAULT_PRELOAD) == '1',
+        'timeout': int(os.environ.get(TIMEOUT_KEY, DEFAULT_TIMEOUT)),
+        'keepalive': int(os.environ.get(KEEPALIVE_KEY, DEFAULT_KEEPALIVE)),
+        'max_requests': int(os.environ.get(MAX_REQUESTS_KEY, DEFAULT_MAX_REQUESTS)),
+        'max_requests_jitter': int(os.environ.get(MAX_REQUESTS_KEY,
+                                                  DEFAULT_MAX_REQUESTS)) // 10,
+        'accesslog': None,
+    }
+
+    if mode == 'async':
+        options['worker_class'] = 'aiohttp.GunicornWebWorker'
+    else:
+        options['worker_class'] = 'gthread'
+        options['threads'] = threads or int(os.environ.get(THREADS_KEY, DEFAULT_THREADS))
+
+    # Heartbeat files on a tmpfs, so a slow disk does not get workers killed
+    if os.path.isdir('/dev/shm'):
+        options['worker_tmp_dir'] = '/dev/shm'
+
+    SureWeatherServer(mode, options).run()
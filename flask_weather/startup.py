@@ -0,0 +1,84 @@
+"""
+Background initialization of the slow parts of the application state.
+
+With STARTUP_BACKGROUND=1, the default, the weather services are imported and
+created on a background thread once the app is created, so the server binds
+its port and answers /health/live right away. /health/ready reports the
+startup as `starting` until every step has completed, `failed` if one raised.
+Requests that arrive in the meantime load the services they need themselves.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class Startup:
+    BACKGROUND_KEY = 'STARTUP_BACKGROUND'
+
+    STARTING = 'starting'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self, background: bool = None):
+        """
+        :param background: run the steps on a background thread, defaults to STARTUP_BACKGROUND
+        """
+        self.background = background if background is not None else \
+            os.environ.get(self.BACKGROUND_KEY, '1') == '1'
+        self.state = self.STARTING
+        self.steps = OrderedDict()
+        self.error = None
+        self.elapsed = None
+        self._started = time.monotonic()
+        self._done = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == self.READY
+
+    def run(self, steps: list):
+        """
+        Runs the steps in order, on a background thread or before returning
+        :param steps: list of tuples (name, callable), a step that raises fails the startup
+        :return:
+        """
+        if not self.background:
+            self._run(steps)
+            return
+
+        threading.Thread(target=self._run, args=(steps,), name='startup', daemon=True).start()
+
+    def _run(self, steps: list):
+        try:
+            for name, step in steps:
+                start = time.monotonic()
+                step()
+                self.steps[name] = round(time.monotonic() - start, 3)
+            self.state = self.READY
+        except Exception as err:  # pylint: disable=broad-except
+            logging.exception('Startup failed: %s', err)
+            self.error = str(err)
+            self.state = self.FAILED
+        finally:
+            self.elapsed = round(time.monotonic() - self._started, 3)
+            self._done.set()
+            logging.info('Startup %s in %s seconds', self.state, self.elapsed)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits for the startup to complete or fail
+        :param timeout: seconds, None to wait until it does
+        :return: True if it is ready
+        """
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self) -> dict:
+        return {
+            'status': self.state,
+            'steps': dict(self.steps),
+            'seconds': self.elapsed,
+            'error': self.error,
+        }
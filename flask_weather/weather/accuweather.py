@@ -1,11 +1,5 @@
-import json
-import logging
 import os
-from http import HTTPStatus
 
-import requests
-
-from flask_weather.exceptions import WeatherServiceException
 from flask_weather.weather.base_service import BaseWeatherService
 
 
@@ -20,32 +14,24 @@ class AccuWeather(BaseWeatherService):
         super().__init__()
         self.url = os.environ[self.BASE_URL_KEY]
 
-    def _get_current_weather(self, latitude: float, longitude: float):
+    def _build_request(self, latitude: float, longitude: float) -> tuple:
         """
-        For a given location gets the current weather report from AccuWeather
+        For a given location describes the current weather request to AccuWeather
         :param latitude:
         :param longitude:
-        :return:
+        :return: tuple (method, url, keyword arguments)
         """
         params = {
             'latitude': str(latitude),
             'longitude': str(longitude)
         }
 
-        response = requests.get(self.url + "/" + self.SERVICE_NAME, params=params)
-        if response.status_code == HTTPStatus.OK.value:
-            return json.loads(response.text)
+        return 'GET', self.url + "/" + self.SERVICE_NAME, {'params': params}
 
-    def get_current_temperature(self, latitude: float, longitude: float) -> float:
+    def _parse_temperature(self, report: dict) -> float:
         """
-        For a given location gets the current temperature in fahrenheit from AccuWeather
-        :param latitude:
-        :param longitude:
+        Gets the current temperature in fahrenheit from an AccuWeather report
+        :param report:
         :return:
         """
-        try:
-            report = self._get_current_weather(latitude, longitude)
-            return float(report["simpleforecast"]["forecastday"][0]["current"]["fahrenheit"])
-        except KeyError as err:
-            logging.exception(err)
-            raise WeatherServiceException from err
+        return float(report["simpleforecast"]["forecastday"][0]["current"]["fahrenheit"])
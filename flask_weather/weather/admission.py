@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from http import HTTPStatus
+
+from flask_weather.exceptions import ProviderSaturatedException, AppErrorCodes
+from flask_weather.helper import metrics
+
+
+def is_throttled(error: Exception) -> bool:
+    """
+    :param error: exception raised by a call to a weather service
+    :return: True if the service answered 429 Too Many Requests
+    """
+    return getattr(error, 'status', None) == HTTPStatus.TOO_MANY_REQUESTS.value
+
+
+def parse_retry_after(value) -> float:
+    """
+    :param value: Retry-After header in seconds, HTTP dates are not supported
+    :return: seconds, None when missing or not a number
+    """
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AdmissionController:
+    """
+    Admission of the calls to one weather service.
+
+    A token bucket of `rate` calls per second, with room for `burst` calls,
+    caps the call rate when a rate is set. An adaptive limit caps the calls in
+    flight: it grows by one every `limit` successful calls and is cut by
+    ADMISSION_BACKOFF, at most once per ADMISSION_BACKOFF_INTERVAL, when the
+    service answers 429 or 5xx or a call takes longer than
+    ADMISSION_LATENCY_TOLERANCE times the fastest recent call. A 429 with a
+    Retry-After header also pauses the service for that long.
+
+    A call that cannot be admitted waits up to ADMISSION_QUEUE_TIMEOUT seconds,
+    then the service is skipped with ProviderSaturatedException. So is a call
+    the service answered with 429: it is not a failure of the service, and is
+    neither cached nor counted by the circuit breaker.
+    """
+    RATE_KEY = 'ADMISSION_RATE'
+    BURST_KEY = 'ADMISSION_BURST'
+    INITIAL_LIMIT_KEY = 'ADMISSION_INITIAL_LIMIT'
+    MIN_LIMIT_KEY = 'ADMISSION_MIN_LIMIT'
+    MAX_LIMIT_KEY = 'ADMISSION_MAX_LIMIT'
+    BACKOFF_KEY = 'ADMISSION_BACKOFF'
+    BACKOFF_INTERVAL_KEY = 'ADMISSION_BACKOFF_INTERVAL'
+    LATENCY_TOLERANCE_KEY = 'ADMISSION_LATENCY_TOLERANCE'
+    QUEUE_TIMEOUT_KEY = 'ADMISSION_QUEUE_TIMEOUT'
+
+    DEFAULT_RATE = 0.0
+    DEFAULT_INITIAL_LIMIT = 8
+    DEFAULT_MIN_LIMIT = 2
+    DEFAULT_MAX_LIMIT = 64
+    DEFAULT_BACKOFF = 0.5
+    DEFAULT_BACKOFF_INTERVAL = 1.0
+    DEFAULT_LATENCY_TOLERANCE = 4.0
+    DEFAULT_QUEUE_TIMEOUT = 0.05
+
+    # Latencies the fastest recent call is taken from
+    LATENCY_WINDOW = 100
+    # Longest pause a Retry-After header can cause
+    MAX_RETRY_AFTER = 30.0
+    # Longest sleep between two admission attempts of a queued async call
+    ASYNC_POLL_INTERVAL = 0.01
+
+    def __init__(self, name: str):
+        self.name = name
+        self.default_rate = float(os.environ.get(self.RATE_KEY, self.DEFAULT_RATE))
+        self.default_max_limit = int(os.environ.get(self.MAX_LIMIT_KEY, self.DEFAULT_MAX_LIMIT))
+        self.rate = self.default_rate
+        self.burst = self._burst(self.rate)
+        self.min_limit = int(os.environ.get(self.MIN_LIMIT_KEY, self.DEFAULT_MIN_LIMIT))
+        self.max_limit = self.default_max_limit
+        self.backoff = float(os.environ.get(self.BACKOFF_KEY, self.DEFAULT_BACKOFF))
+        self.backoff_interval = float(os.environ.get(self.BACKOFF_INTERVAL_KEY,
+                                                     self.DEFAULT_BACKOFF_INTERVAL))
+        self.latency_tolerance = float(os.environ.get(self.LATENCY_TOLERANCE_KEY,
+                                                      self.DEFAULT_LATENCY_TOLERANCE))
+        self.queue_timeout = float(os.environ.get(self.QUEUE_TIMEOUT_KEY,
+                                                  self.DEFAULT_QUEUE_TIMEOUT))
+
+        self.limit = float(min(int(os.environ.get(self.INITIAL_LIMIT_KEY,
+                                                  self.DEFAULT_INITIAL_LIMIT)),
+                               self.max_limit))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._decreased_at = 0.0
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self._condition = threading.Condition()
+
+    def _burst(self, rate: float) -> float:
+        return float(os.environ.get(self.BURST_KEY, 0)) or max(rate, 1.0)
+
+    def configure(self, rate: float = None, max_limit: int = None):
+        """
+        Applies the rate and concurrency settings of the service's ProviderSpec
+        :param rate: calls per second, None for ADMISSION_RATE
+        :param max_limit: most calls in flight, None for ADMISSION_MAX_LIMIT
+        :return:
+        """
+        with self._condition:
+            self.rate = float(rate) if rate is not None else self.default_rate
+            self.burst = self._burst(self.rate)
+            self._tokens = min(self._tokens, self.burst)
+            self.max_limit = int(max_limit) if max_limit is not None else self.default_max_limit
+            self.min_limit = min(self.min_limit, self.max_limit)
+            self.limit = min(self.limit, float(self.max_limit))
+            self._condition.notify_all()
+
+    def _try_admit(self, now: float) -> float:
+        """
+        Admits the call if the service can take it, must hold the condition's lock
+        :return: 0 when admitted, else seconds until it may be worth trying again
+        """
+        if self.paused_until > now:
+            return self.paused_until - now
+
+        if self.in_flight >= int(self.limit):
+            return float('inf')
+
+        if self.rate > 0:
+            self._tokens = min(self._tokens + (now - self._refilled_at) * self.rate, self.burst)
+            self._refilled_at = now
+            if self._tokens < 1.0:
+                return (1.0 - self._tokens) / self.rate
+            self._tokens -= 1.0
+
+        self.in_flight += 1
+        self.admitted += 1
+        return 0.0
+
+    def _reject(self):
+        self.rejected += 1
+        metrics.ADMISSIONS.inc(self.name, 'rejected')
+        return ProviderSaturatedException(
+            AppErrorCodes.WEATHER_SERVICE_ERROR,
+            '{} is saturated: {} calls in flight, limit {}'.format(self.name, self.in_flight,
+                                                                 int(self.limit)))
+
+    def throttled(self, error: Exception) -> ProviderSaturatedException:
+        """
+        :param error: exception of a call the service answered with 429
+        :return: exception to raise instead
+        """
+        metrics.ADMISSIONS.inc(self.name, 'throttled')
+        return ProviderSaturatedException(AppErrorCodes.WEATHER_SERVICE_ERROR,
+                                          '{} is throttling: {}'.format(self.name, error))
+
+    def acquire(self, timeout: float = None):
+        """
+        Waits until the service can take a call
+        :param timeout: seconds to queue, defaults to ADMISSION_QUEUE_TIMEOUT
+        :return: start time of the call, for release
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        now = time.monotonic()
+        deadline = now + timeout
+        with self._condition:
+            wait_for = self._try_admit(now)
+            if wait_for:
+                self.queued += 1
+                metrics.ADMISSIONS.inc(self.name, 'queued')
+            while wait_for:
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise self._reject()
+                self._condition.wait(min(wait_for, remaining))
+                now = time.monotonic()
+                wait_for = self._try_admit(now)
+        return now
+
+    async def acquire_async(self, timeout: float = None):
+        """
+        Same as acquire without blocking the event loop
+        :param timeout: seconds to queue, defaults to ADMISSION_QUEUE_TIMEOUT
+        :return: start time of the call, for release
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        now = time.monotonic()
+        deadline = now + timeout
+        queued = False
+        while True:
+            with self._condition:
+                wait_for = self._try_admit(now)
+                if not wait_for:
+                    return now
+                if not queued:
+                    queued = True
+                    self.queued += 1
+                    metrics.ADMISSIONS.inc(self.name, 'queued')
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise self._reject()
+            await asyncio.sleep(min(wait_for, remaining, self.ASYNC_POLL_INTERVAL))
+            now = time.monotonic()
+
+    def _overloaded(self, latency: float, error) -> bool:
+        status = getattr(error, 'status', None)
+        if status is not None and (status == HTTPStatus.TOO_MANY_REQUESTS.value or
+                                   status >= HTTPStatus.INTERNAL_SERVER_ERROR.value):
+            return True
+
+        return bool(self._latencies) and \
+            latency > self.latency_tolerance * min(self._latencies)
+
+    def release(self, started: float, error: Exception = None):
+        """
+        Ends a call admitted by acquire and adapts the limit to its outcome
+        :param started: return value of acquire
+        :param error: exception the call raised, None on success
+        :return:
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._condition:
+            self.in_flight -= 1
+
+            if self._overloaded(latency, error):
+                self.overloads += 1
+                retry_after = getattr(error, 'retry_after', None)
+                if retry_after and is_throttled(error):
+                    self.paused_until = max(self.paused_until,
+                                            now + min(retry_after, self.MAX_RETRY_AFTER))
+                if now - self._decreased_at >= self.backoff_interval:
+                    self._decreased_at = now
+                    self.decreases += 1
+                    self.limit = max(self.limit * self.backoff, float(self.min_limit))
+                    logging.info('Admission limit of %s cut to %d', self.name, int(self.limit))
+            elif error is None:
+                self._latencies.append(latency)
+                self.limit = min(self.limit + 1.0 / self.limit, float(self.max_limit))
+
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'rate': self.rate or None,
+                'tokens': round(self._tokens, 2) if self.rate else None,
+                'paused_for': round(max(self.paused_until - time.monotonic(), 0.0), 2),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'overloads': self.overloads,
+                'decreases': self.decreases,
+            }
+
+
+class AdmissionControllers:
+    """
+    Admission controllers of the weather services, created on first use and configured
+    with the rate and concurrency settings of each service
+    """
+    ENABLED_KEY = 'ADMISSION_ENABLED'
+
+    def __init__(self):
+        self._controllers = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return os.environ.get(cls.ENABLED_KEY, '1') == '1'
+
+    def get(self, service) -> AdmissionController:
+        """
+        :param service: BaseWeatherService object
+        :return: AdmissionController of the service
+        """
+        entry = self._controllers.get(service.SERVICE_NAME)
+        settings = (service.rate, service.concurrency)
+        if entry is None or entry[1] != settings:
+            with self._lock:
+                entry = self._controllers.get(service.SERVICE_NAME)
+                if entry is None:
+                    entry = (AdmissionController(service.SERVICE_NAME), None)
+                if entry[1] != settings:
+                    entry[0].configure(*settings)
+                    entry = (entry[0], settings)
+                self._controllers[service.SERVICE_NAME] = entry
+        return entry[0]
+
+    def stats(self) -> dict:
+        return {name: entry[0].stats() for name, entry in list(self._controllers.items())}
@@ -0,0 +1,291 @@
+"""
+Aggregation of the weather service readings of a location into one temperature.
+
+Strategies, selected with AGGREGATION_STRATEGY or the `aggregation` request parameter:
+    weighted_mean      mean weighted by provider weight and recent success rate
+    median             median of the readings
+    trimmed_mean       mean without the AGGREGATION_TRIM fraction of highest and lowest readings
+    outlier_rejection  weighted mean of the readings within AGGREGATION_OUTLIER_THRESHOLD
+                       scaled median absolute deviations of the median
+
+A batch of locations is aggregated column-wise: the locations with the same strategy and
+the same services are aggregated together, with one list of readings per service, and
+the weighted mean, the median, the spread and the rounding are mapped over whole
+columns. The trimmed mean and outlier rejection, which drop readings per location,
+are computed location by location. A single location is aggregated on its own, with
+the same arithmetic, so it gets the same result as in a batch.
+"""
+import logging
+import math
+import os
+from collections import OrderedDict, namedtuple
+from itertools import repeat
+from operator import add, itemgetter, mul, sub, truediv
+
+from flask_weather.exceptions import ServiceNotAvailable, AppErrorCodes
+
+STRATEGY_KEY = 'AGGREGATION_STRATEGY'
+TRIM_KEY = 'AGGREGATION_TRIM'
+OUTLIER_THRESHOLD_KEY = 'AGGREGATION_OUTLIER_THRESHOLD'
+OUTLIER_MIN_DEVIATION_KEY = 'AGGREGATION_OUTLIER_MIN_DEVIATION'
+
+WEIGHTED_MEAN = 'weighted_mean'
+MEDIAN = 'median'
+TRIMMED_MEAN = 'trimmed_mean'
+OUTLIER_REJECTION = 'outlier_rejection'
+STRATEGIES = (WEIGHTED_MEAN, MEDIAN, TRIMMED_MEAN, OUTLIER_REJECTION)
+
+DEFAULT_STRATEGY = WEIGHTED_MEAN
+DEFAULT_TRIM = 0.2
+DEFAULT_OUTLIER_THRESHOLD = 3.0
+DEFAULT_OUTLIER_MIN_DEVIATION = 5.0
+
+# Scales the median absolute deviation to the standard deviation of normal data
+MAD_SCALE = 1.4826
+
+Aggregate = namedtuple('Aggregate', ['fahrenheit', 'celsius', 'strategy', 'readings',
+                                     'rejected', 'spread'])
+
+
+def default_strategy() -> str:
+    strategy = os.environ.get(STRATEGY_KEY, DEFAULT_STRATEGY)
+    if strategy not in STRATEGIES:
+        logging.error('Unknown %s %s, using %s', STRATEGY_KEY, strategy, DEFAULT_STRATEGY)
+        return DEFAULT_STRATEGY
+    return strategy
+
+
+def fahrenheit_to_celsius(fahrenheit: float) -> float:
+    return round((fahrenheit - 32) * 5 / 9, 2)
+
+
+def _weighted_mean(values: list, weights: list) -> float:
+    total_weight = sum(weights)
+    if total_weight <= 0:
+        return sum(values) / len(values)
+    return sum(value * weight for value, weight in zip(values, weights)) / total_weight
+
+
+def _median(ordered: list) -> float:
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def _settings() -> tuple:
+    return (float(os.environ.get(TRIM_KEY, DEFAULT_TRIM)),
+            float(os.environ.get(OUTLIER_THRESHOLD_KEY, DEFAULT_OUTLIER_THRESHOLD)),
+            float(os.environ.get(OUTLIER_MIN_DEVIATION_KEY, DEFAULT_OUTLIER_MIN_DEVIATION)))
+
+
+def _aggregate_values(values: list, weights: list, strategy: str, settings: tuple) -> tuple:
+    """
+    :param values: readings of the location
+    :param weights: weights of the readings
+    :return: tuple (fahrenheit, positions of the rejected readings)
+    """
+    trim, threshold, min_deviation = settings
+
+    if strategy == WEIGHTED_MEAN:
+        return _weighted_mean(values, weights), ()
+
+    order = sorted(range(len(values)), key=values.__getitem__)
+    ordered = [values[position] for position in order]
+
+    if strategy == MEDIAN:
+        return _median(ordered), ()
+
+    if strategy == TRIMMED_MEAN:
+        # Trim rounded up, so three readings lose one at each end, always keeping one
+        cut = min(math.ceil(len(ordered) * trim - 1e-9), (len(ordered) - 1) // 2)
+        kept = ordered[cut:len(ordered) - cut]
+        return sum(kept) / len(kept), tuple(order[:cut] + order[len(ordered) - cut:])
+
+    median = _median(ordered)
+    deviation = _median(sorted(abs(value - median) for value in values)) * MAD_SCALE
+    limit = max(threshold * deviation, min_deviation)
+    kept = [position for position, value in enumerate(values) if abs(value - median) <= limit]
+    rejected = tuple(position for position, value in enumerate(values)
+                     if abs(value - median) > limit)
+    return _weighted_mean([values[position] for position in kept],
+                          [weights[position] for position in kept]), rejected
+
+
+def _spread(values: list) -> dict:
+    mean = sum(values) / len(values)
+    return {
+        'min': round(min(values), 2),
+        'max': round(max(values), 2),
+        'range': round(max(values) - min(values), 2),
+        'stdev': round(math.sqrt(sum((value - mean) ** 2 for value in values) / len(values)),
+                       2),
+    }
+
+
+def _aggregate(readings: dict, weights: dict, strategy: str, settings: tuple) -> Aggregate:
+    """
+    :return: Aggregate, None when there is no reading
+    """
+    services = [name for name, value in readings.items() if value is not None]
+    if not services:
+        return None
+
+    values = [float(readings[name]) for name in services]
+    fahrenheit, rejected = _aggregate_values(
+        values, [weights.get(name, 1.0) if weights else 1.0 for name in services],
+        strategy, settings)
+    return Aggregate(
+        fahrenheit=fahrenheit,
+        celsius=fahrenheit_to_celsius(fahrenheit),
+        strategy=strategy,
+        readings=OrderedDict((name, round(value, 2)) for name, value in zip(services, values)),
+        rejected=[services[position] for position in sorted(rejected)],
+        spread=_spread(values))
+
+
+def _column_sum(columns: list) -> list:
+    totals = columns[0]
+    for column in columns[1:]:
+        totals = list(map(add, totals, column))
+    return totals
+
+
+def _column_weighted_mean(columns: list, weights: list) -> list:
+    """
+    :param columns: one list of readings per service
+    :param weights: weight of each service
+    :return: weighted mean of each location
+    """
+    total_weight = sum(weights)
+    if total_weight <= 0:
+        return list(map(truediv, _column_sum(columns), repeat(len(columns))))
+    return list(map(truediv, _column_sum([list(map(mul, column, repeat(weight)))
+                                          for column, weight in zip(columns, weights)]),
+                    repeat(total_weight)))
+
+
+def _column_median(columns: list) -> list:
+    if len(columns) == 1:
+        return columns[0]
+
+    ordered = list(map(sorted, zip(*columns)))
+    middle = len(columns) // 2
+    if len(columns) % 2:
+        return list(map(itemgetter(middle), ordered))
+    return list(map(truediv, map(add, map(itemgetter(middle - 1), ordered),
+                                 map(itemgetter(middle), ordered)), repeat(2)))
+
+
+def _column_spread(columns: list) -> list:
+    """
+    :return: dict of the min, max, range and standard deviation of each location
+    """
+    if len(columns) == 1:
+        lowest = highest = columns[0]
+    else:
+        lowest, highest = list(map(min, *columns)), list(map(max, *columns))
+    means = list(map(truediv, _column_sum(columns), repeat(len(columns))))
+    deviations = [list(map(sub, column, means)) for column in columns]
+    variances = map(truediv, _column_sum([list(map(mul, deviation, deviation))
+                                          for deviation in deviations]),
+                    repeat(len(columns)))
+    return [{'min': low, 'max': high, 'range': spread_range, 'stdev': stdev}
+            for low, high, spread_range, stdev in zip(
+                map(round, lowest, repeat(2)), map(round, highest, repeat(2)),
+                map(round, map(sub, highest, lowest), repeat(2)),
+                map(round, map(math.sqrt, variances), repeat(2)))]
+
+
+def _aggregate_columns(services: tuple, rows: list, weights: dict, strategy: str,
+                       settings: tuple) -> list:
+    """
+    Aggregates locations that have readings of the same services
+    :param services: names of the services, in the order of the readings
+    :param rows: dicts of service name to temperature in fahrenheit
+    :return: list with an Aggregate per row
+    """
+    columns = [[float(readings[name]) for readings in rows] for name in services]
+    column_weights = [weights.get(name, 1.0) if weights else 1.0 for name in services]
+
+    if strategy == WEIGHTED_MEAN:
+        fahrenheit, rejected = _column_weighted_mean(columns, column_weights), None
+    elif strategy == MEDIAN:
+        fahrenheit, rejected = _column_median(columns), None
+    else:
+        results = [_aggregate_values(list(values), column_weights, strategy, settings)
+                   for values in zip(*columns)]
+        fahrenheit = [result[0] for result in results]
+        rejected = [[services[position] for position in sorted(result[1])]
+                    for result in results]
+
+    count = len(rows)
+    readings = map(OrderedDict, map(zip, repeat(services), zip(
+        *[list(map(round, column, repeat(2))) for column in columns])))
+    # Same arithmetic as fahrenheit_to_celsius
+    celsius = map(round, map(truediv, map(mul, map(sub, fahrenheit, repeat(32)), repeat(5)),
+                             repeat(9)), repeat(2))
+    return list(map(Aggregate._make, zip(
+        fahrenheit, celsius, repeat(strategy, count), readings,
+        rejected if rejected is not None else map(list, repeat((), count)),
+        _column_spread(columns))))
+
+
+def aggregate_batch(rows: list, strategies: list, weights: dict = None) -> list:
+    """
+    Aggregates the readings of many locations, column-wise for each group of locations
+    with the same strategy and services
+    :param rows: list of dicts of service name to temperature in fahrenheit
+    :param strategies: strategy of each row, None for the default
+    :param weights: dict of service name to weight of its readings
+    :return: list with an Aggregate per row, None for rows without any reading
+    """
+    default, settings = default_strategy(), _settings()
+    groups = OrderedDict()
+    for index, (readings, strategy) in enumerate(zip(rows, strategies)):
+        if None in readings.values():
+            services = tuple(name for name, value in readings.items() if value is not None)
+        else:
+            services = tuple(readings)
+        groups.setdefault((strategy or default, services), []).append(index)
+
+    aggregates = [None] * len(rows)
+    for (strategy, services), indices in groups.items():
+        if not services:
+            continue
+        group = _aggregate_columns(services, [rows[index] for index in indices], weights,
+                                   strategy, settings)
+        for index, aggregate in zip(indices, group):
+            aggregates[index] = aggregate
+    return aggregates
+
+
+def aggregate_temperature(readings: dict, weights: dict = None,
+                          strategy: str = None) -> Aggregate:
+    """
+    Aggregates the readings of the weather services for one location
+    :param readings: dict of service name to temperature in fahrenheit
+    :param weights: dict of service name to weight of its reading, defaults to equal weights
+    :param strategy: one of STRATEGIES, defaults to AGGREGATION_STRATEGY
+    :return: Aggregate
+    """
+    aggregate = _aggregate(readings, weights, strategy or default_strategy(), _settings())
+    if aggregate is None:
+        raise ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
+                                  "No weather service available")
+    return aggregate
+
+
+def provider_weights(weather_services: dict, circuit_breakers=None) -> dict:
+    """
+    Weight of each service's readings: its configured weight times the fraction of its
+    recent calls that succeeded
+    :param weather_services: dict of service name to BaseWeatherService object
+    :param circuit_breakers: CircuitBreakers, None to use the configured weights only
+    :return: dict of service name to weight
+    """
+    if circuit_breakers is None:
+        return {name: service.weight for name, service in weather_services.items()}
+
+    return {name: service.weight * circuit_breakers.get(name).success_rate()
+            for name, service in weather_services.items()}
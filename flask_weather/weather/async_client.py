@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from http import HTTPStatus
+
+import aiohttp
+
+from flask_weather.exceptions import ProviderSkippedException, WeatherServiceException
+from flask_weather.helper import metrics, tracing
+from flask_weather.weather.admission import is_throttled
+from flask_weather.weather.fanout import FanoutResult, ProviderFanout
+
+
+async def fetch_current_temperature(service, session: aiohttp.ClientSession,
+                                    latitude: float, longitude: float) -> float:
+    """
+    For a given location gets the current temperature in fahrenheit from a weather service
+    without blocking the event loop
+    :param service: BaseWeatherService object, describes the request and parses the report
+    :param session: aiohttp.ClientSession object
+    :param latitude:
+    :param longitude:
+    :return: temperature in fahrenheit
+    """
+    method, url, kwargs = service._build_request(latitude, longitude)
+    if service.timeout is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(sock_read=service.timeout)
+    tracing.inject(kwargs)
+
+    with metrics.timed_call(metrics.PROVIDER_SECONDS, service.SERVICE_NAME):
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status != HTTPStatus.OK.value:
+                    raise service.status_error(response.status, response.headers)
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise service.service_error('request failed: {!r}'.format(err)) from err
+
+        with tracing.span(service.SERVICE_NAME + ':decode'):
+            report = json.loads(text)
+        return service.temperature_from_report(report)
+
+
+class AsyncProviderFanout:
+    """
+    Queries weather services concurrently on the event loop with a per-request deadline,
+    reading through the same ReadingCache, and adding to the same ReadingIndex, as ProviderFanout
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, deadline: float = None,
+                 reading_cache=None, single_flight=None, circuit_breakers=None, hedgers=None,
+                 admission=None, reading_index=None):
+        self.session = session
+        self.deadline = deadline or ProviderFanout.default_deadline()
+        self.reading_cache = reading_cache
+        self.single_flight = single_flight
+        self.circuit_breakers = circuit_breakers
+        self.hedgers = hedgers
+        self.admission = admission
+        self.reading_index = reading_index
+
+    async def _fetch_upstream(self, service, latitude: float, longitude: float) -> float:
+        if self.admission is None:
+            return await fetch_current_temperature(service, self.session, latitude, longitude)
+
+        controller = self.admission.get(service)
+        started = await controller.acquire_async()
+        try:
+            result = await fetch_current_temperature(service, self.session, latitude, longitude)
+        except Exception as err:
+            controller.release(started, err)
+            if is_throttled(err):
+                raise controller.throttled(err) from err
+            raise
+        except BaseException:
+            controller.release(started, asyncio.CancelledError())
+            raise
+        controller.release(started)
+        return result
+
+    async def _hedged_upstream(self, service, latitude: float, longitude: float) -> float:
+        if self.hedgers is None:
+            return await self._fetch_upstream(service, latitude, longitude)
+
+        return await self.hedgers.get(service.SERVICE_NAME).call_async(
+            lambda: self._fetch_upstream(service, latitude, longitude))
+
+    async def _call_upstream(self, service, latitude: float, longitude: float) -> float:
+        if self.circuit_breakers is None:
+            value = await self._hedged_upstream(service, latitude, longitude)
+        else:
+            value = await self.circuit_breakers.get(service.SERVICE_NAME).call_async(
+                lambda: self._hedged_upstream(service, latitude, longitude))
+
+        if self.reading_index is not None:
+            self.reading_index.add(service.SERVICE_NAME, latitude, longitude, value)
+        return value
+
+    async def _call_service(self, service, latitude: float, longitude: float) -> float:
+        if self.single_flight is None:
+            return await self._call_upstream(service, latitude, longitude)
+
+        return await self.single_flight.do(
+            (service.SERVICE_NAME, latitude, longitude),
+            lambda: self._call_upstream(service, latitude, longitude))
+
+    async def _fetch(self, service, latitude: float, longitude: float) -> float:
+        if self.reading_cache is None:
+            return await self._call_service(service, latitude, longitude)
+
+        return await self.reading_cache.get_or_load_async(
+            service.SERVICE_NAME, latitude, longitude,
+            lambda: self._call_upstream(service, latitude, longitude), self.single_flight)
+
+    async def fan_out(self, weather_services: dict, latitude: float, longitude: float,
+                      deadline: float = None) -> FanoutResult:
+        """
+        Gets the current temperature from all the given services concurrently
+        :param weather_services: dict of service name to BaseWeatherService object
+        :param latitude:
+        :param longitude:
+        :param deadline: seconds to wait for the services, defaults to self.deadline
+        :return: FanoutResult object
+        """
+        tasks = OrderedDict()
+        for name, service in weather_services.items():
+            tasks[name] = asyncio.ensure_future(self._fetch(service, latitude, longitude))
+
+        await asyncio.wait(tasks.values(), timeout=deadline or self.deadline)
+
+        result = FanoutResult()
+        for name, task in tasks.items():
+            if not task.done():
+                task.cancel()
+                logging.warning('%s did not respond before the deadline', name)
+                result.timed_out.append(name)
+                continue
+
+            try:
+                result.readings[name] = task.result()
+            except ProviderSkippedException as err:
+                logging.debug('%s skipped: %s', name, err)
+                result.skipped.append(name)
+            except WeatherServiceException as err:
+                logging.warning('%s failed: %s', name, err)
+                result.failed.append(name)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.exception(err)
+                result.failed.append(name)
+
+        return result
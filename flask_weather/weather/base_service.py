@@ -1,14 +1,123 @@
+import json
+import logging
 from abc import ABC
 from abc import abstractmethod
+from http import HTTPStatus
+
+import requests
+
+from flask_weather.exceptions import WeatherServiceException, AppErrorCodes
+from flask_weather.helper import metrics, tracing
+from flask_weather.helper.http_transport import get_transport
+from flask_weather.weather.admission import parse_retry_after
 
 
 class BaseWeatherService(ABC):
     """
-    Base class for weather services
+    Base class for weather services.
+
+    Subclasses describe the request for a location with `_build_request` and
+    pick the temperature out of the report with `_parse_temperature`, so the
+    same service can be called by the pooled HTTP transport or asynchronously.
     """
     SERVICE_NAME = None
     BASE_URL_KEY = None
 
+    def __init__(self, transport=None):
+        self.http = transport or get_transport()
+        self.timeout = None
+        self.weight = 1.0
+        self.concurrency = None
+        self.rate = None
+
+    def configure(self, timeout: float = None, weight: float = 1.0, concurrency: int = None,
+                  rate: float = None):
+        """
+        Applies the settings of the service's ProviderSpec
+        :param timeout: read timeout in seconds, None for the transport's default
+        :param weight: weight of the service's readings in the average
+        :param concurrency: most calls in flight at a time, None for ADMISSION_MAX_LIMIT
+        :param rate: most calls per second, None for ADMISSION_RATE
+        :return:
+        """
+        self.timeout = timeout
+        self.weight = weight
+        self.concurrency = concurrency
+        self.rate = rate
+
+    @abstractmethod
+    def _build_request(self, latitude: float, longitude: float) -> tuple:
+        """
+        Describes the request for the current weather of a location
+        :param latitude:
+        :param longitude:
+        :return: tuple (method, url, keyword arguments for the request)
+        """
+
     @abstractmethod
-    def get_current_temperature(self, latitude: float, longitude: float):
-        pass
+    def _parse_temperature(self, report: dict) -> float:
+        """
+        Picks the current temperature out of the weather report
+        :param report: json data
+        :return: temperature in fahrenheit
+        """
+
+    def service_error(self, message: str, status: int = None,
+                      retry_after: float = None) -> WeatherServiceException:
+        return WeatherServiceException(AppErrorCodes.WEATHER_SERVICE_ERROR,
+                                       '{} {}'.format(self.SERVICE_NAME, message),
+                                       status, retry_after)
+
+    def status_error(self, status: int, headers) -> WeatherServiceException:
+        """
+        :param status: HTTP status other than 200 the service answered with
+        :param headers: response headers
+        :return: WeatherServiceException with the status and Retry-After of the response
+        """
+        return self.service_error('returned {}'.format(status), status,
+                                  parse_retry_after(headers.get('Retry-After')))
+
+    def _get_current_weather(self, latitude: float, longitude: float):
+        """
+        For a given location gets the current weather report from the service
+        :param latitude:
+        :param longitude:
+        :return: json data
+        """
+        method, url, kwargs = self._build_request(latitude, longitude)
+        if self.timeout is not None:
+            kwargs['timeout'] = (self.http.timeout[0], self.timeout)
+        tracing.inject(kwargs)
+
+        try:
+            response = self.http.request(method, url, idempotent=True, **kwargs)
+        except requests.RequestException as err:
+            raise self.service_error('request failed: {}'.format(err)) from err
+
+        if response.status_code == HTTPStatus.OK.value:
+            with tracing.span(self.SERVICE_NAME + ':decode'):
+                return json.loads(response.text)
+
+        raise self.status_error(response.status_code, response.headers)
+
+    def temperature_from_report(self, report: dict) -> float:
+        """
+        :param report: json data
+        :return: temperature in fahrenheit
+        """
+        try:
+            return self._parse_temperature(report)
+        except (KeyError, IndexError, TypeError, ValueError) as err:
+            logging.exception(err)
+            raise self.service_error('returned an unexpected report') from err
+
+    def get_current_temperature(self, latitude: float, longitude: float) -> float:
+        """
+        For a given location gets the current temperature in fahrenheit from the service
+        :param latitude:
+        :param longitude:
+        :return: temperature in fahrenheit
+        """
+        with metrics.timed_call(metrics.PROVIDER_SECONDS, self.SERVICE_NAME):
+            report = self._get_current_weather(latitude, longitude)
+            return self.temperature_from_report(report)
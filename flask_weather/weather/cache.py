@@ -0,0 +1,302 @@
+import logging
+import os
+import re
+import threading
+import time
+from flask_weather.exceptions import WeatherServiceException, ProviderSkippedException
+from flask_weather.helper.cache_backends import create_backend
+
+
+class ReadingCache:
+    """
+    TTL and LRU bounded cache of weather service readings.
+
+    Readings are keyed on (service name, latitude, longitude) with the location
+    snapped to a grid of `grid` degrees, so nearby requests share an entry.
+    Failures of a service are cached for `error_ttl` seconds so that a service
+    that is down is not called on every request. Calls rejected by a circuit
+    breaker or an admission controller are not cached, they decide when to try again.
+
+    When a refresher is set, readings that expired less than `stale_ttl`
+    seconds ago are still served while the refresher fetches a new reading in
+    the background (stale-while-revalidate).
+
+    Entries are kept in a CacheBackend, selected with CACHE_BACKEND, so worker
+    processes can share readings. The LRU bound `max_entries` applies to the
+    in-process backend.
+    """
+    GRID_KEY = 'CACHE_GRID_DEGREES'
+    TTL_KEY = 'CACHE_TTL'
+    ERROR_TTL_KEY = 'CACHE_ERROR_TTL'
+    MAX_ENTRIES_KEY = 'CACHE_MAX_ENTRIES'
+    STALE_TTL_KEY = 'CACHE_STALE_TTL'
+
+    DEFAULT_GRID = 0.01
+    DEFAULT_TTL = 300.0
+    DEFAULT_ERROR_TTL = 30.0
+    DEFAULT_MAX_ENTRIES = 10000
+    DEFAULT_STALE_TTL = 60.0
+
+    def __init__(self, grid: float = None, ttl: float = None, error_ttl: float = None,
+                 max_entries: int = None, service_ttls: dict = None, stale_ttl: float = None,
+                 backend=None):
+        self.grid = grid or float(os.environ.get(self.GRID_KEY, self.DEFAULT_GRID))
+        self.ttl = ttl if ttl is not None else float(os.environ.get(self.TTL_KEY,
+                                                                    self.DEFAULT_TTL))
+        self.error_ttl = error_ttl if error_ttl is not None else \
+            float(os.environ.get(self.ERROR_TTL_KEY, self.DEFAULT_ERROR_TTL))
+        self.max_entries = max_entries or int(os.environ.get(self.MAX_ENTRIES_KEY,
+                                                             self.DEFAULT_MAX_ENTRIES))
+        self.service_ttls = dict(service_ttls or {})
+        self.stale_ttl = stale_ttl if stale_ttl is not None else \
+            float(os.environ.get(self.STALE_TTL_KEY, self.DEFAULT_STALE_TTL))
+        self.refresher = None
+        self.backend = backend or create_backend('readings', self.max_entries)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.error_hits = 0
+        self.expirations = 0
+
+    def get_ttl(self, service_name: str) -> float:
+        """
+        TTL of a service, can be overridden per service with CACHE_TTL_<SERVICE NAME>,
+        example: CACHE_TTL_WEATHER_COM=60
+        :param service_name:
+        :return: TTL in seconds
+        """
+        if service_name not in self.service_ttls:
+            env_key = '{}_{}'.format(self.TTL_KEY, re.sub(r'\W', '_', service_name).upper())
+            self.service_ttls[service_name] = float(os.environ.get(env_key, self.ttl))
+
+        return self.service_ttls[service_name]
+
+    def make_key(self, service_name: str, latitude: float, longitude: float) -> tuple:
+        """
+        Snaps the location to the grid
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :return: tuple (service_name, latitude cell, longitude cell)
+        """
+        return service_name, round(latitude / self.grid), round(longitude / self.grid)
+
+    def _lookup(self, key: tuple, now: float):
+        entry = self.backend.get(key)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if entry[0] <= now:
+            if self.refresher is not None and entry[2] is None and \
+                    now < entry[0] + self.stale_ttl:
+                with self._lock:
+                    self.stale_hits += 1
+                return entry
+
+            self.backend.delete(key)
+            with self._lock:
+                self.expirations += 1
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if entry[2] is not None:
+                self.error_hits += 1
+        return entry
+
+    def _store(self, key: tuple, ttl: float, value, error):
+        """
+        :param error: WeatherServiceException or None
+        """
+        if ttl <= 0:
+            return
+
+        if error is not None:
+            error = (error.error_code, error.message)
+        self.backend.set(key, (time.time() + ttl, value, error))
+
+    def expires_in(self, service_name: str, latitude: float, longitude: float):
+        """
+        Seconds until the cached reading of a service for a location expires
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :return: seconds, negative once expired, None if nothing is cached
+        """
+        entry = self.backend.get(self.make_key(service_name, latitude, longitude))
+        if entry is None or entry[2] is not None:
+            return None
+        return entry[0] - time.time()
+
+    def peek(self, service_name: str, latitude: float, longitude: float):
+        """
+        Cached entry of a service for a location, without counting a hit or a miss
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :return: tuple (temperature in fahrenheit, None for a cached failure, time() it was
+                 fetched at, time() it expires at), None if nothing is cached
+        """
+        entry = self.backend.get(self.make_key(service_name, latitude, longitude))
+        if entry is None:
+            return None
+        expires_at, value, error = entry
+        ttl = self.error_ttl if error is not None else self.get_ttl(service_name)
+        return value, expires_at - ttl, expires_at
+
+    def _revalidate(self, entry: tuple, service_name: str, latitude: float, longitude: float,
+                    now: float):
+        """
+        Asks the refresher for a new reading when a stale entry is served
+        """
+        if entry[0] <= now:
+            self.refresher.request_refresh(service_name, latitude, longitude)
+
+    @staticmethod
+    def _entry_value(entry: tuple):
+        """
+        :param entry: tuple (expires at, value, (error code, message) or None)
+        :return: the cached reading, raises the cached failure
+        """
+        _, value, error = entry
+        if error is not None:
+            raise WeatherServiceException(*error)
+        return value
+
+    def get_or_load(self, service_name: str, latitude: float, longitude: float, loader,
+                    single_flight=None):
+        """
+        Returns the cached reading of a service for a location, calls `loader` on a miss.
+        The lock is not held while `loader` runs. With a SingleFlight, concurrent misses
+        share one call of `loader`, whose reading is stored before the flight ends
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :param loader: callable returning the temperature in fahrenheit
+        :param single_flight: SingleFlight coalescing the loads of an entry
+        :return: temperature in fahrenheit
+        """
+        key = self.make_key(service_name, latitude, longitude)
+        now = time.time()
+        entry = self._lookup(key, now)
+        if entry is not None:
+            self._revalidate(entry, service_name, latitude, longitude, now)
+            return self._entry_value(entry)
+
+        if single_flight is None:
+            return self._load(key, service_name, loader)
+        return single_flight.do(key, lambda: self._load_missing(key, service_name, loader))
+
+    def _fresh_entry(self, key: tuple):
+        """
+        :return: the entry of key if it has not expired, None otherwise
+        """
+        entry = self.backend.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry
+
+    def _load_missing(self, key: tuple, service_name: str, loader):
+        """
+        Loads an entry in a flight, unless the flight that ended just before stored it
+        """
+        entry = self._fresh_entry(key)
+        if entry is not None:
+            return self._entry_value(entry)
+        return self._load(key, service_name, loader)
+
+    def _load(self, key: tuple, service_name: str, loader):
+        try:
+            value = loader()
+        except ProviderSkippedException:
+            raise
+        except WeatherServiceException as err:
+            self._store(key, self.error_ttl, None, err)
+            raise
+
+        self._store(key, self.get_ttl(service_name), value, None)
+        return value
+
+    def refresh(self, service_name: str, latitude: float, longitude: float, loader,
+                single_flight=None):
+        """
+        Calls `loader` and replaces the cached reading, even if it has not expired
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :param loader: callable returning the temperature in fahrenheit
+        :param single_flight: SingleFlight coalescing the loads of an entry
+        :return: temperature in fahrenheit
+        """
+        key = self.make_key(service_name, latitude, longitude)
+        logging.debug('Refreshing %s', key)
+        if single_flight is None:
+            return self._load(key, service_name, loader)
+        return single_flight.do(key, lambda: self._load(key, service_name, loader))
+
+    async def get_or_load_async(self, service_name: str, latitude: float, longitude: float,
+                                loader, single_flight=None):
+        """
+        Same as get_or_load for a coroutine function `loader` and an AsyncSingleFlight
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :param loader: coroutine function returning the temperature in fahrenheit
+        :param single_flight: AsyncSingleFlight coalescing the loads of an entry
+        :return: temperature in fahrenheit
+        """
+        key = self.make_key(service_name, latitude, longitude)
+        now = time.time()
+        entry = self._lookup(key, now)
+        if entry is not None:
+            self._revalidate(entry, service_name, latitude, longitude, now)
+            return self._entry_value(entry)
+
+        if single_flight is None:
+            return await self._load_async(key, service_name, loader)
+        return await single_flight.do(
+            key, lambda: self._load_missing_async(key, service_name, loader))
+
+    async def _load_missing_async(self, key: tuple, service_name: str, loader):
+        entry = self._fresh_entry(key)
+        if entry is not None:
+            return self._entry_value(entry)
+        return await self._load_async(key, service_name, loader)
+
+    async def _load_async(self, key: tuple, service_name: str, loader):
+        try:
+            value = await loader()
+        except ProviderSkippedException:
+            raise
+        except WeatherServiceException as err:
+            self._store(key, self.error_ttl, None, err)
+            raise
+
+        self._store(key, self.get_ttl(service_name), value, None)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        """
+        Hit, miss and expiration counters of this process, and the statistics of the backend
+        :return: dict
+        """
+        hits = self.hits + self.stale_hits
+        lookups = hits + self.misses
+        stats = self.backend.stats()
+        stats.update({
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'error_hits': self.error_hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+        })
+        return stats
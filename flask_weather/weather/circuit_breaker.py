@@ -0,0 +1,263 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from flask_weather.exceptions import CircuitOpenException, ProviderSkippedException, \
+    AppErrorCodes
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one weather service.
+
+    Calls are tracked over a rolling window of `window` seconds. Once at least
+    `min_calls` calls were made, the circuit opens when the error rate or the
+    rate of calls slower than `slow_call` seconds reaches its threshold. An open
+    circuit rejects calls for `cooldown` seconds, then lets `probes` calls
+    through (half open). The circuit closes when all of them succeed and opens
+    again when any of them fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    WINDOW_KEY = 'BREAKER_WINDOW'
+    MIN_CALLS_KEY = 'BREAKER_MIN_CALLS'
+    ERROR_RATE_KEY = 'BREAKER_ERROR_RATE'
+    SLOW_CALL_KEY = 'BREAKER_SLOW_CALL'
+    SLOW_RATE_KEY = 'BREAKER_SLOW_RATE'
+    COOLDOWN_KEY = 'BREAKER_COOLDOWN'
+    PROBES_KEY = 'BREAKER_PROBES'
+
+    DEFAULT_WINDOW = 60.0
+    DEFAULT_MIN_CALLS = 10
+    DEFAULT_ERROR_RATE = 0.5
+    DEFAULT_SLOW_CALL = 2.0
+    DEFAULT_SLOW_RATE = 0.8
+    DEFAULT_COOLDOWN = 30.0
+    DEFAULT_PROBES = 3
+
+    MAX_CALLS = 1000
+
+    def __init__(self, name: str):
+        self.name = name
+        self.window = float(os.environ.get(self.WINDOW_KEY, self.DEFAULT_WINDOW))
+        self.min_calls = int(os.environ.get(self.MIN_CALLS_KEY, self.DEFAULT_MIN_CALLS))
+        self.error_rate = float(os.environ.get(self.ERROR_RATE_KEY, self.DEFAULT_ERROR_RATE))
+        self.slow_call = float(os.environ.get(self.SLOW_CALL_KEY, self.DEFAULT_SLOW_CALL))
+        self.slow_rate = float(os.environ.get(self.SLOW_RATE_KEY, self.DEFAULT_SLOW_RATE))
+        self.cooldown = float(os.environ.get(self.COOLDOWN_KEY, self.DEFAULT_COOLDOWN))
+        self.probes = int(os.environ.get(self.PROBES_KEY, self.DEFAULT_PROBES))
+
+        self.state = self.CLOSED
+        self.reason = None
+        self.opened_at = None
+        self.rejected = 0
+        self._calls = deque(maxlen=self.MAX_CALLS)
+        self._probes_started = 0
+        self._probes_succeeded = 0
+        self._success_rate = (1.0, 0.0)
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _open(self, now: float, reason: str):
+        logging.warning('Opening circuit of %s: %s', self.name, reason)
+        self.state = self.OPEN
+        self.reason = reason
+        self.opened_at = now
+
+    def allow_request(self) -> bool:
+        """
+        Whether the service may be called now, a True in half open state starts a probe
+        :return: bool
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                logging.info('Circuit of %s half open, probing', self.name)
+                self.state = self.HALF_OPEN
+                self._probes_started = 0
+                self._probes_succeeded = 0
+
+            if self.state == self.HALF_OPEN and self._probes_started < self.probes:
+                self._probes_started += 1
+                return True
+
+            self.rejected += 1
+            return False
+
+    def abandon(self):
+        """
+        Releases the probe of a call that was cancelled before it finished
+        :return:
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes_started > self._probes_succeeded:
+                self._probes_started -= 1
+
+    def call(self, func):
+        """
+        Calls `func` if the circuit allows it and records the outcome
+        :param func: callable without arguments
+        :return: the return value of func
+        """
+        if not self.allow_request():
+            raise CircuitOpenException(AppErrorCodes.WEATHER_SERVICE_ERROR,
+                                       '{} circuit is {}: {}'.format(self.name, self.state,
+                                                                     self.reason))
+
+        start = time.monotonic()
+        try:
+            result = func()
+        except ProviderSkippedException:
+            self.abandon()
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - start)
+            raise
+
+        self.record(True, time.monotonic() - start)
+        return result
+
+    async def call_async(self, coro_func):
+        """
+        Same as call for a coroutine function
+        :param coro_func: coroutine function without arguments
+        :return: the result of the coroutine
+        """
+        if not self.allow_request():
+            raise CircuitOpenException(AppErrorCodes.WEATHER_SERVICE_ERROR,
+                                       '{} circuit is {}: {}'.format(self.name, self.state,
+                                                                     self.reason))
+
+        start = time.monotonic()
+        try:
+            result = await coro_func()
+        except ProviderSkippedException:
+            self.abandon()
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - start)
+            raise
+        except BaseException:
+            self.abandon()
+            raise
+
+        self.record(True, time.monotonic() - start)
+        return result
+
+    def record(self, success: bool, latency: float):
+        """
+        Records the outcome of a call
+        :param success: False if the call raised
+        :param latency: seconds the call took
+        :return:
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, success, latency))
+
+            if self.state == self.HALF_OPEN:
+                if not success:
+                    self._open(now, 'probe failed')
+                    return
+                self._probes_succeeded += 1
+                if self._probes_succeeded >= self.probes:
+                    logging.info('Closing circuit of %s', self.name)
+                    self.state = self.CLOSED
+                    self.reason = None
+                    self._calls.clear()
+                return
+
+            if self.state != self.CLOSED:
+                return
+
+            self._prune(now)
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+
+            errors = sum(1 for _, ok, _ in self._calls if not ok)
+            slow = sum(1 for _, _, elapsed in self._calls if elapsed >= self.slow_call)
+            if errors / total >= self.error_rate:
+                self._open(now, 'error rate {:.2f} over {} calls'.format(errors / total, total))
+            elif slow / total >= self.slow_rate:
+                self._open(now, 'slow call rate {:.2f} over {} calls'.format(slow / total,
+                                                                             total))
+
+    def success_rate(self) -> float:
+        """
+        Fraction of the calls in the window that succeeded, 1.0 until `min_calls` calls
+        were made. Recomputed at most once a second
+        :return: float
+        """
+        now = time.monotonic()
+        rate, computed_at = self._success_rate
+        if now - computed_at < 1.0:
+            return rate
+
+        with self._lock:
+            self._prune(now)
+            total = len(self._calls)
+            errors = sum(1 for _, ok, _ in self._calls if not ok)
+        rate = 1.0 - errors / total if total >= self.min_calls else 1.0
+        self._success_rate = (rate, now)
+        return rate
+
+    def stats(self) -> dict:
+        """
+        State and rolling statistics of the breaker
+        :return: dict
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            calls = list(self._calls)
+            state, reason, opened_at = self.state, self.reason, self.opened_at
+
+        latencies = sorted(elapsed for _, _, elapsed in calls)
+        errors = sum(1 for _, ok, _ in calls if not ok)
+
+        def _percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)], 4)
+
+        return {
+            'state': state,
+            'reason': reason,
+            'open_for': round(now - opened_at, 1) if state != self.CLOSED else None,
+            'rejected': self.rejected,
+            'calls': len(calls),
+            'error_rate': round(errors / len(calls), 4) if calls else 0.0,
+            'latency_p50': _percentile(0.5),
+            'latency_p95': _percentile(0.95),
+        }
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers of the weather services, created on first use
+    """
+
+    def __init__(self):
+        self._breakers = dict()
+        self._lock = threading.Lock()
+
+    def get(self, service_name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(service_name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(service_name, CircuitBreaker(service_name))
+        return breaker
+
+    def stats(self) -> dict:
+        return {name: breaker.stats() for name, breaker in list(self._breakers.items())}
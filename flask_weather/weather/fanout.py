@@ -0,0 +1,212 @@
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from flask_weather.exceptions import ProviderSkippedException, WeatherServiceException
+from flask_weather.helper import tracing
+from flask_weather.weather.admission import is_throttled
+
+
+MEASURED = 'measured'
+
+
+class FanoutResult:
+    """
+    Outcome of querying a set of weather services for one location
+    """
+    source = MEASURED
+
+    def __init__(self):
+        self.readings = OrderedDict()
+        self.failed = list()
+        self.skipped = list()
+        self.timed_out = list()
+
+    @property
+    def responded(self) -> list:
+        """
+        Names of the services that returned a reading before the deadline
+        :return: list of service names
+        """
+        return list(self.readings.keys())
+
+
+class ProviderFanout:
+    """
+    Queries weather services concurrently on a shared, bounded worker pool.
+
+    Every call to `fan_out` waits at most `deadline` seconds; services that
+    have not answered by then are reported as timed out and their readings
+    are left out of the result. When a ReadingCache is given, readings are
+    served from it and only misses reach the services. When a SingleFlight is
+    given, concurrent lookups of the same service and location share one call.
+    When CircuitBreakers are given, services with an open circuit are skipped.
+    When Hedgers are given, slow calls to a service are sent a second time.
+    When AdmissionControllers are given, calls to a service that is at its rate or
+    concurrency limit queue briefly, then the service is skipped.
+    When a ReadingIndex is given, every reading fetched from a service is added to it.
+    The calls of a traced request run in its trace.
+    """
+    MAX_WORKERS_KEY = 'FANOUT_MAX_WORKERS'
+    DEADLINE_KEY = 'FANOUT_DEADLINE'
+
+    DEFAULT_MAX_WORKERS = 32
+    DEFAULT_DEADLINE = 2.0
+
+    def __init__(self, max_workers: int = None, deadline: float = None, reading_cache=None,
+                 single_flight=None, circuit_breakers=None, hedgers=None, admission=None,
+                 reading_index=None):
+        self.max_workers = max_workers or int(os.environ.get(self.MAX_WORKERS_KEY,
+                                                             self.DEFAULT_MAX_WORKERS))
+        self.deadline = deadline or self.default_deadline()
+        self.reading_cache = reading_cache
+        self.single_flight = single_flight
+        self.circuit_breakers = circuit_breakers
+        self.hedgers = hedgers
+        self.admission = admission
+        self.reading_index = reading_index
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix='fanout')
+
+    @classmethod
+    def default_deadline(cls) -> float:
+        return float(os.environ.get(cls.DEADLINE_KEY, cls.DEFAULT_DEADLINE))
+
+    def _call_upstream(self, service, latitude: float, longitude: float):
+        """
+        Calls the service through its circuit breaker
+        :param service: BaseWeatherService object
+        :param latitude:
+        :param longitude:
+        :return: temperature in fahrenheit
+        """
+        if self.circuit_breakers is None:
+            value = self._hedged_upstream(service, latitude, longitude)
+        else:
+            value = self.circuit_breakers.get(service.SERVICE_NAME).call(
+                lambda: self._hedged_upstream(service, latitude, longitude))
+
+        if self.reading_index is not None:
+            self.reading_index.add(service.SERVICE_NAME, latitude, longitude, value)
+        return value
+
+    def _hedged_upstream(self, service, latitude: float, longitude: float):
+        """
+        Calls the service, a second time if the first call is slow
+        """
+        if self.hedgers is None:
+            return self._fetch_upstream(service, latitude, longitude)
+
+        return self.hedgers.get(service.SERVICE_NAME).call(
+            lambda: self._fetch_upstream(service, latitude, longitude))
+
+    def _fetch_upstream(self, service, latitude: float, longitude: float):
+        """
+        Calls the service once its admission controller admits the call
+        """
+        if self.admission is None:
+            return service.get_current_temperature(latitude, longitude)
+
+        controller = self.admission.get(service)
+        started = controller.acquire()
+        try:
+            result = service.get_current_temperature(latitude, longitude)
+        except Exception as err:
+            controller.release(started, err)
+            if is_throttled(err):
+                raise controller.throttled(err) from err
+            raise
+        controller.release(started)
+        return result
+
+    def _call_service(self, service, latitude: float, longitude: float):
+        """
+        Calls the service, concurrent calls for the same service and location are coalesced
+        :param service: BaseWeatherService object
+        :param latitude:
+        :param longitude:
+        :return: temperature in fahrenheit
+        """
+        if self.single_flight is None:
+            return self._call_upstream(service, latitude, longitude)
+
+        return self.single_flight.do((service.SERVICE_NAME, latitude, longitude),
+                                     lambda: self._call_upstream(service, latitude, longitude))
+
+    def _fetch(self, service, latitude: float, longitude: float):
+        """
+        Gets the current temperature from a single service, runs on the worker pool.
+        Concurrent misses of the cache share one call, in a flight that ends once the
+        reading is cached
+        :param service: BaseWeatherService object
+        :param latitude:
+        :param longitude:
+        :return: temperature in fahrenheit
+        """
+        if self.reading_cache is None:
+            return self._call_service(service, latitude, longitude)
+
+        return self.reading_cache.get_or_load(
+            service.SERVICE_NAME, latitude, longitude,
+            lambda: self._call_upstream(service, latitude, longitude), self.single_flight)
+
+    def refresh(self, service, latitude: float, longitude: float):
+        """
+        Fetches a new reading of a service for a location into the cache, runs on the
+        caller's thread
+        :param service: BaseWeatherService object
+        :param latitude:
+        :param longitude:
+        :return: temperature in fahrenheit
+        """
+        return self.reading_cache.refresh(
+            service.SERVICE_NAME, latitude, longitude,
+            lambda: self._call_upstream(service, latitude, longitude), self.single_flight)
+
+    def fan_out(self, weather_services: dict, latitude: float, longitude: float,
+                deadline: float = None) -> FanoutResult:
+        """
+        Gets the current temperature from all the given services in parallel
+        :param weather_services: dict of service name to BaseWeatherService object
+        :param latitude:
+        :param longitude:
+        :param deadline: seconds to wait for the services, defaults to self.deadline
+        :return: FanoutResult object
+        """
+        futures = OrderedDict()
+        for name, service in weather_services.items():
+            futures[name] = self._executor.submit(tracing.propagate(self._fetch), service,
+                                                  latitude, longitude)
+
+        wait(futures.values(), timeout=deadline or self.deadline)
+
+        result = FanoutResult()
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()
+                logging.warning('%s did not respond before the deadline', name)
+                result.timed_out.append(name)
+                continue
+
+            try:
+                result.readings[name] = future.result()
+            except ProviderSkippedException as err:
+                logging.debug('%s skipped: %s', name, err)
+                result.skipped.append(name)
+            except WeatherServiceException as err:
+                logging.warning('%s failed: %s', name, err)
+                result.failed.append(name)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.exception(err)
+                result.failed.append(name)
+
+        return result
+
+    def shutdown(self, wait_for_pending: bool = False):
+        """
+        Stops the worker pool
+        :param wait_for_pending: wait for the in-flight calls to finish
+        :return:
+        """
+        self._executor.shutdown(wait=wait_for_pending)
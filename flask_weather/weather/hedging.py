@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask_weather.helper import metrics, tracing
+
+
+class Hedger:
+    """
+    Hedged calls to one weather service.
+
+    A call that has not returned after the service's observed HEDGE_PERCENTILE
+    latency is sent a second time, and whichever attempt succeeds first is
+    used. Latencies of the last HEDGE_WINDOW successful attempts are kept;
+    there is no hedging before HEDGE_MIN_SAMPLES of them were seen.
+
+    Hedges are paid for by a budget: every call earns HEDGE_BUDGET of a hedge,
+    up to HEDGE_BURST saved hedges, so hedges add at most about HEDGE_BUDGET
+    to the calls made to the service.
+    """
+    PERCENTILE_KEY = 'HEDGE_PERCENTILE'
+    WINDOW_KEY = 'HEDGE_WINDOW'
+    MIN_SAMPLES_KEY = 'HEDGE_MIN_SAMPLES'
+    MIN_DELAY_KEY = 'HEDGE_MIN_DELAY'
+    BUDGET_KEY = 'HEDGE_BUDGET'
+    BURST_KEY = 'HEDGE_BURST'
+
+    DEFAULT_PERCENTILE = 0.95
+    DEFAULT_WINDOW = 200
+    DEFAULT_MIN_SAMPLES = 20
+    DEFAULT_MIN_DELAY = 0.02
+    DEFAULT_BUDGET = 0.05
+    DEFAULT_BURST = 5.0
+
+    # Seconds the hedge delay is reused before the percentile is computed again
+    DELAY_TTL = 1.0
+
+    def __init__(self, name: str, executor: ThreadPoolExecutor = None):
+        """
+        :param name: service name
+        :param executor: pool running the attempts of blocking calls
+        """
+        self.name = name
+        self.executor = executor
+        self.percentile = float(os.environ.get(self.PERCENTILE_KEY, self.DEFAULT_PERCENTILE))
+        self.min_samples = int(os.environ.get(self.MIN_SAMPLES_KEY, self.DEFAULT_MIN_SAMPLES))
+        self.min_delay = float(os.environ.get(self.MIN_DELAY_KEY, self.DEFAULT_MIN_DELAY))
+        self.budget = float(os.environ.get(self.BUDGET_KEY, self.DEFAULT_BUDGET))
+        self.burst = float(os.environ.get(self.BURST_KEY, self.DEFAULT_BURST))
+
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0
+        self.denied = 0
+        self._tokens = 0.0
+        self._latencies = deque(maxlen=int(os.environ.get(self.WINDOW_KEY,
+                                                          self.DEFAULT_WINDOW)))
+        self._delay = (None, 0.0)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """
+        Seconds to wait before hedging a call, None until enough latencies were seen
+        :return: float or None
+        """
+        now = time.monotonic()
+        delay, computed_at = self._delay
+        if now - computed_at < self.DELAY_TTL:
+            return delay
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            delay = None
+        else:
+            index = min(int(len(latencies) * self.percentile), len(latencies) - 1)
+            delay = max(latencies[index], self.min_delay)
+        self._delay = (delay, now)
+        return delay
+
+    def _start_call(self):
+        with self._lock:
+            self.calls += 1
+            self._tokens = min(self._tokens + self.budget, self.burst)
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._tokens < 1.0:
+                self.denied += 1
+                metrics.HEDGES.inc(self.name, 'denied')
+                return False
+            self._tokens -= 1.0
+            self.hedged += 1
+        metrics.HEDGES.inc(self.name, 'fired')
+        return True
+
+    def _record(self, elapsed: float):
+        with self._lock:
+            self._latencies.append(elapsed)
+
+    def _won(self):
+        with self._lock:
+            self.won += 1
+        metrics.HEDGES.inc(self.name, 'won')
+
+    def _attempt(self, func):
+        start = time.monotonic()
+        result = func()
+        self._record(time.monotonic() - start)
+        return result
+
+    async def _attempt_async(self, coro_func):
+        start = time.monotonic()
+        result = await coro_func()
+        self._record(time.monotonic() - start)
+        return result
+
+    def call(self, func):
+        """
+        Calls func on the executor, and a second time if it is slow and the budget allows.
+        Returns as soon as either attempt succeeds, the attempt that loses keeps running
+        on the executor until it returns
+        :param func: callable doing one blocking call to the service
+        :return: the result of the first attempt that succeeds
+        """
+        self._start_call()
+        delay = self.delay()
+        if delay is None or self.executor is None:
+            return self._attempt(func)
+
+        primary = self.executor.submit(tracing.propagate(self._attempt), func)
+        if wait([primary], timeout=delay).done or not self._take_hedge():
+            return primary.result()
+
+        logging.debug('Hedging %s after %.3f seconds', self.name, delay)
+        hedge = self.executor.submit(tracing.propagate(self._attempt), func)
+        pending = [primary, hedge]
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            # The primary wins ties, it was sent first
+            for future in (primary, hedge):
+                if future in done and future.exception() is None:
+                    # A hedge that answers after the primary failed saved no time
+                    if future is hedge and primary in pending and primary not in done:
+                        self._won()
+                    return future.result()
+            pending = [future for future in pending if future not in done]
+
+        return primary.result()
+
+    async def call_async(self, coro_func):
+        """
+        Awaits coro_func(), and a second coro_func() if it is slow and the budget allows.
+        The attempt that loses is cancelled
+        :param coro_func: callable returning a coroutine doing one call to the service
+        :return: the result of the first attempt that succeeds
+        """
+        self._start_call()
+        delay = self.delay()
+        if delay is None:
+            return await self._attempt_async(coro_func)
+
+        primary = asyncio.ensure_future(self._attempt_async(coro_func))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done or not self._take_hedge():
+                return await primary
+
+            logging.debug('Hedging %s after %.3f seconds', self.name, delay)
+            hedge = asyncio.ensure_future(self._attempt_async(coro_func))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in (primary, hedge):
+                    if task in done and task.exception() is None:
+                        if task is hedge and primary in pending:
+                            self._won()
+                        return task.result()
+
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {
+            'calls': self.calls,
+            'hedged': self.hedged,
+            'won': self.won,
+            'denied': self.denied,
+            'hedge_rate': round(self.hedged / self.calls, 4) if self.calls else 0.0,
+            'delay': round(delay, 4) if delay is not None else None,
+        }
+
+
+class Hedgers:
+    """
+    Hedgers of the weather services, created on first use. The attempts of blocking
+    calls run on a pool of HEDGE_MAX_WORKERS threads shared by all services
+    """
+    ENABLED_KEY = 'HEDGE_ENABLED'
+    MAX_WORKERS_KEY = 'HEDGE_MAX_WORKERS'
+
+    DEFAULT_MAX_WORKERS = 32
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or int(os.environ.get(self.MAX_WORKERS_KEY,
+                                                             self.DEFAULT_MAX_WORKERS))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix='hedge')
+        self._hedgers = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return os.environ.get(cls.ENABLED_KEY, '1') == '1'
+
+    def get(self, service_name: str) -> Hedger:
+        hedger = self._hedgers.get(service_name)
+        if hedger is None:
+            with self._lock:
+                hedger = self._hedgers.setdefault(service_name,
+                                                  Hedger(service_name, self._executor))
+        return hedger
+
+    def stats(self) -> dict:
+        return {name: hedger.stats() for name, hedger in list(self._hedgers.items())}
@@ -1,11 +1,5 @@
-import json
-import logging
 import os
-from http import HTTPStatus
 
-import requests
-
-from flask_weather.exceptions import WeatherServiceException
 from flask_weather.weather.base_service import BaseWeatherService
 
 
@@ -20,31 +14,23 @@ class NoaaWeather(BaseWeatherService):
         super().__init__()
         self.url = os.environ[self.BASE_URL_KEY]
 
-    def _get_current_weather(self, latitude: float, longitude: float):
+    def _build_request(self, latitude: float, longitude: float) -> tuple:
         """
-        For a given location gets the current weather report from NOAA
+        For a given location describes the current weather request to NOAA
         :param latitude:
         :param longitude:
-        :return: json data
+        :return: tuple (method, url, keyword arguments)
         """
         params = {
             'latlon': '{},{}'.format(str(latitude), str(longitude))
         }
 
-        response = requests.get(self.url + "/" + self.SERVICE_NAME, params=params)
-        if response.status_code == HTTPStatus.OK.value:
-            return json.loads(response.text)
+        return 'GET', self.url + "/" + self.SERVICE_NAME, {'params': params}
 
-    def get_current_temperature(self, latitude: float, longitude: float):
+    def _parse_temperature(self, report: dict) -> float:
         """
-        For a given location gets the current temperature in fahrenheit from NOAA
-        :param latitude:
-        :param longitude:
+        Gets the current temperature in fahrenheit from a NOAA report
+        :param report:
         :return:
         """
-        try:
-            report = self._get_current_weather(latitude, longitude)
-            return float(report["today"]["current"]["fahrenheit"])
-        except KeyError as err:
-            logging.exception(err)
-            raise WeatherServiceException from err
+        return float(report["today"]["current"]["fahrenheit"])
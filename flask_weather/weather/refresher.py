@@ -0,0 +1,216 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_weather.exceptions import ProviderSkippedException
+
+
+class HotLocationRefresher:
+    """
+    Keeps the readings of the most requested locations fresh.
+
+    Requests are counted per cache grid cell. Every `interval` seconds the
+    `hot_locations` most requested cells whose readings expire within `ahead`
+    seconds are refreshed, and stale readings served by the ReadingCache are
+    refreshed as they are served. Refreshes run on `concurrency` threads and
+    make at most `budget` upstream calls per minute. Counts are halved on every
+    scan so that locations that are no longer requested cool down.
+
+    The scanning thread starts with the first recorded request, so that it runs
+    in the process serving requests and not in a server that forks workers.
+    """
+    HOT_LOCATIONS_KEY = 'REFRESH_HOT_LOCATIONS'
+    CONCURRENCY_KEY = 'REFRESH_CONCURRENCY'
+    BUDGET_KEY = 'REFRESH_BUDGET'
+    AHEAD_KEY = 'REFRESH_AHEAD'
+    INTERVAL_KEY = 'REFRESH_INTERVAL'
+
+    DEFAULT_HOT_LOCATIONS = 100
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_BUDGET = 600
+    DEFAULT_AHEAD = 30.0
+    DEFAULT_INTERVAL = 5.0
+
+    DECAY = 0.5
+    MIN_COUNT = 0.5
+    MAX_TRACKED_FACTOR = 10
+    MAX_PENDING_FACTOR = 4
+    BUDGET_WINDOW = 60.0
+
+    def __init__(self, fanout, weather_services: dict, hot_locations: int = None,
+                 concurrency: int = None, budget: int = None, ahead: float = None,
+                 interval: float = None):
+        """
+        :param fanout: ProviderFanout object with a ReadingCache, refreshes go through it
+        :param weather_services: dict of service name to BaseWeatherService object
+        """
+        self.fanout = fanout
+        self.reading_cache = fanout.reading_cache
+        self.weather_services = weather_services
+        self.hot_locations = hot_locations or int(
+            os.environ.get(self.HOT_LOCATIONS_KEY, self.DEFAULT_HOT_LOCATIONS))
+        self.concurrency = concurrency or int(
+            os.environ.get(self.CONCURRENCY_KEY, self.DEFAULT_CONCURRENCY))
+        self.budget = budget or int(os.environ.get(self.BUDGET_KEY, self.DEFAULT_BUDGET))
+        self.ahead = ahead if ahead is not None else \
+            float(os.environ.get(self.AHEAD_KEY, self.DEFAULT_AHEAD))
+        self.interval = interval or float(os.environ.get(self.INTERVAL_KEY,
+                                                         self.DEFAULT_INTERVAL))
+
+        # grid cell -> [count, latitude, longitude, set of service names]
+        self._locations = dict()
+        self._pending = set()
+        self._budget_started = time.monotonic()
+        self._budget_used = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                            thread_name_prefix='refresh')
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.over_budget = 0
+
+    def _cell(self, latitude: float, longitude: float) -> tuple:
+        return self.reading_cache.make_key('', latitude, longitude)[1:]
+
+    def record(self, latitude: float, longitude: float, services: list):
+        """
+        Counts a request for a location
+        :param latitude:
+        :param longitude:
+        :param services: names of the services requested
+        :return:
+        """
+        cell = self._cell(latitude, longitude)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+
+            location = self._locations.get(cell)
+            if location is not None:
+                location[0] += 1
+                location[3].update(services)
+            elif len(self._locations) < self.hot_locations * self.MAX_TRACKED_FACTOR:
+                self._locations[cell] = [1, latitude, longitude, set(services)]
+
+    def _take_budget(self) -> bool:
+        now = time.monotonic()
+        if now - self._budget_started >= self.BUDGET_WINDOW:
+            self._budget_started = now
+            self._budget_used = 0
+
+        if self._budget_used >= self.budget:
+            self.over_budget += 1
+            return False
+
+        self._budget_used += 1
+        return True
+
+    def request_refresh(self, service_name: str, latitude: float, longitude: float) -> bool:
+        """
+        Schedules a refresh of the reading of a service for a location, unless one is
+        already pending, too many are queued or the budget of the minute is used up
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :return: True if scheduled
+        """
+        service = self.weather_services.get(service_name)
+        if service is None:
+            return False
+
+        key = (service_name, self._cell(latitude, longitude))
+        with self._lock:
+            if key in self._pending or \
+                    len(self._pending) >= self.concurrency * self.MAX_PENDING_FACTOR:
+                return False
+            if not self._take_budget():
+                return False
+            self._pending.add(key)
+
+        self._executor.submit(self._refresh, key, service, latitude, longitude)
+        return True
+
+    def _refresh(self, key: tuple, service, latitude: float, longitude: float):
+        try:
+            self.fanout.refresh(service, latitude, longitude)
+            self.refreshes += 1
+        except ProviderSkippedException as err:
+            logging.info(err)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning('Refresh of %s failed: %s', key, err)
+            self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def scan(self):
+        """
+        Refreshes the hot locations whose readings are about to expire, then decays the counts
+        :return:
+        """
+        with self._lock:
+            hottest = heapq.nlargest(self.hot_locations, self._locations.values(),
+                                     key=lambda location: location[0])
+            hot = [(latitude, longitude, list(services))
+                   for _, latitude, longitude, services in hottest]
+
+            for cell, location in list(self._locations.items()):
+                location[0] *= self.DECAY
+                if location[0] < self.MIN_COUNT:
+                    del self._locations[cell]
+
+        for latitude, longitude, services in hot:
+            for service_name in services:
+                expires_in = self.reading_cache.expires_in(service_name, latitude, longitude)
+                if expires_in is not None and expires_in < self.ahead:
+                    self.request_refresh(service_name, latitude, longitude)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.scan()
+            except Exception as err:  # pylint: disable=broad-except
+                logging.exception(err)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='refresher', daemon=True)
+        self._thread.start()
+
+    def start(self):
+        """
+        Starts scanning in a daemon thread, unless it is already running in this process
+        :return: self
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            tracked = len(self._locations)
+            pending = len(self._pending)
+            budget_used = self._budget_used
+
+        return {
+            'tracked_locations': tracked,
+            'hot_locations': min(tracked, self.hot_locations),
+            'pending': pending,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'over_budget': self.over_budget,
+            'budget_per_minute': self.budget,
+            'budget_used': budget_used,
+        }
@@ -0,0 +1,254 @@
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata as metadata
+
+
+class ProviderSpec:
+    """
+    Declaration of a weather service: the class implementing it and its settings
+    """
+
+    def __init__(self, name: str, target: str, enabled: bool = True, timeout: float = None,
+                 weight: float = 1.0, concurrency: int = None, rate: float = None):
+        """
+        :param name: service name, as used in the services request parameter
+        :param target: 'module:Class' of a BaseWeatherService subclass
+        :param enabled: disabled services are not offered
+        :param timeout: read timeout of the service in seconds, defaults to HTTP_READ_TIMEOUT
+        :param weight: weight of the service's readings in the average
+        :param concurrency: most calls to the service in flight at a time,
+                            None for ADMISSION_MAX_LIMIT
+        :param rate: most calls to the service per second, None for ADMISSION_RATE
+        """
+        self.name = name
+        self.target = target
+        self.enabled = enabled
+        self.timeout = timeout
+        self.weight = weight
+        self.concurrency = concurrency
+        self.rate = rate
+
+    def settings(self) -> tuple:
+        return self.timeout, self.weight, self.concurrency, self.rate
+
+    def to_dict(self) -> dict:
+        return {
+            'class': self.target,
+            'enabled': self.enabled,
+            'timeout': self.timeout,
+            'weight': self.weight,
+            'concurrency': self.concurrency,
+            'rate': self.rate,
+        }
+
+
+class ProviderRegistry(Mapping):
+    """
+    The weather services, as a mapping of service name to BaseWeatherService object.
+
+    Services are declared by the built-in providers, by packages through the
+    `sure_weather.providers` entry point group (name = 'module:Class'), and by
+    the JSON file at PROVIDERS_CONFIG, which can also change the settings of
+    the others or disable them:
+
+        {"providers": {"noaa": {"timeout": 1.5, "weight": 2, "concurrency": 16, "rate": 50},
+                       "accuweather": {"enabled": false},
+                       "metoffice": {"class": "weather_plugins.metoffice:MetOffice"}}}
+
+    A service is imported and created the first time it is used. Services that
+    fail to load are left out. The config file is read again when it changes,
+    at most every PROVIDERS_RELOAD_INTERVAL seconds, or on `reload()`.
+    """
+    CONFIG_KEY = 'PROVIDERS_CONFIG'
+    ENTRY_POINTS_KEY = 'PROVIDERS_ENTRY_POINTS'
+    RELOAD_INTERVAL_KEY = 'PROVIDERS_RELOAD_INTERVAL'
+
+    DEFAULT_RELOAD_INTERVAL = 5.0
+    ENTRY_POINT_GROUP = 'sure_weather.providers'
+
+    BUILTIN_PROVIDERS = OrderedDict([
+        ('weather.com', 'flask_weather.weather.weatherdotcom:WeatherDotCom'),
+        ('accuweather', 'flask_weather.weather.accuweather:AccuWeather'),
+        ('noaa', 'flask_weather.weather.noaa:NoaaWeather'),
+    ])
+
+    def __init__(self, config_path: str = None, entry_points: bool = None,
+                 reload_interval: float = None):
+        self.config_path = config_path or os.environ.get(self.CONFIG_KEY)
+        self.entry_points = entry_points if entry_points is not None else \
+            os.environ.get(self.ENTRY_POINTS_KEY, '1') == '1'
+        self.reload_interval = reload_interval if reload_interval is not None else \
+            float(os.environ.get(self.RELOAD_INTERVAL_KEY, self.DEFAULT_RELOAD_INTERVAL))
+
+        self.specs = OrderedDict()
+        self.failed = dict()
+        self._services = dict()
+        self._lock = threading.RLock()
+        self._config_mtime = None
+        self._checked_at = 0.0
+        self.reloads = 0
+        self.reload()
+
+    def _read_specs(self) -> OrderedDict:
+        specs = OrderedDict((name, ProviderSpec(name, target))
+                            for name, target in self.BUILTIN_PROVIDERS.items())
+
+        if self.entry_points:
+            for entry_point in self._entry_points():
+                specs[entry_point.name] = ProviderSpec(entry_point.name, entry_point.value)
+
+        if self.config_path:
+            with open(self.config_path) as config_file:
+                config = json.load(config_file)
+            for name, settings in config.get('providers', {}).items():
+                spec = specs.get(name) or ProviderSpec(name, settings.get('class'))
+                spec.target = settings.get('class', spec.target)
+                spec.enabled = bool(settings.get('enabled', spec.enabled))
+                spec.timeout = settings.get('timeout', spec.timeout)
+                spec.weight = float(settings.get('weight', spec.weight))
+                spec.concurrency = settings.get('concurrency', spec.concurrency)
+                spec.rate = settings.get('rate', spec.rate)
+                if not spec.target:
+                    logging.error('Provider %s has no class', name)
+                    continue
+                specs[name] = spec
+
+        return specs
+
+    def _entry_points(self) -> tuple:
+        try:
+            return tuple(metadata.entry_points().get(self.ENTRY_POINT_GROUP, ()))
+        except Exception as err:  # broken distributions must not stop the service
+            logging.error('Cannot read the %s entry points: %r', self.ENTRY_POINT_GROUP, err)
+            return ()
+
+    def _config_changed(self) -> bool:
+        now = time.monotonic()
+        if not self.config_path or now - self._checked_at < self.reload_interval:
+            return False
+
+        self._checked_at = now
+        try:
+            return os.stat(self.config_path).st_mtime != self._config_mtime
+        except OSError:
+            return False
+
+    def reload(self):
+        """
+        Reads the declarations again. Services that are still declared with the same class
+        are kept with their new settings, the others are loaded again on first use
+        :return:
+        """
+        with self._lock:
+            if self.config_path:
+                try:
+                    self._config_mtime = os.stat(self.config_path).st_mtime
+                except OSError:
+                    self._config_mtime = None
+
+            try:
+                specs = self._read_specs()
+            except (OSError, ValueError) as err:
+                logging.error('Keeping the weather services, cannot read %s: %s',
+                              self.config_path, err)
+                return
+
+            for name, service in list(self._services.items()):
+                spec = specs.get(name)
+                if spec is None or not spec.enabled or spec.target != self.specs[name].target:
+                    del self._services[name]
+                else:
+                    service.configure(*spec.settings())
+
+            self.specs = specs
+            self.failed = {name: error for name, error in self.failed.items()
+                           if name in specs and specs[name].target == error[0]}
+            self.reloads += 1
+            logging.info('Weather services: %s', ', '.join(self._names()))
+
+    def _load(self, name: str):
+        spec = self.specs[name]
+        logging.info('Adding Weather service: %s', name)
+        try:
+            module_name, _, class_name = spec.target.partition(':')
+            service_class = getattr(importlib.import_module(module_name), class_name)
+            service = service_class()
+        except (ImportError, AttributeError, KeyError, ValueError) as err:
+            logging.info('%s not available: %r', name, err)
+            self.failed[name] = (spec.target, repr(err))
+            return None
+
+        service.configure(*spec.settings())
+        logging.info('%s added', name)
+        self._services[name] = service
+        return service
+
+    def _names(self) -> list:
+        return [name for name, spec in self.specs.items()
+                if spec.enabled and name not in self.failed]
+
+    def __getitem__(self, name: str):
+        if self._config_changed():
+            self.reload()
+
+        service = self._services.get(name)
+        if service is not None:
+            return service
+
+        with self._lock:
+            if name not in self._names():
+                raise KeyError(name)
+            service = self._services.get(name) or self._load(name)
+        if service is None:
+            raise KeyError(name)
+        return service
+
+    def __iter__(self):
+        if self._config_changed():
+            self.reload()
+        return iter(self._names())
+
+    def __len__(self):
+        return len(self._names())
+
+    def select(self, names: list) -> OrderedDict:
+        """
+        The services of the given names that could be loaded
+        :param names: service names
+        :return: OrderedDict of service name to BaseWeatherService object
+        """
+        services = OrderedDict()
+        for name in names:
+            try:
+                services[name] = self[name]
+            except KeyError:
+                pass
+        return services
+
+    def load_all(self):
+        """
+        Loads every enabled service now instead of on first use
+        :return: self
+        """
+        for name in list(self._names()):
+            self.get(name)
+        return self
+
+    def stats(self) -> dict:
+        return {
+            'providers': {name: dict(spec.to_dict(), loaded=name in self._services,
+                                     error=self.failed.get(name, (None, None))[1])
+                          for name, spec in self.specs.items()},
+            'config': self.config_path,
+            'reloads': self.reloads,
+        }
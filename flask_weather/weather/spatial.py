@@ -0,0 +1,333 @@
+"""
+Spatial index of recent weather service readings, answering locations by
+inverse distance weighted interpolation of the readings around them.
+
+Every reading fetched from a service is added to the index with the location
+and time it was fetched for. A location is answered from the index when, for
+at least INTERPOLATION_MIN_SERVICES of the requested services, at least
+INTERPOLATION_MIN_NEIGHBOURS readings younger than INTERPOLATION_MAX_AGE
+seconds lie within INTERPOLATION_RADIUS_KM. Otherwise it is looked up live.
+
+Readings of a service are bucketed in grid cells about the radius wide, each
+cell keeping its readings in columns of doubles, oldest first, so expired
+readings are dropped from the front and a query only reads the cells around it.
+Queries of many locations, as in a batch, gather the candidate readings of a
+group of cells once for all the locations in it.
+"""
+import math
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from flask_weather.helper import metrics
+from flask_weather.weather.fanout import FanoutResult
+
+LOOKUP_MODE_KEY = 'LOOKUP_MODE'
+
+LIVE = 'live'
+INTERPOLATE = 'interpolate'
+LOOKUP_MODES = (LIVE, INTERPOLATE)
+DEFAULT_LOOKUP_MODE = LIVE
+
+INTERPOLATED = 'interpolated'
+
+KM_PER_DEGREE = 111.195
+
+
+def default_lookup_mode() -> str:
+    mode = os.environ.get(LOOKUP_MODE_KEY, DEFAULT_LOOKUP_MODE)
+    return mode if mode in LOOKUP_MODES else DEFAULT_LOOKUP_MODE
+
+
+class InterpolatedResult(FanoutResult):
+    """
+    Readings of a location interpolated from the readings around it, in place of the
+    FanoutResult of a live lookup
+    """
+    source = INTERPOLATED
+
+    def __init__(self):
+        super().__init__()
+        self.neighbours = 0
+        self.nearest_km = None
+        self.oldest_seconds = None
+
+    def details(self) -> dict:
+        return {
+            'neighbours': self.neighbours,
+            'nearest_km': round(self.nearest_km, 2),
+            'oldest_seconds': round(self.oldest_seconds, 1),
+        }
+
+
+class _Cell:
+    """
+    Readings of one service in one grid cell, oldest first
+    """
+    __slots__ = ('latitudes', 'longitudes', 'times', 'values')
+
+    def __init__(self):
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.times = array('d')
+        self.values = array('d')
+
+    def append(self, latitude: float, longitude: float, fetched_at: float, value: float):
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.times.append(fetched_at)
+        self.values.append(value)
+
+    def drop(self, count: int):
+        """
+        Drops the `count` oldest readings
+        """
+        if count:
+            del self.latitudes[:count]
+            del self.longitudes[:count]
+            del self.times[:count]
+            del self.values[:count]
+
+    def expire(self, oldest: float):
+        """
+        Drops the readings fetched before `oldest`
+        """
+        count = 0
+        for fetched_at in self.times:
+            if fetched_at >= oldest:
+                break
+            count += 1
+        self.drop(count)
+
+
+class ReadingIndex:
+    """
+    Recent readings of every weather service, bucketed by location
+    """
+    ENABLED_KEY = 'INTERPOLATION_ENABLED'
+    RADIUS_KEY = 'INTERPOLATION_RADIUS_KM'
+    MAX_AGE_KEY = 'INTERPOLATION_MAX_AGE'
+    MIN_NEIGHBOURS_KEY = 'INTERPOLATION_MIN_NEIGHBOURS'
+    MIN_SERVICES_KEY = 'INTERPOLATION_MIN_SERVICES'
+    POWER_KEY = 'INTERPOLATION_POWER'
+    CELL_READINGS_KEY = 'INTERPOLATION_CELL_READINGS'
+
+    DEFAULT_RADIUS = 10.0
+    DEFAULT_MAX_AGE = 120.0
+    DEFAULT_MIN_NEIGHBOURS = 3
+    DEFAULT_MIN_SERVICES = 2
+    DEFAULT_POWER = 2.0
+    DEFAULT_CELL_READINGS = 64
+
+    # Readings closer than this are taken as they are
+    EXACT_KM = 0.01
+
+    def __init__(self, radius: float = None, max_age: float = None, min_neighbours: int = None,
+                 min_services: int = None, power: float = None, cell_readings: int = None):
+        """
+        :param radius: kilometres around a location its neighbours are taken from
+        :param max_age: seconds a reading is used for
+        :param min_neighbours: readings of a service a location needs to be interpolated
+        :param min_services: services a location needs to be interpolated, at most the
+                             number of requested services
+        :param power: power of the distance the readings are weighted by the inverse of
+        :param cell_readings: readings of a service kept per grid cell
+        """
+        self.radius = radius or float(os.environ.get(self.RADIUS_KEY, self.DEFAULT_RADIUS))
+        self.max_age = max_age or float(os.environ.get(self.MAX_AGE_KEY, self.DEFAULT_MAX_AGE))
+        self.min_neighbours = min_neighbours or int(os.environ.get(self.MIN_NEIGHBOURS_KEY,
+                                                                   self.DEFAULT_MIN_NEIGHBOURS))
+        self.min_services = min_services or int(os.environ.get(self.MIN_SERVICES_KEY,
+                                                               self.DEFAULT_MIN_SERVICES))
+        self.power = power or float(os.environ.get(self.POWER_KEY, self.DEFAULT_POWER))
+        self.cell_readings = cell_readings or int(os.environ.get(self.CELL_READINGS_KEY,
+                                                                 self.DEFAULT_CELL_READINGS))
+        self.cell_degrees = self.radius / KM_PER_DEGREE
+
+        self._cells = dict()
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+        self.added = 0
+        self.interpolated = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return os.environ.get(cls.ENABLED_KEY, '1') == '1'
+
+    def _cell_of(self, latitude: float, longitude: float) -> tuple:
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def add(self, service_name: str, latitude: float, longitude: float, value: float,
+            fetched_at: float = None):
+        """
+        Adds a reading fetched from a service
+        :param service_name:
+        :param latitude:
+        :param longitude:
+        :param value: temperature in fahrenheit
+        :param fetched_at: time.monotonic() of the reading, defaults to now
+        :return:
+        """
+        now = time.monotonic()
+        key = (service_name,) + self._cell_of(latitude, longitude)
+        with self._lock:
+            cell = self._cells.get(key)
+            if cell is None:
+                cell = self._cells[key] = _Cell()
+            cell.append(latitude, longitude, fetched_at or now, value)
+            if len(cell.times) > self.cell_readings:
+                cell.drop(len(cell.times) - self.cell_readings)
+            self.added += 1
+
+            if now - self._swept_at >= self.max_age:
+                self._sweep(now - self.max_age)
+                self._swept_at = now
+
+    def _sweep(self, oldest: float):
+        """
+        Drops the expired readings and the cells left empty, must hold the lock
+        """
+        for key, cell in list(self._cells.items()):
+            cell.expire(oldest)
+            if not cell.times:
+                del self._cells[key]
+
+    def _candidates(self, service_name: str, cells: tuple, oldest: float) -> tuple:
+        """
+        Readings of a service in a block of cells fetched after `oldest`
+        :param cells: tuple (first latitude cell, last latitude cell, first longitude cell,
+                      last longitude cell)
+        :return: tuple of arrays (latitudes, longitudes, times, values)
+        """
+        latitudes, longitudes, times, values = array('d'), array('d'), array('d'), array('d')
+        first_lat, last_lat, first_lon, last_lon = cells
+        with self._lock:
+            for lat_cell in range(first_lat, last_lat + 1):
+                for lon_cell in range(first_lon, last_lon + 1):
+                    cell = self._cells.get((service_name, lat_cell, lon_cell))
+                    if cell is None:
+                        continue
+                    cell.expire(oldest)
+                    latitudes.extend(cell.latitudes)
+                    longitudes.extend(cell.longitudes)
+                    times.extend(cell.times)
+                    values.extend(cell.values)
+        return latitudes, longitudes, times, values
+
+    def _block(self, lat_cell: int) -> tuple:
+        """
+        :return: tuple (latitude cells, longitude cells) on each side of a cell that can hold
+                 readings within the radius of a location in it, a degree of longitude
+                 being shorter away from the equator
+        """
+        latitude = min(abs(lat_cell * self.cell_degrees) + 2 * self.cell_degrees, 89.0)
+        return 1, math.ceil(1 / math.cos(math.radians(latitude)))
+
+    def _interpolate_service(self, candidates: tuple, latitude: float, longitude: float,
+                             now: float):
+        """
+        :return: tuple (value, neighbours, nearest km, oldest seconds), None when there
+                 are fewer than min_neighbours readings within the radius
+        """
+        latitudes, longitudes, times, values = candidates
+        lon_scale = math.cos(math.radians(latitude))
+        radius_squared = self.cell_degrees * self.cell_degrees
+        # Squared distances in degrees of latitude, on an equirectangular projection
+        squared = [lat_delta * lat_delta + lon_delta * lon_delta for lat_delta, lon_delta in
+                   zip([lat - latitude for lat in latitudes],
+                       [(lon - longitude) * lon_scale for lon in longitudes])]
+        neighbours = [position for position, distance in enumerate(squared)
+                      if distance <= radius_squared]
+        if len(neighbours) < self.min_neighbours:
+            return None
+
+        distances = [math.sqrt(squared[position]) * KM_PER_DEGREE for position in neighbours]
+        nearest = min(distances)
+        oldest = now - min(times[position] for position in neighbours)
+        if nearest < self.EXACT_KM:
+            value = values[neighbours[distances.index(nearest)]]
+        else:
+            weights = [distance ** -self.power for distance in distances]
+            value = sum(weight * values[position]
+                        for weight, position in zip(weights, neighbours)) / sum(weights)
+        return value, len(neighbours), nearest, oldest
+
+    def interpolate_many(self, locations: list, services: list) -> list:
+        """
+        Interpolates the readings of many locations
+        :param locations: list of tuples (latitude, longitude)
+        :param services: list of the service names requested for each location
+        :return: list with an InterpolatedResult per location, None for the locations
+                 without enough readings around them
+        """
+        now = time.monotonic()
+        oldest = now - self.max_age
+        results = [None] * len(locations)
+
+        # Locations of the same cell share the candidate readings of the cells around it
+        groups = OrderedDict()
+        for position, (latitude, longitude) in enumerate(locations):
+            groups.setdefault(self._cell_of(latitude, longitude), []).append(position)
+
+        for (lat_cell, lon_cell), positions in groups.items():
+            lat_span, lon_span = self._block(lat_cell)
+            cells = (lat_cell - lat_span, lat_cell + lat_span,
+                     lon_cell - lon_span, lon_cell + lon_span)
+            candidates = dict()
+
+            for position in positions:
+                latitude, longitude = locations[position]
+                requested = services[position]
+                result = InterpolatedResult()
+                for name in requested:
+                    if name not in candidates:
+                        candidates[name] = self._candidates(name, cells, oldest)
+                    interpolation = self._interpolate_service(candidates[name], latitude,
+                                                              longitude, now)
+                    if interpolation is None:
+                        result.skipped.append(name)
+                        continue
+                    value, neighbours, nearest, age = interpolation
+                    result.readings[name] = value
+                    result.neighbours += neighbours
+                    result.nearest_km = nearest if result.nearest_km is None else \
+                        min(result.nearest_km, nearest)
+                    result.oldest_seconds = age if result.oldest_seconds is None else \
+                        max(result.oldest_seconds, age)
+
+                if requested and len(result.readings) >= min(self.min_services, len(requested)):
+                    results[position] = result
+
+        interpolated = sum(result is not None for result in results)
+        with self._lock:
+            self.interpolated += interpolated
+            self.fallbacks += len(results) - interpolated
+        if interpolated:
+            metrics.INTERPOLATIONS.inc('interpolated', amount=interpolated)
+        if len(results) - interpolated:
+            metrics.INTERPOLATIONS.inc('fallback', amount=len(results) - interpolated)
+        return results
+
+    def interpolate(self, latitude: float, longitude: float, services: list):
+        """
+        :param latitude:
+        :param longitude:
+        :param services: requested service names
+        :return: InterpolatedResult, None when there are not enough readings around
+        """
+        return self.interpolate_many([(latitude, longitude)], [services])[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'cells': len(self._cells),
+                'readings': sum(len(cell.times) for cell in self._cells.values()),
+                'added': self.added,
+                'interpolated': self.interpolated,
+                'fallbacks': self.fallbacks,
+                'radius_km': self.radius,
+                'max_age': self.max_age,
+            }
@@ -0,0 +1,378 @@
+"""
+Subscriptions to the current weather of a set of locations, streamed to the
+client as server-sent events or NDJSON lines.
+
+Every distinct location, that is latitude, longitude, services and aggregation,
+is polled once every SUBSCRIPTION_INTERVAL seconds however many clients
+subscribed to it, so the calls to the weather services grow with the distinct
+locations and not with the connected clients. The polls go through the same
+fanout, reading cache and single flight as /current_weather requests. A client
+is sent the current weather of each of its locations when it subscribes, then
+an update only when the aggregated temperature of a location changed by more
+than SUBSCRIPTION_MIN_CHANGE, or when its lookup starts or stops failing.
+
+A client that reads slower than the updates come gets the latest update of
+each of its locations, the ones it missed are dropped.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_weather.exceptions import SureWeatherException, ServiceNotAvailable, AppErrorCodes
+from flask_weather.helper import metrics
+
+SSE_CONTENT_TYPE = 'text/event-stream'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# Sent to keep idle connections open, ignored by EventSource and NDJSON readers
+SSE_HEARTBEAT = b': keepalive\n\n'
+NDJSON_HEARTBEAT = b'\n'
+
+# Parsed location of a subscription, shared by the clients that subscribed to it
+Location = namedtuple('Location', ['latitude', 'longitude', 'services', 'strategy'])
+
+
+def format_event(data: bytes, content_type: str) -> bytes:
+    """
+    :param data: encoded update
+    :param content_type: SSE_CONTENT_TYPE or NDJSON_CONTENT_TYPE
+    :return: bytes to write to the stream
+    """
+    if content_type == SSE_CONTENT_TYPE:
+        return b'event: update\ndata: ' + data + b'\n\n'
+    return data + b'\n'
+
+
+def heartbeat(content_type: str) -> bytes:
+    return SSE_HEARTBEAT if content_type == SSE_CONTENT_TYPE else NDJSON_HEARTBEAT
+
+
+def group_locations(parsed: list) -> OrderedDict:
+    """
+    Groups identical locations of a subscription
+    :param parsed: list of tuples (latitude, longitude, services, strategy), one per location
+    :return: OrderedDict of Location to the list of its indices in the request
+    """
+    locations = OrderedDict()
+    for index, (latitude, longitude, services, strategy) in enumerate(parsed):
+        location = Location(latitude, longitude, tuple(sorted(services)), strategy)
+        locations.setdefault(location, []).append(index)
+    return locations
+
+
+class Subscription:
+    """
+    Locations of one client and their updates not yet sent to it, the latest per location
+    """
+
+    def __init__(self, locations: OrderedDict, notify):
+        """
+        :param locations: OrderedDict of Location to the list of its indices in the request
+        :param notify: called without arguments when an update is pending
+        """
+        self.locations = locations
+        self._notify = notify
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def push(self, location: Location, response: dict, error: SureWeatherException):
+        with self._lock:
+            self._pending[location] = (response, error)
+        self._notify()
+
+    def take(self) -> list:
+        """
+        :return: list of tuples (Location, response dict, SureWeatherException) pending,
+                 one of the last two None
+        """
+        with self._lock:
+            pending = [(location,) + update for location, update in self._pending.items()]
+            self._pending.clear()
+        return pending
+
+
+class _LocationState:
+    __slots__ = ('subscribers', 'last', 'fahrenheit', 'error_code', 'next_poll', 'polling')
+
+    def __init__(self):
+        self.subscribers = set()
+        self.last = None
+        self.fahrenheit = None
+        self.error_code = None
+        self.next_poll = None
+        self.polling = False
+
+
+class SubscriptionHub:
+    """
+    Subscribed locations, their polling schedule and the clients subscribed to each
+    """
+    INTERVAL_KEY = 'SUBSCRIPTION_INTERVAL'
+    MIN_CHANGE_KEY = 'SUBSCRIPTION_MIN_CHANGE'
+    MAX_CLIENTS_KEY = 'SUBSCRIPTION_MAX_CLIENTS'
+    MAX_LOCATIONS_KEY = 'SUBSCRIPTION_MAX_LOCATIONS'
+    HEARTBEAT_KEY = 'SUBSCRIPTION_HEARTBEAT'
+    CONCURRENCY_KEY = 'SUBSCRIPTION_CONCURRENCY'
+
+    DEFAULT_INTERVAL = 10.0
+    DEFAULT_MIN_CHANGE = 0.0
+    DEFAULT_MAX_CLIENTS = 1000
+    DEFAULT_MAX_LOCATIONS = 100
+    DEFAULT_HEARTBEAT = 15.0
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, interval: float = None, min_change: float = None,
+                 max_clients: int = None, max_locations: int = None, heartbeat: float = None,
+                 concurrency: int = None):
+        """
+        :param interval: seconds between two polls of a location
+        :param min_change: fahrenheit the temperature of a location must change by to be sent
+        :param max_clients: subscriptions open at a time
+        :param max_locations: locations per subscription
+        :param heartbeat: seconds without update after which a keep-alive is sent
+        :param concurrency: locations polled at a time
+        """
+        self.interval = interval or float(os.environ.get(self.INTERVAL_KEY,
+                                                         self.DEFAULT_INTERVAL))
+        self.min_change = min_change if min_change is not None else \
+            float(os.environ.get(self.MIN_CHANGE_KEY, self.DEFAULT_MIN_CHANGE))
+        self.max_clients = max_clients or int(os.environ.get(self.MAX_CLIENTS_KEY,
+                                                             self.DEFAULT_MAX_CLIENTS))
+        self.max_locations = max_locations or int(os.environ.get(self.MAX_LOCATIONS_KEY,
+                                                                 self.DEFAULT_MAX_LOCATIONS))
+        self.heartbeat = heartbeat or float(os.environ.get(self.HEARTBEAT_KEY,
+                                                           self.DEFAULT_HEARTBEAT))
+        self.concurrency = concurrency or int(os.environ.get(self.CONCURRENCY_KEY,
+                                                             self.DEFAULT_CONCURRENCY))
+
+        self._states = dict()
+        self._subscriptions = set()
+        # Tuples (next poll, sequence, Location), entries whose time is no longer the
+        # location's next poll are skipped
+        self._schedule = list()
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                            thread_name_prefix='subscription')
+        self._stop = threading.Event()
+        self._lookup = None
+        self._loop = None
+        self._semaphore = None
+        self._pid = None
+
+        self.polls = 0
+        self.updates = 0
+        self.unchanged = 0
+        self.errors = 0
+
+    def start(self, lookup, loop: asyncio.AbstractEventLoop = None):
+        """
+        Starts polling in a daemon thread, unless it is already running in this process
+        :param lookup: callable taking a Location and returning its /current_weather response
+                       or raising a SureWeatherException, run on a pool of `concurrency`
+                       threads
+        :param loop: event loop the lookups run on instead, lookup is then a coroutine
+                     function. start must be called from the loop
+        :return: self
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return self
+            self._pid = os.getpid()
+            self._lookup = lookup
+            if loop is not None:
+                self._loop = loop
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+        threading.Thread(target=self._run, name='subscriptions', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+    def subscribe(self, locations: OrderedDict, notify) -> Subscription:
+        """
+        Subscribes a client to its locations, it is sent the last known weather of the ones
+        already polled and the others are polled right away
+        :param locations: OrderedDict of Location to the list of its indices in the request
+        :param notify: called without arguments when an update is pending
+        :return: Subscription
+        :raises ServiceNotAvailable: when max_clients subscriptions are open
+        """
+        subscription = Subscription(locations, notify)
+        polled = list()
+        with self._lock:
+            if len(self._subscriptions) >= self.max_clients:
+                raise ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
+                                          'Too many subscriptions, retry later')
+            self._subscriptions.add(subscription)
+
+            now = time.monotonic()
+            for location in locations:
+                state = self._states.get(location)
+                if state is None:
+                    state = self._states[location] = _LocationState()
+                    state.polling = True
+                    self._reschedule(location, state, now)
+                    polled.append(location)
+                elif state.last is not None:
+                    subscription.push(location, *state.last)
+                state.subscribers.add(subscription)
+
+        for location in polled:
+            self._submit(location)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Removes a client, the locations it was the last subscriber of are no longer polled
+        :param subscription: Subscription returned by subscribe
+        :return:
+        """
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            for location in subscription.locations:
+                state = self._states.get(location)
+                if state is None:
+                    continue
+                state.subscribers.discard(subscription)
+                if not state.subscribers:
+                    del self._states[location]
+
+    def _reschedule(self, location: Location, state: _LocationState, now: float):
+        # Must hold the lock
+        state.next_poll = now + self.interval
+        self._sequence += 1
+        heapq.heappush(self._schedule, (state.next_poll, self._sequence, location))
+
+    def _due(self) -> tuple:
+        """
+        Takes the locations due for a poll and schedules their next one
+        :return: tuple (list of Location, seconds until the next poll is due)
+        """
+        due = list()
+        with self._lock:
+            now = time.monotonic()
+            while self._schedule and self._schedule[0][0] <= now:
+                next_poll, _, location = heapq.heappop(self._schedule)
+                state = self._states.get(location)
+                if state is None or state.next_poll != next_poll:
+                    continue
+                # A location whose previous poll has not completed waits for the next round
+                if not state.polling:
+                    state.polling = True
+                    due.append(location)
+                self._reschedule(location, state, now)
+            wait = self._schedule[0][0] - now if self._schedule else self.interval
+        return due, min(max(wait, 0.0), self.interval)
+
+    def _run(self):
+        wait = self.interval
+        while not self._stop.wait(wait):
+            try:
+                due, wait = self._due()
+                for location in due:
+                    self._submit(location)
+            except Exception as err:  # pylint: disable=broad-except
+                logging.exception(err)
+                wait = self.interval
+
+    def _submit(self, location: Location):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._poll_async(location), self._loop)
+        else:
+            self._executor.submit(self._poll, location)
+
+    def _poll(self, location: Location):
+        response, error = None, None
+        try:
+            response = self._lookup(location)
+        except SureWeatherException as err:
+            error = err
+        except Exception as err:  # pylint: disable=broad-except
+            logging.exception(err)
+            error = ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
+                                        'No weather service available')
+        self.publish(location, response, error)
+
+    async def _poll_async(self, location: Location):
+        response, error = None, None
+        async with self._semaphore:
+            try:
+                response = await self._lookup(location)
+            except SureWeatherException as err:
+                error = err
+            except Exception as err:  # pylint: disable=broad-except
+                logging.exception(err)
+                error = ServiceNotAvailable(AppErrorCodes.SERVICE_NOT_AVAILABLE,
+                                            'No weather service available')
+        self.publish(location, response, error)
+
+    def _changed(self, state: _LocationState, response: dict,
+                 error: SureWeatherException) -> bool:
+        """
+        Compares a poll with the last update sent, and keeps it when it is sent. Must hold
+        the lock
+        """
+        if error is not None:
+            if state.last is not None and state.error_code == error.error_code:
+                return False
+            state.error_code, state.fahrenheit = error.error_code, None
+            return True
+
+        fahrenheit = response['temperature']['fahrenheit']
+        if state.fahrenheit is not None and abs(fahrenheit - state.fahrenheit) <= self.min_change:
+            return False
+        state.error_code, state.fahrenheit = None, fahrenheit
+        return True
+
+    def publish(self, location: Location, response: dict = None,
+                error: SureWeatherException = None):
+        """
+        Records the result of a poll, and sends it to the subscribers of the location when
+        the temperature changed
+        :param location:
+        :param response: /current_weather response on success
+        :param error: SureWeatherException on failure
+        :return:
+        """
+        with self._lock:
+            self.polls += 1
+            if error is not None:
+                self.errors += 1
+            state = self._states.get(location)
+            if state is None:
+                return
+            state.polling = False
+            if self._changed(state, response, error):
+                self.updates += 1
+                state.last = (response, error)
+                subscribers = list(state.subscribers)
+            else:
+                self.unchanged += 1
+                subscribers = None
+
+        if subscribers is None:
+            metrics.SUBSCRIPTION_POLLS.inc('unchanged')
+            return
+        metrics.SUBSCRIPTION_POLLS.inc('error' if error is not None else 'changed')
+        for subscription in subscribers:
+            subscription.push(location, response, error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'subscriptions': len(self._subscriptions),
+                'locations': len(self._states),
+                'polls': self.polls,
+                'updates': self.updates,
+                'unchanged': self.unchanged,
+                'errors': self.errors,
+                'interval': self.interval,
+                'min_change': self.min_change,
+            }
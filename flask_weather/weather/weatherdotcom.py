@@ -1,11 +1,5 @@
-import json
-import logging
 import os
-from http import HTTPStatus
 
-import requests
-
-from flask_weather.exceptions import WeatherServiceException
 from flask_weather.weather.base_service import BaseWeatherService
 
 
@@ -20,32 +14,25 @@ class WeatherDotCom(BaseWeatherService):
         super().__init__()
         self.url = os.environ[self.BASE_URL_KEY]
 
-    def _get_current_weather(self, latitude: float, longitude: float):
+    def _build_request(self, latitude: float, longitude: float) -> tuple:
         """
-        For a given location gets the current weather report from weather.com
+        For a given location describes the current weather request to weather.com.
+        The lookup is a POST but it is safe to retry
         :param latitude:
         :param longitude:
-        :return:
+        :return: tuple (method, url, keyword arguments)
         """
         data = {
             'lat': str(latitude),
             'lon': str(longitude)
         }
 
-        response = requests.post(self.url + "/weatherdotcom", json=data)
-        if response.status_code == HTTPStatus.OK:
-            return json.loads(response.text)
+        return 'POST', self.url + "/weatherdotcom", {'json': data}
 
-    def get_current_temperature(self, latitude: float, longitude: float):
+    def _parse_temperature(self, report: dict) -> float:
         """
-        For a given location gets the current temperature in fahrenheit from weather.com
-        :param latitude:
-        :param longitude:
+        Gets the current temperature in fahrenheit from a weather.com report
+        :param report:
         :return:
         """
-        try:
-            report = self._get_current_weather(latitude, longitude)
-            return float(report["query"]["results"]["channel"]["condition"]["temp"])
-        except KeyError as err:
-            logging.exception(err)
-            raise WeatherServiceException from err
+        return float(report["query"]["results"]["channel"]["condition"]["temp"])